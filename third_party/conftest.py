@@ -0,0 +1,21 @@
+import pytest
+
+from experiments.causal_trace import ModelAndTokenizer
+from tests.synthetic import make_facts, make_model, make_tokenizer
+
+
+@pytest.fixture(scope="session")
+def synthetic_facts():
+    return make_facts(8, seed=0)
+
+
+@pytest.fixture(scope="session", params=["gpt2", "gptj"])
+def tiny_mt(request, synthetic_facts):
+    """
+    A small, randomly initialized model with a tokenizer trained on the
+    synthetic facts, on the cpu.
+    """
+    _, corpus = synthetic_facts
+    tok = make_tokenizer(corpus, vocab_size=500)
+    model = make_model(request.param, tok, n_layer=4, n_embd=64, n_head=4, n_positions=128, device="cpu")
+    return ModelAndTokenizer(model=model, tokenizer=tok)
@@ -0,0 +1,504 @@
+"""
+Benchmarks the main workloads of the repository on a small, randomly
+initialized GPT-2 or GPT-J model with a tokenizer trained on synthetic
+facts, so that it runs offline and on the cpu:
+
+    python -m experiments.benchmark --arch gpt2 --device cpu --profile_hooks 1
+
+For each of calculate_hidden_flow, compute_u, compute_v, layer_stats,
+generate_fast and test_batch_prediction it reports the time per run, the
+throughput and the peak memory used above what was in use before the run.
+With --profile_hooks, one more run of each workload is made inside a
+nethook.HookProfile, to show how much of it is spent in the Trace hooks.
+The numbers are only comparable between runs with the same arguments on
+the same machine.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from argparse import Namespace
+
+import numpy as np
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from transformers import (
+    AutoModelForCausalLM,
+    GPT2Config,
+    GPTJConfig,
+    PreTrainedTokenizerFast,
+)
+
+from experiments.causal_trace import ModelAndTokenizer, calculate_hidden_flow
+from experiments.py.eval_utils_counterfact import test_batch_prediction_groups
+from rome.compute_u import compute_u
+from rome.compute_v import compute_v
+from rome.layer_stats import layer_stats
+from rome.rome_hparams import ROMEHyperParams
+from util import nethook
+from util.generate import generate_fast
+
+SYLLABLES = ["ka", "lo", "mi", "ren", "tos", "vel", "dar", "shi", "po", "ne", "gu", "bra"]
+RELATIONS = [
+    "{} is located in",
+    "{} was born in",
+    "The native language of {} is",
+    "{} works in the field of",
+    "{} is a citizen of",
+]
+ARCH_MODULES = dict(
+    gpt2=dict(rewrite_module_tmp="transformer.h.{}.mlp.c_proj", lm_head_module="transformer.wte"),
+    gptj=dict(rewrite_module_tmp="transformer.h.{}.mlp.fc_out", lm_head_module="lm_head"),
+)
+BENCHMARKS = [
+    "hidden_flow",
+    "compute_u",
+    "compute_v",
+    "layer_stats",
+    "generate_fast",
+    "test_batch_prediction",
+]
+
+
+def make_word(prng, capitalize=True):
+    word = "".join(prng.choice(SYLLABLES, size=prng.randint(2, 4)))
+    return word.capitalize() if capitalize else word
+
+
+def make_facts(num_facts, seed=0):
+    """
+    Returns num_facts synthetic records in the format of CounterFact, about
+    made-up subjects of one or two words, and a corpus of texts mentioning them.
+    """
+    prng = np.random.RandomState(seed)
+    subjects = [
+        " ".join(make_word(prng) for _ in range(prng.randint(1, 3))) for _ in range(num_facts)
+    ]
+    facts, corpus = [], []
+    for i, subject in enumerate(subjects):
+        relation = RELATIONS[i % len(RELATIONS)]
+        target_true, target_new = make_word(prng), make_word(prng)
+        neighbors = [s for s in subjects if s != subject][:3]
+        facts.append(
+            dict(
+                case_id=i,
+                requested_rewrite=dict(
+                    prompt=relation,
+                    subject=subject,
+                    target_true=dict(str=target_true),
+                    target_new=dict(str=target_new),
+                ),
+                paraphrase_prompts=[
+                    f"{make_word(prng)} {make_word(prng, False)}. " + relation.format(subject),
+                    "As everyone knows, " + relation.format(subject),
+                ],
+                neighborhood_prompts=[relation.format(s) for s in neighbors],
+            )
+        )
+        corpus.append(f"{relation.format(subject)} {target_true}.")
+        corpus.append(
+            " ".join(make_word(prng, j == 0) for j in range(prng.randint(8, 40))) + "."
+        )
+    return facts, corpus
+
+
+def make_tokenizer(corpus, vocab_size):
+    """
+    Trains a byte-level BPE tokenizer like GPT-2's on corpus.
+    """
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=vocab_size,
+        special_tokens=["<|endoftext|>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    )
+    tokenizer.train_from_iterator(corpus, trainer)
+    tok = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        bos_token="<|endoftext|>",
+        eos_token="<|endoftext|>",
+        unk_token="<|endoftext|>",
+    )
+    tok.pad_token = tok.eos_token
+    return tok
+
+
+def make_model(arch, tok, n_layer, n_embd, n_head, n_positions, device, seed=0):
+    """
+    Returns a randomly initialized model of the given architecture.
+    """
+    config_args = dict(
+        vocab_size=len(tok),
+        n_positions=n_positions,
+        n_embd=n_embd,
+        n_layer=n_layer,
+        n_head=n_head,
+        bos_token_id=tok.bos_token_id,
+        eos_token_id=tok.eos_token_id,
+    )
+    if arch == "gpt2":
+        config = GPT2Config(**config_args)
+    elif arch == "gptj":
+        config = GPTJConfig(rotary_dim=n_embd // n_head // 2, **config_args)
+    else:
+        raise ValueError(f"Unknown architecture {arch}")
+    torch.manual_seed(seed)
+    model = AutoModelForCausalLM.from_config(config)
+    nethook.set_requires_grad(False, model)
+    return model.eval().to(device)
+
+
+def make_hparams(arch, n_layer, v_num_grad_steps):
+    return ROMEHyperParams(
+        layers=[n_layer // 2],
+        fact_token="subject_last",
+        v_num_grad_steps=v_num_grad_steps,
+        v_lr=5e-1,
+        v_loss_layer=n_layer - 1,
+        v_weight_decay=0.5,
+        clamp_norm_factor=4,
+        kl_factor=0.0625,
+        # The inverse covariance comes from layer_stats, which is benchmarked on its own.
+        mom2_adjustment=False,
+        context_template_length_params=[[5, 10], [10, 10]],
+        layer_module_tmp="transformer.h.{}",
+        mlp_module_tmp="transformer.h.{}.mlp",
+        attn_module_tmp="transformer.h.{}.attn",
+        ln_f_module="transformer.ln_f",
+        mom2_dataset="wikitext",
+        mom2_n_samples=100000,
+        mom2_dtype="float32",
+        editing_noise=0.1,
+        **ARCH_MODULES[arch],
+    )
+
+
+class PeakMemory(contextlib.AbstractContextManager):
+    """
+    Measures the peak memory in use while the context is open, above what
+    was in use when it was entered: allocated memory on a CUDA device, and
+    otherwise the resident set size of the process, sampled every interval
+    seconds. peak_bytes is None if neither can be measured.
+    """
+
+    def __init__(self, device, interval=0.002):
+        self.device = torch.device(device)
+        self.interval = interval
+        self.peak_bytes = None
+
+    def rss(self):
+        try:
+            with open("/proc/self/statm", "r") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError):
+            return None
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, self.rss())
+
+    def __enter__(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+            self.baseline = torch.cuda.memory_allocated(self.device)
+            return self
+        self.baseline = self.peak = self.rss()
+        if self.baseline is not None:
+            self.stopped = threading.Event()
+            self.thread = threading.Thread(target=self.sample, daemon=True)
+            self.thread.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+            self.peak_bytes = torch.cuda.max_memory_allocated(self.device) - self.baseline
+        elif self.baseline is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.peak_bytes = max(self.peak, self.rss()) - self.baseline
+
+
+def clock(device):
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize(device)
+    return time.perf_counter()
+
+
+def run_benchmark(name, fn, device, repeats=3, warmup=1, profile_hooks=False, verbose=False):
+    """
+    Times repeats calls of fn(), after warmup calls. fn returns the number
+    of items it processed and their unit, used to compute the throughput.
+    """
+    if repeats < 1:
+        raise ValueError(f"repeats must be at least 1, got {repeats}")
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    seconds, peaks = [], []
+    with output:
+        for _ in range(warmup):
+            fn()
+        for _ in range(repeats):
+            torch.manual_seed(0)
+            with PeakMemory(device) as memory:
+                start = clock(device)
+                items, unit = fn()
+                seconds.append(clock(device) - start)
+            peaks.append(memory.peak_bytes)
+        profile = None
+        if profile_hooks:
+            torch.manual_seed(0)
+            with nethook.HookProfile() as profile:
+                fn()
+    mean_seconds = float(np.mean(seconds))
+    result = dict(
+        benchmark=name,
+        repeats=repeats,
+        mean_seconds=mean_seconds,
+        min_seconds=float(np.min(seconds)),
+        items=items,
+        unit=unit,
+        throughput=items / mean_seconds,
+        peak_mb=None if None in peaks else max(peaks) / 2 ** 20,
+    )
+    if profile is not None:
+        totals = profile.totals()
+        result.update(
+            hook_calls=totals["calls"],
+            hook_seconds=totals["hook_seconds"],
+            traced_forward_seconds=totals["forward_seconds"],
+            clone_mb=totals["clone_bytes"] / 2 ** 20,
+        )
+        print(f"\nHook profile of {name}:\n{profile.summary()}")
+    return result
+
+
+def make_benchmarks(mt, facts, corpus, hparams, args):
+    """
+    Returns a dict from benchmark name to a function running the workload once.
+    """
+    model, tok = mt.model, mt.tokenizer
+    requests = [fact["requested_rewrite"] for fact in facts]
+    layer = hparams.layers[0]
+    eval_args = Namespace(
+        fact_forcing=args.fact_forcing,
+        fact_erasure=False,
+        weight_based_tracing=False,
+        noise_all_prefix_rows=False,
+        hparams=hparams,
+    )
+    context_templates = ["{}"] + [
+        " ".join(text.split()[:5]) + ". {}" for text in corpus[1::2][:4]
+    ]
+    left_vectors = {}
+
+    def hidden_flow():
+        cells = 0
+        for r in requests:
+            result = calculate_hidden_flow(
+                mt,
+                r["prompt"].format(r["subject"]),
+                r["subject"],
+                r["target_true"]["str"],
+                samples=args.samples,
+                kind=None if args.kind == "None" else args.kind,
+                max_batch_rows=args.max_batch_rows,
+            )
+            cells += result["scores"].numel()
+        return cells, "cells"
+
+    def run_compute_u():
+        for i, r in enumerate(requests):
+            left_vectors[i] = compute_u(
+                eval_args, model, tok, r, hparams, layer, context_templates
+            )
+        return len(requests), "requests"
+
+    def run_compute_v():
+        if len(left_vectors) < len(requests):
+            run_compute_u()
+        for i, r in enumerate(requests):
+            compute_v(eval_args, model, tok, r, hparams, layer, left_vectors[i], context_templates)
+        return len(requests), "requests"
+
+    def run_layer_stats():
+        with tempfile.TemporaryDirectory() as stats_dir:
+            layer_stats(
+                model,
+                tok,
+                hparams.rewrite_module_tmp.format(layer),
+                stats_dir,
+                hparams.mom2_dataset,
+                to_collect=["mom2"],
+                model_name=f"benchmark_{args.arch}",
+                precision=hparams.mom2_dtype,
+                download=False,
+                progress=None,
+                force_recompute=True,
+                text_dataset=[dict(text=text) for text in corpus],
+            )
+        tokens = sum(
+            len(tok.encode(text, truncation=True, max_length=args.n_positions))
+            for text in corpus
+        )
+        return tokens, "tokens"
+
+    def run_generate_fast():
+        prompts = [r["prompt"].format(r["subject"]) for r in requests]
+        generate_fast(
+            model,
+            tok,
+            prompts,
+            n_gen_per_prompt=args.n_gen_per_prompt,
+            max_out_len=args.max_out_len,
+            stop_at_eos=False,
+        )
+        tokens = args.n_gen_per_prompt * sum(
+            max(0, args.max_out_len - len(tok.encode(p))) for p in prompts
+        )
+        return tokens, "tokens"
+
+    def run_test_batch_prediction():
+        groups = [
+            dict(
+                prefixes=[r["prompt"].format(r["subject"])]
+                + fact["paraphrase_prompts"]
+                + fact["neighborhood_prompts"],
+                target_new=r["target_new"]["str"],
+                request_baseline=r["target_true"]["str"],
+                subject=r["subject"],
+            )
+            for fact, r in zip(facts, requests)
+        ]
+        with torch.no_grad():
+            test_batch_prediction_groups(
+                eval_args, model, tok, groups, max_batch_rows=args.max_batch_rows
+            )
+        return sum(len(g["prefixes"]) for g in groups), "prefixes"
+
+    return dict(
+        hidden_flow=hidden_flow,
+        compute_u=run_compute_u,
+        compute_v=run_compute_v,
+        layer_stats=run_layer_stats,
+        generate_fast=run_generate_fast,
+        test_batch_prediction=run_test_batch_prediction,
+    )
+
+
+def format_results(results):
+    lines = [
+        f"{'benchmark':<22} {'seconds':>9} {'throughput':>12} {'unit':<10} {'peak MB':>9}"
+    ]
+    for r in results:
+        peak = "n/a" if r["peak_mb"] is None else f"{r['peak_mb']:.1f}"
+        lines.append(
+            f"{r['benchmark']:<22} {r['mean_seconds']:>9.3f} "
+            f"{r['throughput']:>12.1f} {r['unit'] + '/s':<10} {peak:>9}"
+        )
+    return "\n".join(lines)
+
+
+def main(args):
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    names = args.benchmarks.split()
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if len(unknown) > 0:
+        raise ValueError(f"Unknown benchmarks {unknown}, choose from {BENCHMARKS}")
+
+    facts, corpus = make_facts(args.num_facts, seed=args.seed)
+    tok = make_tokenizer(corpus, args.vocab_size)
+    model = make_model(
+        args.arch,
+        tok,
+        args.n_layer,
+        args.n_embd,
+        args.n_head,
+        args.n_positions,
+        args.device,
+        seed=args.seed,
+    )
+    mt = ModelAndTokenizer(model=model, tokenizer=tok)
+    hparams = make_hparams(args.arch, args.n_layer, args.v_num_grad_steps)
+    print(f"Benchmarking {mt} on {args.device} with {args.num_facts} synthetic facts")
+
+    benchmarks = make_benchmarks(mt, facts, corpus, hparams, args)
+    results = []
+    for name in names:
+        results.append(
+            run_benchmark(
+                name,
+                benchmarks[name],
+                args.device,
+                repeats=args.repeats,
+                warmup=args.warmup,
+                profile_hooks=args.profile_hooks,
+                verbose=args.verbose,
+            )
+        )
+    print()
+    print(format_results(results))
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(dict(args=vars(args), results=results), f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--arch", type=str, default="gpt2", choices=["gpt2", "gptj"])
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--n_layer", type=int, default=4)
+    parser.add_argument("--n_embd", type=int, default=128)
+    parser.add_argument("--n_head", type=int, default=4)
+    parser.add_argument("--n_positions", type=int, default=128)
+    parser.add_argument("--vocab_size", type=int, default=1000)
+    parser.add_argument("--num_facts", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--benchmarks",
+        type=str,
+        default=" ".join(BENCHMARKS),
+        help="Benchmarks to run, separated by spaces.",
+    )
+    parser.add_argument("--repeats", type=int, default=3, help="Timed runs of each benchmark, at least 1.")
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--samples", type=int, default=10, help="Noise samples for causal tracing.")
+    parser.add_argument(
+        "--kind",
+        type=str,
+        default="None",
+        choices=["None", "mlp", "attn"],
+        help="Kind of causal tracing. None restores whole hidden states.",
+    )
+    parser.add_argument("--max_batch_rows", type=int, default=None)
+    parser.add_argument("--v_num_grad_steps", type=int, default=5)
+    parser.add_argument("--n_gen_per_prompt", type=int, default=5)
+    parser.add_argument("--max_out_len", type=int, default=50)
+    parser.add_argument(
+        "--fact_forcing",
+        type=int,
+        default=0,
+        help="Noise subject embeddings in test_batch_prediction, as under fact forcing.",
+    )
+    parser.add_argument(
+        "--profile_hooks",
+        type=int,
+        default=0,
+        help="Make one more run of each benchmark with nethook.HookProfile and print its summary.",
+    )
+    parser.add_argument("--threads", type=int, default=None, help="Number of torch cpu threads.")
+    parser.add_argument("--verbose", type=int, default=0, help="Show the output of the workloads.")
+    parser.add_argument("--output", type=str, default=None, help="Json file to write the results to.")
+    args = parser.parse_args()
+    if args.repeats < 1:
+        parser.error("--repeats must be at least 1")
+    main(args)
@@ -1,4 +1,5 @@
 import argparse
+import itertools
 import json
 import os
 import re
@@ -21,7 +22,8 @@ from rome.tok_dataset import (
 )
 from util.fewshot_utils import score_from_batch, simple_make_inputs
 from util import nethook
-from util.globals import DATA_DIR
+from util.globals import DATA_DIR, STATS_DIR
+from util.noise_bank import seeded_noise
 from util.runningstats import Covariance, tally
 
 def main():
@@ -139,7 +141,6 @@ def corrupted_forward_pass(
     noise=0.1,        # Level of noise to add
     output_hidden_states=False,
     ):
-    prng = np.random.RandomState(1)  # For reproducibility, use pseudorandom noise
     embed_layername = layername(model, 0, 'embed')
     assert batch is None or gen_batch is None
     # define function that noises embeddings at tokens_to_mix indices
@@ -148,8 +149,8 @@ def corrupted_forward_pass(
             # If requested, we corrupt a range of token embeddings on batch items x[1:]
             if tokens_to_mix is not None:
                 b, e = tokens_to_mix
-                embeds_noise = torch.from_numpy(prng.randn(x.shape[0], e - b, x.shape[2])).to(x.device)
-                x[:, b:e] += noise * embeds_noise
+                # For reproducibility, use pseudorandom noise, drawn once per shape and cached on the device
+                x[:, b:e] += seeded_noise((x.shape[0], e - b, x.shape[2]), x.device, scale=noise)
             # print("added noise to embeds: ", embeds_noise)
             return x
         else:
@@ -187,11 +188,8 @@ def trace_with_repatch(
     noise=0.1,  # Level of noise to add
     uniform_noise=False,
 ):
-    rs = np.random.RandomState(1)  # For reproducibility, use pseudorandom noise
-    if uniform_noise:
-        prng = lambda *shape: rs.uniform(-1, 1, shape)
-    else:
-        prng = lambda *shape: rs.randn(*shape)
+    # For reproducibility, use pseudorandom noise: the consecutive draws of a RandomState(1)
+    draws = itertools.count()
     patch_spec = defaultdict(list)
     for t, l in states_to_patch:
         patch_spec[l].append(t)
@@ -210,9 +208,10 @@ def trace_with_repatch(
             # If requested, we corrupt a range of token embeddings on batch items x[1:]
             if tokens_to_mix is not None:
                 b, e = tokens_to_mix
-                x[1:, b:e] += noise * torch.from_numpy(
-                    prng(x.shape[0] - 1, e - b, x.shape[2])
-                ).to(x.device)
+                x[1:, b:e] += seeded_noise(
+                    (x.shape[0] - 1, e - b, x.shape[2]), x.device, scale=noise,
+                    draw=next(draws), uniform=uniform_noise,
+                )
             return x
         if first_pass or (layer not in patch_spec and layer not in unpatch_spec):
             return x
@@ -250,7 +249,6 @@ def trace_with_patch(
     noise=0.1,        # Level of noise to add
     trace_layers=None # List of traced outputs to return
 ):
-    prng = np.random.RandomState(1)  # For reproducibility, use pseudorandom noise
     patch_spec = defaultdict(list)
     for t, l in states_to_patch:
         patch_spec[l].append(t)
@@ -265,9 +263,8 @@ def trace_with_patch(
             # If requested, we corrupt a range of token embeddings on batch items x[1:]
             if tokens_to_mix is not None:
                 b, e = tokens_to_mix
-                x[1:, b:e] += noise * torch.from_numpy(
-                    prng.randn(x.shape[0] - 1, e - b, x.shape[2])
-                ).to(x.device)
+                # For reproducibility, use pseudorandom noise, drawn once per shape and cached on the device
+                x[1:, b:e] += seeded_noise((x.shape[0] - 1, e - b, x.shape[2]), x.device, scale=noise)
             return x
         if layer not in patch_spec:
             return x
@@ -356,9 +353,139 @@ def trace_important_window(
         table.append(torch.stack(row))
     return torch.stack(table)
 
+def collect_clean_states(model, batch, layers):
+    """
+    Runs the uncorrupted prompt once and returns a dict mapping each of the
+    given layernames to its (seq_len, hidden) output for that prompt. These
+    serve as the restore sources for trace_with_patch_batched, in place of
+    the clean row 0 that trace_with_patch carries along in every pass.
+    """
+    def untuple(x):
+        return x[0] if isinstance(x, tuple) else x
+
+    clean_batch = {
+        'input_ids' : batch['input_ids'][:1],
+        'attention_mask' : batch['attention_mask'][:1],
+    }
+    with torch.no_grad(), nethook.TraceDict(model, layers) as td:
+        model(**clean_batch)
+    return {layer: untuple(td[layer].output)[0].detach().clone() for layer in layers}
+
+
+def trace_with_patch_batched(
+    model,            # The model
+    batch,            # A set of inputs, as passed to trace_with_patch (clean row 0 plus noise samples)
+    cells,            # A list of cells, each a list of (token index, layername) pairs to restore
+    clean_states,     # Dict of layername -> (seq_len, hidden) clean outputs, from collect_clean_states
+    pred_id,          # token id of answer probabilities to collect
+    tokens_to_mix,    # Range of tokens to corrupt (begin, end)
+    noise=0.1,        # Level of noise to add
+):
+    """
+    Equivalent to calling trace_with_patch once per cell, but packs all of the
+    cells into the batch dimension of a single forward pass. Each cell gets its
+    own group of noise samples rows, all corrupted with the same seeded noise
+    that trace_with_patch uses, and restored from clean_states instead of
+    from an uncorrupted row in the same batch. Returns one score per cell.
+    """
+    samples = batch['input_ids'].shape[0] - 1
+    num_cells = len(cells)
+    rows = num_cells * samples
+    embed_layername = layername(model, 0, 'embed')
+    device = batch['input_ids'].device
+
+    # Restore targets per layer, as flat (row, token) index tensors.
+    patch_spec = defaultdict(lambda: ([], []))
+    for c, cell in enumerate(cells):
+        for t, l in cell:
+            row_idx, tok_idx = patch_spec[l]
+            row_idx.extend(range(c * samples, (c + 1) * samples))
+            tok_idx.extend([t] * samples)
+    patch_spec = {
+        l: (torch.tensor(r, device=device), torch.tensor(t, device=device))
+        for l, (r, t) in patch_spec.items()
+    }
+
+    def untuple(x):
+        return x[0] if isinstance(x, tuple) else x
+
+    def patch_rep(x, layer):
+        if layer == embed_layername:
+            # Every cell gets the same noise that trace_with_patch would draw for it.
+            if tokens_to_mix is not None:
+                b, e = tokens_to_mix
+                embeds_noise = seeded_noise((samples, e - b, x.shape[2]), x.device, scale=noise)
+                x[:, b:e] += embeds_noise.repeat(num_cells, 1, 1)
+            return x
+        if layer not in patch_spec:
+            return x
+        h = untuple(x)
+        row_idx, tok_idx = patch_spec[layer]
+        h[row_idx, tok_idx] = clean_states[layer][tok_idx].to(h.dtype)
+        return x
+
+    # All rows are the same prompt, so repeat the first row of every input.
+    model_batch = {k: v[:1].repeat(rows, 1) for k, v in batch.items()}
+    with torch.no_grad(), nethook.TraceDict(
+        model,
+        [embed_layername] + list(patch_spec.keys()),
+        edit_output=patch_rep
+    ):
+        if 'target_indicators' not in model_batch:
+          outputs_exp = model(**model_batch)
+          assert pred_id is not None, "no targets provided, need to specify pred_id"
+          probs = torch.softmax(outputs_exp.logits[:, -1, :], dim=1)
+          outputs = probs.reshape(num_cells, samples, -1).mean(dim=1)[:, pred_id]
+        else:
+          probs = score_from_batch(model, model_batch)
+          outputs = probs.reshape(num_cells, samples).mean(dim=1)
+    return outputs
+
+
+def trace_important_batched(
+    model, num_layers, batch, e_range, pred_id=None, kind=None, window=10, noise=0.1, max_batch_rows=128,
+):
+    """
+    Batched counterpart of trace_important_states (kind=None) and
+    trace_important_window. Clean states are captured in one pass and the
+    (token, layer) grid is traced in chunks of cells, with as many cells per
+    forward pass as fit in max_batch_rows rows of noise samples.
+    """
+    if 'target_indicators' in batch:
+      ntoks = batch["input_ids"].shape[1] - batch["target_indicators"].sum(-1)[0]
+    else:
+      ntoks = batch["input_ids"].shape[1]
+    ntoks = int(ntoks)
+    samples = batch['input_ids'].shape[0] - 1
+    start_token_idx = e_range[0]
+    cells = []
+    for tnum in range(start_token_idx, ntoks):
+        for layer in range(0, num_layers):
+            if not kind:
+                cells.append([(tnum, layername(model, layer))])
+            else:
+                cells.append([
+                    (tnum, layername(model, L, kind))
+                    for L in range(
+                        max(0, layer - window // 2), min(num_layers, layer - (-window // 2))
+                    )
+                ])
+    layers = sorted(set(l for cell in cells for _, l in cell))
+    clean_states = collect_clean_states(model, batch, layers)
+    cells_per_pass = max(1, max_batch_rows // samples)
+    scores = []
+    for i in range(0, len(cells), cells_per_pass):
+        print(f"tracing cells {i}-{min(i + cells_per_pass, len(cells))} of {len(cells)} for module type {kind}", end='\r')
+        scores.append(trace_with_patch_batched(
+            model, batch, cells[i:i + cells_per_pass], clean_states, pred_id, tokens_to_mix=e_range, noise=noise,
+        ))
+    return torch.cat(scores).reshape(ntoks - start_token_idx, num_layers)
+
+
 
 def calculate_hidden_flow(
     mt, prompt, subject, target, samples=10, noise=0.1, window=10, output_type='probs', kind=None,
+    max_batch_rows=None,
 ):
     """
     Runs causal tracing over every token/layer combination in the network
@@ -366,6 +493,8 @@ def calculate_hidden_flow(
 
     Args
       target: str output to be explained
+      max_batch_rows: if set, trace many (token, layer) cells per forward pass
+        with trace_important_batched, using at most this many rows per pass
     """
     special_token_ids = [mt.tokenizer.eos_token_id, mt.tokenizer.bos_token_id, mt.tokenizer.pad_token_id]
     assert isinstance(prompt, str)
@@ -377,10 +506,22 @@ def calculate_hidden_flow(
     base_score = scores[0].item()
     pred_id = None 
     batch_size = (samples+1)
-    batch = make_inputs(mt.tokenizer, prompts=[prompt] * batch_size, targets=[answer] * batch_size)
+    batch = make_inputs(mt.tokenizer, prompts=[prompt] * batch_size, targets=[answer] * batch_size, device=mt.model.device)
     e_range = find_token_range(mt.tokenizer, substring=subject, prompt_str=prompt)
     low_score = trace_with_patch(mt.model, batch, [], pred_id, tokens_to_mix=e_range, noise=noise)
-    if not kind:
+    if max_batch_rows:
+        differences = trace_important_batched(
+            mt.model,
+            mt.num_layers,
+            batch,
+            e_range,
+            pred_id,
+            noise=noise,
+            window=window,
+            kind=kind,
+            max_batch_rows=max_batch_rows,
+        )
+    elif not kind:
         differences = trace_important_states(
             mt.model, mt.num_layers, batch, e_range, pred_id, noise=noise,
         )
@@ -439,7 +580,7 @@ def get_high_and_low_scores(
     base_score = scores[0].item()
     pred_id = None 
     batch_size = (samples+1)
-    batch = make_inputs(mt.tokenizer, prompts=[prompt] * batch_size, targets=[answer] * batch_size)
+    batch = make_inputs(mt.tokenizer, prompts=[prompt] * batch_size, targets=[answer] * batch_size, device=mt.model.device)
     e_range = find_token_range(mt.tokenizer, substring=subject, prompt_str=prompt)
     low_score = trace_with_patch(mt.model, batch, [], pred_id, tokens_to_mix=e_range, noise=noise)
     high_score = scores[0]
@@ -455,7 +596,7 @@ def predict_model(mt,
   assert not isinstance(query_inputs, str), "provide queries as list"
   with torch.no_grad():
     generate_and_score = (answers is None)
-    batch = make_inputs(mt.tokenizer, query_inputs, targets=answers)
+    batch = make_inputs(mt.tokenizer, query_inputs, targets=answers, device=mt.model.device)
     if generate_and_score:
       pad_token_id = mt.tokenizer.pad_token_id
       pad_token_id = pad_token_id if pad_token_id else 0
@@ -466,7 +607,7 @@ def predict_model(mt,
       preds = [pred.replace(query_input, "").strip() for pred, query_input in zip(preds, query_inputs)]     
       # for some reason huggingface generate not giving generation probs, so we recalculate
       if score_if_generating: 
-        batch = make_inputs(mt.tokenizer, query_inputs, targets=preds)
+        batch = make_inputs(mt.tokenizer, query_inputs, targets=preds, device=mt.model.device)
         scores = score_from_batch(mt.model, batch)
       else:
         scores = -100 * np.ones(len(preds))
@@ -478,7 +619,7 @@ def predict_model(mt,
         for answer in answers:
           repeated_inputs.append(input)
           repeated_answers.append(answer)
-      batch = make_inputs(mt.tokenizer, repeated_inputs, repeated_answers)
+      batch = make_inputs(mt.tokenizer, repeated_inputs, repeated_answers, device=mt.model.device)
       scores = score_from_batch(mt.model, batch)
       scores = scores.reshape(-1, num_answers)
       pred_ids = [torch.argmax(ex_answer_probs).item() for ex_answer_probs in scores]
@@ -501,6 +642,7 @@ class ModelAndTokenizer:
         low_cpu_mem_usage=False,
         torch_dtype=None,
         cache_dir=None,
+        device="cuda",
     ):
         if tokenizer is None:
             assert model_name is not None
@@ -511,7 +653,7 @@ class ModelAndTokenizer:
                 model_name, low_cpu_mem_usage=low_cpu_mem_usage, torch_dtype=torch_dtype, cache_dir=cache_dir,
             )
             nethook.set_requires_grad(False, model)
-            model.eval().cuda()
+            model.eval().to(device)
         self.tokenizer = tokenizer
         self.model = model
         self.layer_names = [
@@ -736,7 +878,7 @@ def find_token_range(tokenizer, token_array=None, substring=None, prompt_str=Non
     return (tok_start, tok_end)
 
 def predict_token(mt, prompts, return_p=False):
-    inp = simple_make_inputs(mt.tokenizer, prompts)
+    inp = simple_make_inputs(mt.tokenizer, prompts, device=mt.model.device)
     preds, p = predict_from_input(mt.model, inp)
     result = [mt.tokenizer.decode(c) for c in preds]
     if return_p:
@@ -749,19 +891,28 @@ def predict_from_input(model, inp):
     p, preds = torch.max(probs, dim=1)
     return preds, p
 
-def collect_embedding_std(mt, subjects):
+def collect_embedding_std(mt, subjects, batch_tokens=65536):
+    # The embedding layer looks up each token on its own, so embedding the tokens
+    # of all subjects as one flat sequence gives the same values, in the same order,
+    # as running the model on each subject in turn.
+    embed = nethook.get_module(mt.model, layername(mt.model, 0, "embed"))
+    device = next(mt.model.parameters()).device
+    token_ids = [t for s in subjects for t in mt.tokenizer.encode(s)]
     alldata = []
-    for s in subjects:
-        inp = make_inputs(mt.tokenizer, [s])
-        with nethook.Trace(mt.model, layername(mt.model, 0, "embed")) as t:
-            mt.model(**inp)
-            alldata.append(t.output[0])
+    with torch.no_grad():
+        for i in range(0, len(token_ids), batch_tokens):
+            alldata.append(embed(torch.tensor(token_ids[i : i + batch_tokens], device=device)))
     alldata = torch.cat(alldata)
     noise_level = alldata.std().item()
     return noise_level
 
 
-def get_embedding_cov(mt):
+def embedding_noise_filename(mt, name):
+    model_name = mt.model.config._name_or_path.replace("/", "_")
+    return os.path.join(STATS_DIR, model_name, f"wikitext_embed_{name}.npz")
+
+
+def get_embedding_cov(mt, cache=True):
     model = mt.model
     tokenizer = mt.tokenizer
 
@@ -777,18 +928,18 @@ def get_embedding_cov(mt):
             maxlen = 100  # Hack due to missing setting in GPT2-NeoX.
         return TokenizedDataset(raw_ds["train"], tokenizer, maxlen=maxlen)
 
-    ds = get_ds()
     sample_size = 1000
     batch_size = 5
-    filename = None
+    filename = embedding_noise_filename(mt, f"cov_{sample_size}") if cache else None
     batch_tokens = 100
 
     progress = lambda x, **k: x
 
     stat = Covariance()
+    # tally only calls get_ds, which downloads and tokenizes Wikitext, when the cache file is missing
     loader = tally(
         stat,
-        ds,
+        get_ds,
         cache=filename,
         sample_size=sample_size,
         batch_size=batch_size,
@@ -800,7 +951,7 @@ def get_embedding_cov(mt):
     with torch.no_grad():
         for batch_group in loader:
             for batch in batch_group:
-                batch = dict_to_(batch, "cuda")
+                batch = dict_to_(batch, model.device)
                 del batch["position_ids"]
                 with nethook.Trace(model, layername(mt.model, 0, "embed")) as tr:
                     model(**batch)
@@ -825,12 +976,24 @@ def make_generator_transform(mean=None, cov=None):
     return layer
 
 
-def collect_embedding_gaussian(mt):
-    m, c = get_embedding_cov(mt)
-    return make_generator_transform(m, c)
+def collect_embedding_gaussian(mt, cache=True):
+    # The generator's parameters are saved after the first run, so that later
+    # runs skip both the Wikitext covariance and its svd.
+    filename = embedding_noise_filename(mt, "gaussian_generator") if cache else None
+    if filename is not None and os.path.exists(filename):
+        params = np.load(filename)
+        layer = make_generator_transform(mean=torch.from_numpy(params["bias"]))
+        layer.weight[...] = torch.from_numpy(params["weight"])
+        return layer
+    m, c = get_embedding_cov(mt, cache=cache)
+    layer = make_generator_transform(m, c)
+    if filename is not None:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        np.savez(filename, bias=layer.bias.cpu().numpy(), weight=layer.weight.cpu().numpy())
+    return layer
 
 
-def collect_embedding_tdist(mt, degree=3):
+def collect_embedding_tdist(mt, degree=3, cache=True):
     # We will sample sqrt(degree / u) * sample, where u is from the chi2[degree] dist.
     # And this will give us variance is (degree / degree - 2) * cov.
     # Therefore if we want to match the sample variance, we should
@@ -840,7 +1003,7 @@ def collect_embedding_tdist(mt, degree=3):
         np.random.RandomState(2).chisquare(df=degree, size=1000)
     )
     fixed_sample = ((degree - 2) / u_sample).sqrt()
-    mvg = collect_embedding_gaussian(mt)
+    mvg = collect_embedding_gaussian(mt, cache=cache)
 
     def normal_to_student(x):
         gauss = mvg(x)
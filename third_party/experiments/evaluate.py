@@ -2,6 +2,7 @@ import argparse
 import json
 import os
 import shutil
+import sys
 import collections
 import time
 from google.cloud import storage
@@ -26,12 +27,15 @@ from dsets import (
 )
 from experiments.causal_trace import ModelAndTokenizer, predict_token
 from experiments.causal_trace import layername, corrupted_forward_pass, find_token_range, make_inputs, simple_make_inputs
-from experiments.py.eval_utils_counterfact import compute_rewrite_quality_counterfact
+from experiments.py.eval_utils_counterfact import compute_rewrite_quality_counterfact, compute_rewrite_quality_counterfact_virtual
 from experiments.py.eval_utils_zsre import compute_rewrite_quality_zsre
-from rome import ROMEHyperParams, apply_rome_to_model
+from rome import ROMEHyperParams, VirtualEdits, apply_rome_to_model, execute_rome
 from memit import MEMITHyperParams, apply_memit_to_model
 from util import nethook
 from util.fewshot_utils import predict_model, fewshot_accuracy_sum, score_from_batch
+from util.eval_cache import EvalCache
+from util.results_store import ResultsStore
+from util.work_queue import LEASE_SECONDS, WorkQueue, set_record_seed
 from util.generate import generate_fast
 from util.globals import *
 
@@ -171,6 +175,8 @@ def ROME_experiment_name(args, model_name, alg_name, ds_name, hparams_to_add):
     hparams_to_add['ampfy'] = 'T'
   if args.weight_based_tracing:
     hparams_to_add['weight-based'] = 'T'
+  if args.noise_all_prefix_rows and (args.fact_forcing or args.weight_based_tracing):
+    hparams_to_add['noise-all-rows'] = 'T'
   for k,v in hparams_to_add.items():
     _v = str(v).replace(", ", "-")
     if _v == "-1":
@@ -195,7 +201,13 @@ def ROME_experiment_name_from_override_params(args, model_name, alg_name, ds_nam
                                   important_hparams)
   return exp_name
 
-def make_editing_results_df(exp_name, n=1000):
+def make_editing_results_df(exp_name, n=1000, results_store=None):
+  if results_store is not None:
+    # derived rows are only computed for cases appended since the last call
+    return_df = results_store.derived(exp_name, 'editing_results', editing_results_rows, unique_on='case_id')
+    if len(return_df) > 0:
+      return_df = return_df[return_df['case_id'] < n]
+    return return_df
   run_dir = os.path.join(f'{BASE_DIR}/results/', exp_name)
   dataframes = []
   printed = 0
@@ -208,6 +220,23 @@ def make_editing_results_df(exp_name, n=1000):
       continue
     with open(case_result_path, 'r') as f:
       record = json.load(f)
+    df = editing_record_to_df(record)
+    if df is not None:
+      dataframes.append(df)
+  if len(dataframes) > 0:
+    return_df = pd.concat(dataframes)
+  else:
+    return_df = pd.DataFrame()
+  return return_df
+
+def editing_results_rows(case_rows):
+    # summarizes the metrics of results store rows, one row per case
+    dataframes = [editing_record_to_df(json.loads(metrics)) for metrics in case_rows['metrics']]
+    dataframes = [df for df in dataframes if df is not None]
+    return pd.concat(dataframes) if len(dataframes) > 0 else None
+
+def editing_record_to_df(record):
+    # summarizes the metrics of one case_{id}.json record as a single row df, or None if it is incomplete
     rewrite_data = record['requested_rewrite']
     prompt = rewrite_data['prompt'].format(rewrite_data['subject'])
     target = rewrite_data['target_true']['str']
@@ -221,8 +250,8 @@ def make_editing_results_df(exp_name, n=1000):
             'request_baseline': [rewrite_data['request_baseline']]
         }
     except:
-        print("skipping ", case_result_path, " missing basic info")
-        continue
+        print("skipping case ", record.get('case_id'), " missing basic info")
+        return None
     cur_sum = collections.defaultdict(lambda: [])
     data = record
     # record difference in pre and post probs for target_new
@@ -328,14 +357,78 @@ def make_editing_results_df(exp_name, n=1000):
                       )
     # add ROME metrics to record_dict and append to dataframes
     record_dict.update(cur_sum)
-    df = pd.DataFrame(record_dict)
-    dataframes.append(df)
-  if len(dataframes) > 0:
-    return_df = pd.concat(dataframes)
-  else:
-    return_df = pd.DataFrame()
-  return return_df
+    return pd.DataFrame(record_dict)
+
+def read_through(eval_cache, fn, **key):
+    # returns fn(), through eval_cache under key if a cache is in use. fn runs on a copy of the torch
+    # random state, so that the sampling that follows is the same whether the value was computed or read
+    def forked_fn():
+        with torch.random.fork_rng(devices=[torch.cuda.current_device()] if torch.cuda.is_available() else []):
+            return fn()
+    if eval_cache is None:
+        return forked_fn()
+    return eval_cache.get_or_compute(key, forked_fn)
+
+def pre_eval_cache_key(args, model_name, ds_name, record, snips, vec, skip_generation_tests, virtual=False):
+    # the unedited model's metrics depend on the full record (including the request_baseline and target_new
+    # set per objective), the essence texts it is scored on, and the flags that change how it is scored.
+    # the batched virtual-edit path pads and batches differently, so its results are kept apart
+    subject = record['requested_rewrite']['subject']
+    return dict(
+        kind='pre',
+        eval_path='virtual' if virtual else 'standard',
+        model=model_name,
+        ds_name=ds_name,
+        case_id=record.get('case_id'),
+        record=record,
+        essence_texts=snips.names_to_samples.get(subject) if snips is not None else None,
+        skip_generation_tests=skip_generation_tests,
+        # generation tests sample from the record's seeded random state
+        seed=args.seed if not skip_generation_tests else None,
+        use_tfidf=vec is not None,
+        fact_forcing=args.fact_forcing,
+        weight_based_tracing=args.weight_based_tracing,
+        editing_noise=args.hparams.editing_noise if (args.fact_forcing or args.weight_based_tracing) else None,
+        noise_all_prefix_rows=args.noise_all_prefix_rows if (args.fact_forcing or args.weight_based_tracing) else None,
+    )
 
+def save_case_result(metrics, case_result_path, results_store=None, exp_name=None):
+    # appends the case to the results store if one is in use, else dumps it to its own .json file
+    if results_store is not None:
+        results_store.append(exp_name, [dict(case_id=metrics["case_id"], metrics=json.dumps(metrics))])
+        return
+    with open(case_result_path, "w") as f:
+        json.dump(metrics, f, indent=1)
+
+def evaluate_virtual_edits(args, model, tok, pending, snips, vec, skip_generation_tests, eval_cache, model_name, ds_name, results_store=None, exp_name=None):
+    # evaluates a batch of ROME edits held as virtual edits, post and pre in shared forward passes, then writes
+    # each case's results. pending holds (record, case_result_path, deltas, exec_time, prior_prob) per edit
+    start = time.time()
+    records = [record for record, _, _, _, _ in pending]
+    pre_keys = [pre_eval_cache_key(args, model_name, ds_name, record, snips, vec, skip_generation_tests, virtual=True) for record in records]
+    pres = [eval_cache.get(key) if eval_cache is not None else None for key in pre_keys]
+    jobs = [(record, k) for k, record in enumerate(records)]
+    jobs += [(record, None) for record, pre in zip(records, pres) if pre is None]
+    with torch.no_grad(), VirtualEdits(model, [deltas for _, _, deltas, _, _ in pending]) as virtual_edits:
+        job_metrics = compute_rewrite_quality_counterfact_virtual(
+            args, model, tok, jobs, virtual_edits, snips, vec, skip_generation_tests
+        )
+    computed_pres = iter(job_metrics[len(records):])
+    for k, (record, case_result_path, _, exec_time, prior_prob) in enumerate(pending):
+        if pres[k] is None:
+            pres[k] = next(computed_pres)
+            if eval_cache is not None:
+                pres[k] = eval_cache.put(pre_keys[k], pres[k])
+        metrics = {
+            "case_id": record["case_id"],
+            "requested_rewrite": record["requested_rewrite"],
+            "time": exec_time,
+            "post": job_metrics[k],
+            "pre": pres[k],
+            "prior_prob": prior_prob,
+        }
+        save_case_result(metrics, case_result_path, results_store, exp_name)
+    print(f"Evaluation of {len(pending)} virtual edits took", time.time() - start)
 
 def get_subject_noising_function(model, e_range, hparams, embed_layername):
     # define noise embeddings function
@@ -372,7 +465,29 @@ def main(
     overwrite=False,
     correctness_check=False,
     target_prob_check=0,
+    eval_cache=None,
+    results_store=None,
+    worker_id=None,
+    queue_dir=None,
 ):
+    """
+    Edits and evaluates each record of the dataset, writing one case_{id}.json
+    per record. If eval_cache is given, results that depend only on the
+    unedited model (pre-edit metrics, essence texts, correctness and target
+    prob checks) are read through it instead of being recomputed. If
+    results_store is given, cases are appended to it under the experiment
+    name instead of being written to case_{id}.json files. With
+    args.virtual_edits, ROME edits are never written into the weights; up to
+    args.virtual_edit_batch_size of them are evaluated together as virtual edits.
+    If worker_id is given, the records are shared with other workers through
+    a WorkQueue in queue_dir (the run directory by default), and this
+    worker only processes the records it leases. Each record is seeded from
+    args.seed and its case_id, so serial and worker runs give the same results.
+    """
+    if args.virtual_edits:
+        assert alg_name == "ROME" and ds_name == "cf", "virtual edits are only supported for ROME on CounterFact"
+        # buffered virtual edits would be lost if a worker crashed after completing their queue items
+        assert worker_id is None, "virtual edits are not supported with queue workers"
     # Set algorithm-specific variables
     params_class, apply_algo = ALG_DICT[alg_name]
 
@@ -421,17 +536,30 @@ def main(
     ds_class, ds_eval_method = DS_DICT[ds_name]
     ds = ds_class(DATA_DIR, size=dataset_size_limit, tok=tok)
     # Iterate through dataset
-    for record in ds:
+    pending_virtual_edits = []
+    # kept up to date by the store as cases are appended
+    done_ids = results_store.done_ids(exp_name) if results_store is not None else None
+    def run_record(record):
+        nonlocal pending_virtual_edits, done_ids
         case_id = record["case_id"] if 'case_id' in record else 'known_id'
         case_result_path = os.path.join(run_dir, f"case_{case_id}.json")
-        rewrite_this_point = overwrite or not os.path.exists(case_result_path)
+        if results_store is not None:
+            if worker_id is not None:
+                # pick up cases written by other workers
+                done_ids = results_store.done_ids(exp_name)
+            rewrite_this_point = overwrite or case_id not in done_ids
+        else:
+            rewrite_this_point = overwrite or not os.path.exists(case_result_path)
          # skip some weird memory issues
         if case_id == 1531:
-            continue
+            return
         if case_id == 1517 and ((args.alg_name == "ROME" and args.tracing_reversal) or len(hparams.layers) > 1):
-            continue
+            return
         if rewrite_this_point:
             print("Starting point: ", case_id)
+            # seed per record, so that results do not depend on which records were run before it,
+            # or on which worker ran it
+            set_record_seed(args.seed, case_id)
             # print info for this point
             request = record["requested_rewrite"]
             subject = record["requested_rewrite"]['subject']
@@ -451,35 +579,47 @@ def main(
             if correctness_check or target_prob_check > 0:
                 is_correct, meets_target_prob = True, True
                 if correctness_check:
-                    gen_batch = simple_make_inputs(tok, prompts=[prompt])
-                    samples, scores, _ = predict_model(mt, 
-                                            [prompt], 
-                                            answers=None, 
-                                            trigger_phrase=None, 
-                                            max_decode_steps=36)
-                    is_correct = fewshot_accuracy_sum(samples, [target_true])
+                    def get_is_correct():
+                        samples, scores, _ = predict_model(mt, 
+                                                [prompt], 
+                                                answers=None, 
+                                                trigger_phrase=None, 
+                                                max_decode_steps=36)
+                        return fewshot_accuracy_sum(samples, [target_true])
+                    is_correct = read_through(eval_cache, get_is_correct,
+                        kind='correctness', model=model_name, prompt=prompt, target=target_true, max_decode_steps=36)
                 if target_prob_check > 0:
-                    preds, scores, _ = predict_model(mt, [prompt], answers=[target_true])
-                    meets_target_prob = scores[0].item() > target_prob_check
+                    def get_target_prob():
+                        preds, scores, _ = predict_model(mt, [prompt], answers=[target_true])
+                        return dict(pred=preds[0], prob=scores[0].item())
+                    target_prob = read_through(eval_cache, get_target_prob,
+                        kind='target_prob', model=model_name, prompt=prompt, target=target_true)
+                    meets_target_prob = target_prob['prob'] > target_prob_check
                 if not (is_correct and meets_target_prob):
                     if verbose:
                         print(" Skipping this point due to it being incorrect or not meeting the minimum target prob.")
                         if target_prob_check > 0: 
-                            print(f" Target prob: {scores[0].item():.4f}")
-                            print(f" Pred: {preds}")
-                    continue
+                            print(f" Target prob: {target_prob['prob']:.4f}")
+                            print(f" Pred: {[target_prob['pred']]}")
+                    return
 
             # generate essence_texts for evaluation if needed
             if do_essence_tests or not skip_generation_tests:
                 essence_prompt = "{} is a".format(subject)
                 if verbose:
                     print("GENERATING ESSENCE TEXTS")
-                essence_texts = generate_fast(
-                    model,
-                    tok,
-                    [essence_prompt],
-                    n_gen_per_prompt=5,
-                    max_out_len=100,
+                essence_texts = read_through(
+                    eval_cache,
+                    lambda: generate_fast(
+                        model,
+                        tok,
+                        [essence_prompt],
+                        n_gen_per_prompt=5,
+                        max_out_len=100,
+                    ),
+                    # the texts are sampled from the record's seeded random state
+                    kind='essence_texts', model=model_name, prompt=essence_prompt, n_gen_per_prompt=5, max_out_len=100, stop_at_eos=False,
+                    seed=args.seed, case_id=case_id,
                 )
                 snips.names_to_samples[subject] = essence_texts
                 if verbose:
@@ -495,7 +635,7 @@ def main(
             embed_layername = layername(model, 0, 'embed')
             noise_embeddings_f = get_subject_noising_function(model, e_range, hparams, embed_layername)
             if args.tracing_reversal:
-                gen_batch = simple_make_inputs(tok, prompts=[prompt] * (num_noise_samples))
+                gen_batch = simple_make_inputs(tok, prompts=[prompt] * (num_noise_samples), device=model.device)
                 with torch.no_grad(), nethook.TraceDict(model, [embed_layername], edit_output=noise_embeddings_f) as td:
                     essence_texts = generate_fast(
                         model,
@@ -509,19 +649,19 @@ def main(
                 request['target_new']['str'] = new_target
                 request['target_new']['id'] = 'noised-input'
                 if verbose:
-                    score_batch = make_inputs(tok, [prompt], targets=[new_target])
+                    score_batch = make_inputs(tok, [prompt], targets=[new_target], device=model.device)
                     init_target_prob = score_from_batch(model, score_batch)
                     print(f" NEW TARGET PREDICTION: {new_target}")
                     print(f" with init pred prob: {init_target_prob.item():.4f}")
             elif args.fact_erasure:
-                batch = make_inputs(mt.tokenizer, prompts=[prompt] * num_noise_samples, targets=[target_true] * num_noise_samples)
+                batch = make_inputs(mt.tokenizer, prompts=[prompt] * num_noise_samples, targets=[target_true] * num_noise_samples, device=model.device)
                 request['request_baseline'] = mt.tokenizer.eos_token # arbitrary token, won't use these metrics anyway
                 request['target_new'] = request['target_true']
             elif args.fact_amplification:
                 request['request_baseline'] = mt.tokenizer.eos_token # arbitrary token, won't use these metrics anyway
                 request['target_new'] = request['target_true']
             elif args.fact_forcing or args.weight_based_tracing:
-                gen_batch = simple_make_inputs(tok, prompts=[prompt] * (num_noise_samples))
+                gen_batch = simple_make_inputs(tok, prompts=[prompt] * (num_noise_samples), device=model.device)
                 _, noised_pred_id = corrupted_forward_pass(mt.model, None, gen_batch, tokens_to_mix=e_range, noise=hparams.editing_noise)
                 noised_pred_token = tok.decode([noised_pred_id])
                 request['request_baseline'] = noised_pred_token
@@ -537,12 +677,12 @@ def main(
                 last_subj_idx = e_range[1]
                 with torch.enable_grad():
                     # corrupted forward pass. corrupted_hidden_states will be of shape [n_layers, num_noise_samples, seq_len, hidden_dim]
-                    gen_batch = simple_make_inputs(tok, prompts=[prompt] * num_noise_samples)
+                    gen_batch = simple_make_inputs(tok, prompts=[prompt] * num_noise_samples, device=model.device)
                     gen_batch['output_hidden_states'] = True
                     _, _, corrupted_hidden_states = corrupted_forward_pass(model, None, gen_batch, tokens_to_mix=e_range, noise=hparams.editing_noise, output_hidden_states=True)
                     corrupted_hidden_states = torch.stack([corrupted_hidden_states[layer+1] for layer in hparams.layers], dim=0)
                     # clean forward pass
-                    gen_batch = simple_make_inputs(tok, prompts=[prompt])
+                    gen_batch = simple_make_inputs(tok, prompts=[prompt], device=model.device)
                     clean_hidden_states = model(**gen_batch, output_hidden_states=True).hidden_states
                     clean_hidden_states = torch.stack([clean_hidden_states[layer+1] for layer in hparams.layers], dim=0)
                 # splice uncorrupted hidden_states into corrupted_hidden_states where they are restored. automatically broadcast across num_noise_samples dimension
@@ -559,22 +699,33 @@ def main(
                 else dict()
             )
             with torch.enable_grad(), nethook.TraceDict(model, [embed_layername], edit_output=noise_embeddings_f) if args.fact_forcing else nullcontext() as td:
-              edited_model, weights_copy = apply_algo(
-                  args,
-                  model,
-                  tok,
-                  [request],
-                  hparams,
-                  copy=False,
-                  return_orig_weights=True,
-                  num_noise_samples=num_noise_samples,
-                  prior_prob=prior_prob,
-                  hidden_state_supervision=hidden_state_supervision,
-                  **args_conserve_memory,
-              )
+              if args.virtual_edits:
+                deltas = execute_rome(args, model, tok, request, hparams)
+              else:
+                edited_model, weights_copy = apply_algo(
+                    args,
+                    model,
+                    tok,
+                    [request],
+                    hparams,
+                    copy=False,
+                    return_orig_weights=True,
+                    num_noise_samples=num_noise_samples,
+                    prior_prob=prior_prob,
+                    hidden_state_supervision=hidden_state_supervision,
+                    **args_conserve_memory,
+                )
             exec_time = time.time() - start
             print("Execution took", exec_time)
 
+            if args.virtual_edits:
+                pending_virtual_edits.append((record, case_result_path, deltas, exec_time, prior_prob))
+                if len(pending_virtual_edits) >= args.virtual_edit_batch_size:
+                    evaluate_virtual_edits(args, model, tok, pending_virtual_edits, snips, vec, skip_generation_tests, eval_cache, model_name, ds_name, results_store, exp_name)
+                    pending_virtual_edits = []
+                print('\n')
+                return
+
             # Execute evaluation suite
             start = time.time()
             with torch.no_grad(): 
@@ -585,20 +736,42 @@ def main(
                     "post": ds_eval_method(args, edited_model, tok, record, snips, vec, skip_generation_tests),
                 }
                 for k, v in weights_copy.items():
-                    nethook.get_parameter(model, k)[...] = v.to("cuda")
-                metrics["pre"] = ds_eval_method(args, model, tok, record, snips, vec, skip_generation_tests)
+                    w = nethook.get_parameter(model, k)
+                    w[...] = v.to(w.device)
+                metrics["pre"] = read_through(
+                    eval_cache,
+                    lambda: ds_eval_method(args, model, tok, record, snips, vec, skip_generation_tests),
+                    **pre_eval_cache_key(args, model_name, ds_name, record, snips, vec, skip_generation_tests),
+                )
                 metrics['prior_prob'] = prior_prob
 
             print("Evaluation took", time.time() - start)
-            # Dump metrics in .json
-            with open(case_result_path, "w") as f:
-                json.dump(metrics, f, indent=1)
+            # Dump metrics in .json, or append them to the results store
+            save_case_result(metrics, case_result_path, results_store, exp_name)
             print('\n')
         else:
             if verbose:
               print(f"skipping {case_result_path}, already run")
             else:
               pass
+    if worker_id is not None:
+        work_queue = WorkQueue(os.path.join(queue_dir or run_dir, f"work_queue_{exp_name}.sqlite"), lease_seconds=args.lease_seconds)
+        records_by_id = {str(record["case_id"]): record for record in ds}
+        def log_lease(case_id, counts):
+            print(f"Worker {worker_id} leased case {case_id}. Queue: {counts}")
+        def run_leased_record(case_id):
+            run_record(records_by_id[case_id])
+            # the case is written before its queue item is completed
+            if results_store is not None:
+                results_store.flush(exp_name)
+        work_queue.process_leased(worker_id, list(records_by_id), run_leased_record, on_lease=log_lease)
+    else:
+        for record in ds:
+            run_record(record)
+    if len(pending_virtual_edits) > 0:
+        evaluate_virtual_edits(args, model, tok, pending_virtual_edits, snips, vec, skip_generation_tests, eval_cache, model_name, ds_name, results_store, exp_name)
+    if results_store is not None:
+        results_store.flush(exp_name)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -723,6 +896,13 @@ if __name__ == "__main__":
         action="store_true",
         help="See paper for description",
     )
+    parser.add_argument(
+        "--noise_all_prefix_rows",
+        action="store_true",
+        help="With --fact_forcing or --weight_based_tracing, noise the subject in both the target_new and the "
+        "request_baseline row of every evaluated prompt. By default only the first rows of each batch are noised, "
+        "as in the original code; this changes the pre and post metrics",
+    )
     parser.add_argument(
         "--correctness_filter",
         type=int,
@@ -737,6 +917,74 @@ if __name__ == "__main__":
         help="Reduce memory usage during evaluation at the cost of a minor slowdown. "
         "Backs up model weights on CPU instead of GPU.",
     )
+    parser.add_argument(
+        "--eval_cache",
+        type=int,
+        default=0,
+        choices=[0,1],
+        help="Reuse unedited-model results (pre metrics, essence texts, correctness checks) across runs",
+    )
+    parser.add_argument(
+        "--eval_cache_dir",
+        type=str,
+        default=None,
+        help="Directory for the unedited-model results cache. Defaults to results/eval_cache under BASE_DIR",
+    )
+    parser.add_argument(
+        "--eval_cache_max_gb",
+        type=float,
+        default=5,
+        help="Evict least recently used cache entries beyond this size",
+    )
+    parser.add_argument(
+        "--clear_eval_cache",
+        action="store_true",
+        help="Empty the unedited-model results cache before running",
+    )
+    parser.add_argument(
+        "--results_store",
+        type=int,
+        default=0,
+        choices=[0,1],
+        help="Append case results to the Parquet results store under results/store instead of writing case_{id}.json files",
+    )
+    parser.add_argument(
+        "--results_store_buffer",
+        type=int,
+        default=20,
+        help="Number of cases to buffer in memory before appending them to the results store",
+    )
+    parser.add_argument(
+        "--worker_id",
+        type=int,
+        default=None,
+        help="Run as one of several workers sharing each experiment's records through a work queue. "
+        "Usually set by experiments.run_workers",
+    )
+    parser.add_argument(
+        "--queue_dir",
+        type=str,
+        default=None,
+        help="Local directory for the work queue databases. Defaults to each experiment's results directory",
+    )
+    parser.add_argument(
+        "--lease_seconds",
+        type=float,
+        default=LEASE_SECONDS,
+        help="Seconds after which a queue item leased by a worker that stopped sending heartbeats is reclaimed",
+    )
+    parser.add_argument(
+        "--virtual_edits",
+        action="store_true",
+        help="ROME only. Apply edits through forward hooks instead of the weights, and evaluate several of them "
+        "in the same batched forward passes",
+    )
+    parser.add_argument(
+        "--virtual_edit_batch_size",
+        type=int,
+        default=8,
+        help="Number of virtual edits to evaluate together",
+    )
     parser.add_argument(
         "--run",
         type=int,
@@ -747,6 +995,7 @@ if __name__ == "__main__":
         "--gpu",
         type=str,
         default="0",
+        help="GPU id, or cpu",
     )
     parser.add_argument(
         "--seed",
@@ -757,9 +1006,10 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     # set device
-    device = torch.device(f"cuda:{args.gpu}")
+    device = torch.device("cpu") if args.gpu == "cpu" else torch.device(f"cuda:{args.gpu}")
     np.random.seed(args.seed)
-    torch.cuda.set_device(device)
+    if device.type == "cuda":
+        torch.cuda.set_device(device)
     torch.random.manual_seed(args.seed)
     torch.cuda.manual_seed_all(args.seed)
 
@@ -777,9 +1027,9 @@ if __name__ == "__main__":
         mem_usage = True
         print("Loading model...")
         if '20b' not in model_name:
-            mt = ModelAndTokenizer(model_name, low_cpu_mem_usage=mem_usage, torch_dtype=torch_dtype, cache_dir=MODEL_DIR)
+            mt = ModelAndTokenizer(model_name, low_cpu_mem_usage=mem_usage, torch_dtype=torch_dtype, cache_dir=MODEL_DIR, device=device)
             torch.cuda.empty_cache()
-            mt.model.eval().cuda()
+            mt.model.eval().to(device)
             mt.tokenizer.add_special_tokens({'pad_token' : mt.tokenizer.eos_token})
         else:
             raise RuntimeError("20b model does not load properly across devices")
@@ -818,6 +1068,17 @@ if __name__ == "__main__":
         central_layers = [-1] + central_layers
     if args.edit_layer > -2:
         central_layers = [args.edit_layer]
+    eval_cache = None
+    if args.eval_cache:
+        eval_cache_dir = args.eval_cache_dir or f'{BASE_DIR}/results/eval_cache'
+        eval_cache = EvalCache(eval_cache_dir, max_bytes=int(args.eval_cache_max_gb * 2**30))
+        if args.clear_eval_cache:
+            eval_cache.clear()
+        print(f"Using eval cache: {eval_cache}")
+    results_store = None
+    if args.results_store:
+        # workers also flush each case when it is done
+        results_store = ResultsStore(f'{BASE_DIR}/results/store', buffer_rows=args.results_store_buffer)
     print("Starting sweep with hparams:")
     print("- window_sizes: ", window_sizes)
     print("- central_layers: ", central_layers)
@@ -842,16 +1103,29 @@ if __name__ == "__main__":
                     verbose=args.verbose,
                     overwrite=args.overwrite,
                     correctness_check=args.correctness_filter,
-                    target_prob_check=.02 if args.correctness_filter and args.fact_erasure else 0
+                    target_prob_check=.02 if args.correctness_filter and args.fact_erasure else 0,
+                    eval_cache=eval_cache,
+                    results_store=results_store,
+                    worker_id=args.worker_id,
+                    queue_dir=args.queue_dir,
                 )
+            if args.worker_id is not None:
+                continue
             # accumulate results
             exp_name = ROME_experiment_name_from_override_params(args, model_name, alg_name, ds_name, override_hparams, hparams_class)
-            editing_results_df = make_editing_results_df(exp_name, n=num_points)
+            editing_results_df = make_editing_results_df(exp_name, n=num_points, results_store=results_store)
+            if results_store is not None:
+                # after the editing results are updated, so that they are compacted rather than rebuilt
+                results_store.compact(exp_name)
             editing_results_df['edit_method'] = alg_name
             editing_results_df['edit_central_layer'] = central_layer
             editing_results_df['edit_window_size'] = window_size
             results_dfs.append(editing_results_df)
     
+    if args.worker_id is not None:
+        # results are collected by experiments.run_workers once every worker is done
+        sys.exit(0)
+
     # combine and save results
     results_df = pd.concat(results_dfs)
     _model_name = model_name.split('/')[-1]
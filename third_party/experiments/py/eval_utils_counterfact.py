@@ -21,7 +21,8 @@ from experiments.causal_trace import layername, corrupted_forward_pass, find_tok
 from util import nethook
 from util.fewshot_utils import make_inputs, score_from_batch
 from util.generate import generate_fast
-from util.perplexity import perplexity
+from util.noise_bank import seeded_noise
+from util.perplexity import batch_perplexity, perplexity
 
 def compute_rewrite_quality_counterfact(
     args,
@@ -108,6 +109,131 @@ def compute_rewrite_quality_counterfact(
 
     return ret
 
+def compute_rewrite_quality_counterfact_virtual(
+    args,
+    model: AutoModelForCausalLM,
+    tok: AutoTokenizer,
+    jobs: typing.List[typing.Tuple[typing.Dict, typing.Optional[int]]],
+    virtual_edits,
+    snips: AttributeSnippets,
+    vec: TfidfVectorizer,
+    skip_generation_tests: bool,
+    max_batch_rows: int = 256,
+) -> typing.List[typing.Dict]:
+    """
+    Computes the metrics of compute_rewrite_quality_counterfact for several
+    (record, edit_id) jobs at once, where edit_id selects an edit held in
+    virtual_edits (rome.VirtualEdits) and None means the unedited model. The
+    probability tests and essence perplexities of all jobs share batched
+    forward passes of at most max_batch_rows rows.
+
+    :return: List with one dictionary of rewriting metrics per job
+    """
+
+    groups = []
+    for record, edit_id in jobs:
+        subject, target_new, request_baseline = (
+            record["requested_rewrite"][x] for x in ["subject", "target_new", "request_baseline"]
+        )
+        rewrite_prompts = [record["requested_rewrite"]["prompt"].format(subject)]
+        prob_prompts = [
+            rewrite_prompts,
+            record["paraphrase_prompts"],
+            record["neighborhood_prompts"],
+            record["attribute_prompts"],
+        ]
+        groups.append(
+            dict(
+                prefixes=list(chain(*prob_prompts)),
+                target_new=target_new["str"],
+                request_baseline=request_baseline,
+                subject=subject,
+                edit_id=edit_id,
+                cutoffs=[0] + np.cumsum(list(map(len, prob_prompts))).tolist(),
+            )
+        )
+    all_probs = test_batch_prediction_groups(
+        args, model, tok, groups, virtual_edits=virtual_edits, max_batch_rows=max_batch_rows
+    )
+
+    rets = []
+    for group, probs in zip(groups, all_probs):
+        cutoffs = group["cutoffs"]
+        ret_probs = [probs[cutoffs[i - 1] : cutoffs[i]] for i in range(1, len(cutoffs))]
+        rets.append({
+            f"{key}_probs": ret_probs[i]
+            for i, key in enumerate(
+                [
+                    "rewrite_prompts",
+                    "paraphrase_prompts",
+                    "neighborhood_prompts",
+                    "attribute_prompts",
+                ]
+            )
+        })
+    if snips is None:
+        return rets
+
+    essence_rows = []
+    for j, (record, edit_id) in enumerate(jobs):
+        subject = record["requested_rewrite"]["subject"]
+        essence_texts = snips.names_to_samples[subject]
+        if len(essence_texts) > 5:
+            essence_texts = essence_texts[:5]
+        essence_rows.extend((j, edit_id, subject, text) for text in essence_texts)
+        if len(essence_texts) > 0:
+            rets[j].update({"essence_text": essence_texts})
+        if not skip_generation_tests:
+            # generation varies too much in length to share a batch, so it runs per job
+            target_new = record["requested_rewrite"]["target_new"]
+            rel_id = record["requested_rewrite"]["relation_id"]
+            consistency_texts = [x["text"] for x in snips[rel_id][target_new["id"]]]
+            if virtual_edits is not None:
+                virtual_edits.select(edit_id)
+            rets[j].update(
+                test_generation(
+                    args, model, tok, record["generation_prompts"], consistency_texts, [], vec, subject
+                )
+            )
+
+    ppls = test_essence_perplexity(args, model, tok, essence_rows, virtual_edits, max_batch_rows)
+    for j in range(len(jobs)):
+        job_ppls = [ppl for (k, _, _, _), ppl in zip(essence_rows, ppls) if k == j]
+        if len(job_ppls) > 0:
+            rets[j]["essence_score"] = np.mean(job_ppls)
+    if virtual_edits is not None:
+        virtual_edits.select(None)
+    return rets
+
+
+def test_essence_perplexity(args, model, tok, rows, virtual_edits=None, max_batch_rows=None):
+    """
+    Computes the perplexity of each (job index, edit_id, subject, essence
+    text) row as test_generation does, noising the subject of every text with
+    its own fresh prng under fact forcing or weight based tracing.
+    """
+    noised = args.fact_forcing or args.weight_based_tracing
+    embed_layername = layername(model, 0, 'embed')
+    ppls = []
+    for chunk in chunk_groups(rows, lambda row: 1, max_batch_rows):
+        if noised:
+            e_ranges = [find_token_range(tok, substring=subject, prompt_str=text) for _, _, subject, text in chunk]
+            # define function that noises embeddings at tokens_to_mix indices
+            def noise_embeddings(x, layer):
+                if layer != embed_layername:
+                    return x
+                for i, e_range in enumerate(e_ranges):
+                    if e_range is not None:
+                        b, e = e_range
+                        x[i, b:e] += seeded_noise((1, e - b, x.shape[2]), x.device, scale=args.hparams.editing_noise)[0]
+                return x
+        if virtual_edits is not None:
+            virtual_edits.select([edit_id for _, edit_id, _, _ in chunk])
+        with nethook.TraceDict(model, [embed_layername], edit_output=noise_embeddings) if noised else nullcontext():
+            ppls.extend(batch_perplexity(model, tok, [text for _, _, _, text in chunk], max_input_length=100))
+    return ppls
+
+
 def test_batch_prediction(
     args,
     model,
@@ -118,53 +244,122 @@ def test_batch_prediction(
     subject: str,
 ):
     """ """
-    
-    # calculate the token indices for the subject for each prompt. evaluation gets done in a batch, so need to noise at different token indices depending on the data point
-    if args.fact_forcing or args.weight_based_tracing:
-        prng = np.random.RandomState(1) 
-        embed_layername = layername(model, 0, 'embed')
-        e_ranges = []
-        for prompt in prefixes:
-            e_range = find_token_range(tok, substring=subject, prompt_str=prompt)
-            e_ranges.append(e_range)
-        # define function that noises embeddings at tokens_to_mix indices
-        def noise_embeddings(x, layer):
-            # corrrupt subject embeddings depending on the datapoint index
-            noise_lens = [(e_range[1] - e_range[0]) if e_range is not None else 0 for e_range in e_ranges] # tokenization could differ if subject starts sentence vs is in middle of sentence. find max len needed here, cut noise off as needed later
-            max_noise_len = max(noise_lens)
-            # print(e_ranges)
-            # print('num ranges: ', len(e_ranges))
-            if layer == embed_layername:
-                embeds_noise = torch.from_numpy(prng.randn(x.shape[0], max_noise_len, x.shape[2])).to(x.device)
-                for i in range(len(e_ranges)):
-                    e_range = e_ranges[i]
-                    if e_range is not None:
-                        b, e = e_range
-                        noise_len = e-b
-                        # print(f'about to add noise ({embeds_noise[i, :noise_len, :].shape}) to embeddings range {e_range}')
-                        x[i, b:e] += args.hparams.editing_noise * embeds_noise[i, :noise_len, :]
-                    # print(f"datapoint {i}: {prefixes[i]}")
-                    # print(f" added noise to embeds at idx {e_ranges[i]}: ", embeds_noise[i] if e_range is not None else None)
-                return x
-            else:
+    return test_batch_prediction_groups(
+        args,
+        model,
+        tok,
+        [
+            dict(
+                prefixes=prefixes,
+                target_new=target_new,
+                request_baseline=request_baseline,
+                subject=subject,
+            )
+        ],
+    )[0]
+
+
+def test_batch_prediction_groups(
+    args,
+    model,
+    tok,
+    groups: typing.List[typing.Dict],
+    virtual_edits=None,
+    max_batch_rows: int = None,
+):
+    """
+    Runs test_batch_prediction for several groups of prefixes, each a dict with
+    prefixes, target_new, request_baseline, subject and optionally the
+    edit_id to select in virtual_edits, packing the groups into as few forward
+    passes of at most max_batch_rows rows as possible. Each group is noised
+    exactly as it would be on its own, so the results match per-group calls.
+    """
+    noised = args.fact_forcing or args.weight_based_tracing
+    embed_layername = layername(model, 0, 'embed')
+    results = []
+    for chunk in chunk_groups(groups, lambda g: 2 * len(g["prefixes"]), max_batch_rows):
+        # need to calculate probability of target sequence
+        # inputs are inteleaved in order. so prefixes are [rewrite, paraphrase, neighbor, attribute]
+        # new target is first, then baseline is second for each prefix
+        # double up each prefix after making targets
+        repeated_prefixes, targets, edit_ids = [], [], []
+        for group in chunk:
+            prefixes = group["prefixes"]
+            repeated_prefixes.extend(itertools.chain(*[[prefix, prefix] for prefix in prefixes]))
+            targets.extend([group["target_new"], group["request_baseline"]] * len(prefixes))
+            edit_ids.extend([group.get("edit_id")] * (2 * len(prefixes)))
+        batch = make_inputs(tok, repeated_prefixes, targets, device=next(model.parameters()).device)
+
+        # calculate the token indices for the subject for each prompt. evaluation gets done in a batch, so need to noise at different token indices depending on the data point
+        if noised:
+            group_e_ranges = [
+                [find_token_range(tok, substring=group["subject"], prompt_str=prompt) for prompt in group["prefixes"]]
+                for group in chunk
+            ]
+            # define function that noises embeddings at tokens_to_mix indices
+            def noise_embeddings(x, layer):
+                if layer != embed_layername:
+                    return x
+                offset = 0
+                for group, e_ranges in zip(chunk, group_e_ranges):
+                    # each group draws its noise from a fresh prng, as when it is evaluated on its own
+                    num_rows = 2 * len(group["prefixes"])
+                    noise_lens = [(e_range[1] - e_range[0]) if e_range is not None else 0 for e_range in e_ranges] # tokenization could differ if subject starts sentence vs is in middle of sentence. find max len needed here, cut noise off as needed later
+                    max_noise_len = max(noise_lens)
+                    embeds_noise = seeded_noise((num_rows, max_noise_len, x.shape[2]), x.device, scale=args.hparams.editing_noise)
+                    # corrrupt subject embeddings depending on the datapoint index. each prefix is doubled
+                    # up (target_new and request_baseline rows), but by default only the first len(prefixes)
+                    # rows are noised, at the subject spans of the prefixes in order, as in the original code.
+                    # args.noise_all_prefix_rows noises row i at the subject span of its own prefix, i // 2
+                    if args.noise_all_prefix_rows:
+                        row_e_ranges = [e_ranges[i // 2] for i in range(num_rows)]
+                    else:
+                        row_e_ranges = e_ranges
+                    for i, e_range in enumerate(row_e_ranges):
+                        if e_range is not None:
+                            b, e = e_range
+                            noise_len = e-b
+                            x[offset + i, b:e] += embeds_noise[i, :noise_len, :]
+                    offset += num_rows
                 return x
 
-    # need to calculate probability of target sequence
-    # inputs are inteleaved in order. so prefixes are [rewrite, paraphrase, neighbor, attribute]
-    # new target is first, then baseline is second for each prefix
-    # double up each prefix after making targets
-
-    targets = [target_new, request_baseline] * len(prefixes)
-    repeated_prefixes = list(itertools.chain(*[[prefix, prefix] for prefix in prefixes]))
-    batch = make_inputs(tok, repeated_prefixes, targets)    
-    with nethook.TraceDict(model, [embed_layername], edit_output=noise_embeddings) if args.fact_forcing or args.weight_based_tracing else nullcontext():
-        results = score_from_batch(model, batch, return_log_probs=True)
-        nll = -results
-
-    return [
-        {"target_new": nll[i].item(), "request_baseline": nll[i + 1].item()}
-        for i in range(0, len(nll), 2)
-    ]
+        if virtual_edits is not None:
+            virtual_edits.select(edit_ids)
+        else:
+            assert all(edit_id is None for edit_id in edit_ids), "edit ids given without virtual_edits"
+        with nethook.TraceDict(model, [embed_layername], edit_output=noise_embeddings) if noised else nullcontext():
+            nll = -score_from_batch(model, batch, return_log_probs=True)
+
+        offset = 0
+        for group in chunk:
+            num_rows = 2 * len(group["prefixes"])
+            results.append([
+                {"target_new": nll[i].item(), "request_baseline": nll[i + 1].item()}
+                for i in range(offset, offset + num_rows, 2)
+            ])
+            offset += num_rows
+    return results
+
+
+def chunk_groups(groups, num_rows, max_batch_rows=None):
+    """
+    Splits groups into consecutive chunks of at most max_batch_rows rows,
+    where num_rows(group) gives the rows of each group. A group larger than
+    max_batch_rows gets a chunk of its own.
+    """
+    if max_batch_rows is None:
+        return [groups] if len(groups) else []
+    chunks, chunk, chunk_rows = [], [], 0
+    for group in groups:
+        rows = num_rows(group)
+        if chunk and chunk_rows + rows > max_batch_rows:
+            chunks.append(chunk)
+            chunk, chunk_rows = [], 0
+        chunk.append(group)
+        chunk_rows += rows
+    if chunk:
+        chunks.append(chunk)
+    return chunks
 
 
 def test_generation(
@@ -203,18 +398,18 @@ def test_generation(
             # define subject noising function
             if args.fact_forcing or args.weight_based_tracing:
                 e_range = find_token_range(tok, substring=subject, prompt_str=essence_text)
-                prng = np.random.RandomState(1) 
+                draws = itertools.count()
                 embed_layername = layername(model, 0, 'embed')
                 # define function that noises embeddings at tokens_to_mix indices
                 def noise_embeddings(x, layer):
                     # corrrupt subject embeddings depending on the datapoint index
                     noise_len = e_range[1] - e_range[0]
                     if layer == embed_layername:
-                        embeds_noise = torch.from_numpy(prng.randn(x.shape[0], noise_len, x.shape[2])).to(x.device)
+                        embeds_noise = seeded_noise((x.shape[0], noise_len, x.shape[2]), x.device, scale=args.hparams.editing_noise, draw=next(draws))
                         # print(f'about to add noise ({embeds_noise.shape}) to embeddings range {e_range}')
                         if e_range is not None:
                             b, e = e_range
-                            x[:, b:e] += args.hparams.editing_noise * embeds_noise
+                            x[:, b:e] += embeds_noise
                         return x
                     else:
                         return x
@@ -103,7 +103,7 @@ def test_batch_prediction_acc(model, tok, prompts: typing.List[str], target):
         prompts,
         padding=True,
         return_tensors="pt",
-    ).to("cuda")
+    ).to(model.device)
 
     with torch.no_grad():
         logits = model(**prompt_tok).logits
@@ -112,7 +112,7 @@ def test_batch_prediction_acc(model, tok, prompts: typing.List[str], target):
         gathered = torch.gather(logits, 1, to_gather).squeeze(1)
         ans = torch.argmax(gathered, dim=1)
 
-        correct_id = tok(target, padding=True, return_tensors="pt").to("cuda")[
+        correct_id = tok(target, padding=True, return_tensors="pt").to(model.device)[
             "input_ids"
         ]
         # Temporary hack to deal with foreign characters.
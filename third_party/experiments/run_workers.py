@@ -0,0 +1,147 @@
+"""
+Runs experiments.evaluate or experiments.tracing as several worker processes
+that share each experiment's records through a work queue, e.g. two workers
+on each of four GPUs:
+
+    python -m experiments.run_workers --num_workers 8 --devices "0 1 2 3" -- \
+        experiments.evaluate --alg_name ROME --model_name gpt2-xl --ds_name cf -n 2000
+
+Each worker is started with --worker_id and --gpu, and logs to
+{log_dir}/worker_{i}.log.  By default workers are spread over all visible
+GPUs; with --device cpu they are all run on the CPU.  Workers that exit with an error are
+restarted up to --max_restarts times; the items they were processing are
+reclaimed once their leases expire.  When all workers are done, the module
+is run once more with --run 0 to collect the results of the whole sweep.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+import torch
+
+
+def log(msg):
+    print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] {msg}", flush=True)
+
+
+def start_worker(module_args, worker_id, device, log_dir):
+    cmd = [sys.executable, "-m"] + module_args + ["--worker_id", str(worker_id), "--gpu", device]
+    log_path = os.path.join(log_dir, f"worker_{worker_id}.log")
+    with open(log_path, "a") as log_file:
+        log_file.write(f"\n=== {time.strftime('%Y-%m-%d %H:%M:%S')} {' '.join(cmd)}\n")
+        log_file.flush()
+        process = subprocess.Popen(cmd, stdout=log_file, stderr=subprocess.STDOUT)
+    log(f"Started worker {worker_id} (pid {process.pid}) on device {device}, logging to {log_path}")
+    return process
+
+
+def run_workers(module_args, num_workers, devices, log_dir, max_restarts=3, poll_seconds=10):
+    """
+    Runs num_workers workers of module_args to completion, assigning them
+    devices (GPU ids, or "cpu") round robin. Returns the ids of workers that
+    did not succeed.
+    """
+    os.makedirs(log_dir, exist_ok=True)
+    worker_devices = [devices[i % len(devices)] for i in range(num_workers)]
+    processes = {
+        i: start_worker(module_args, i, worker_devices[i], log_dir) for i in range(num_workers)
+    }
+    restarts = {i: 0 for i in range(num_workers)}
+    failed = []
+    try:
+        while len(processes) > 0:
+            time.sleep(poll_seconds)
+            for i, process in list(processes.items()):
+                returncode = process.poll()
+                if returncode is None:
+                    continue
+                del processes[i]
+                if returncode == 0:
+                    log(f"Worker {i} finished")
+                elif restarts[i] < max_restarts:
+                    restarts[i] += 1
+                    log(f"Worker {i} exited with code {returncode}, restarting ({restarts[i]}/{max_restarts})")
+                    processes[i] = start_worker(module_args, i, worker_devices[i], log_dir)
+                else:
+                    log(f"Worker {i} exited with code {returncode}, giving up on it")
+                    failed.append(i)
+    except KeyboardInterrupt:
+        log("Interrupted, stopping workers")
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            process.wait()
+        raise
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        usage="python -m experiments.run_workers [options] -- MODULE [MODULE ARGS]"
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=1,
+        help="Number of worker processes to run.",
+    )
+    parser.add_argument(
+        "--device",
+        type=str,
+        default="cuda",
+        choices=["cuda", "cpu"],
+        help="Run the workers on GPUs or on the CPU.",
+    )
+    parser.add_argument(
+        "--devices",
+        type=str,
+        default=None,
+        help="GPU ids separated by spaces, assigned to workers round robin. "
+        "By default workers are spread over all visible GPUs.",
+    )
+    parser.add_argument(
+        "--log_dir",
+        type=str,
+        default="logs/workers",
+        help="Directory for the per-worker logs.",
+    )
+    parser.add_argument(
+        "--max_restarts",
+        type=int,
+        default=3,
+        help="Number of times a worker that exits with an error is restarted.",
+    )
+    parser.add_argument(
+        "--no_collect",
+        action="store_true",
+        help="Do not run the module with --run 0 to collect results once the workers are done.",
+    )
+    argv = sys.argv[1:]
+    if "--" not in argv:
+        parser.error("separate the module and its arguments with --")
+    split = argv.index("--")
+    args = parser.parse_args(argv[:split])
+    module_args = argv[split + 1 :]
+    if len(module_args) == 0:
+        parser.error("no module given")
+
+    if args.device == "cpu":
+        if args.devices:
+            parser.error("--devices cannot be used with --device cpu")
+        devices = ["cpu"]
+    elif args.devices:
+        devices = args.devices.split()
+    else:
+        devices = [str(i) for i in range(torch.cuda.device_count())]
+        if len(devices) == 0:
+            parser.error("no GPUs found, use --device cpu")
+    failed = run_workers(module_args, args.num_workers, devices, args.log_dir, args.max_restarts)
+    if len(failed) > 0:
+        log(f"Workers {failed} failed, see their logs in {args.log_dir}")
+    if not args.no_collect:
+        log("Collecting results")
+        subprocess.run([sys.executable, "-m"] + module_args + ["--run", "0", "--gpu", devices[0]], check=True)
+    sys.exit(1 if len(failed) > 0 else 0)
@@ -4,9 +4,11 @@ from pprint import pprint
 from typing import List, Optional
 
 import numpy as np
+import pandas as pd
 from scipy.stats import hmean
 
 from util.globals import *
+from util.results_store import ResultsStore
 
 
 def main(
@@ -15,94 +17,19 @@ def main(
     first_n_cases=None,
     get_uncompressed=False,
     abs_path=False,
+    results_store=None,
 ):  # runs = None -> all runs
     summaries = []
     uncompressed = []
 
-    for run_dir in (RESULTS_DIR / dir_name if not abs_path else dir_name).iterdir():
-        # Skip if we're not interested
-        if runs is not None and all(run not in str(run_dir) for run in runs):
-            continue
-
-        # Iterate through all case files
+    for run_dir, case_sums in iter_run_case_summaries(dir_name, runs, abs_path, results_store):
+        # Iterate through all cases
         cur_sum = collections.defaultdict(lambda: [])
-        files = list(run_dir.glob("case_*.json"))
-        files.sort(key=lambda x: int(str(x).split("_")[-1].split(".")[0]))
-        for case_file in files:
-            try:
-                with open(case_file, "r") as f:
-                    data = json.load(f)
-            except json.JSONDecodeError:
-                print(f"Could not decode {case_file} due to format error; skipping.")
-
-            case_id = data["case_id"]
+        for case_id, case_sum in case_sums:
             if first_n_cases is not None and case_id >= first_n_cases:
                 break
-
-            cur_sum["time"].append(data["time"])
-
-            for prefix in ["pre", "post"]:
-                # Probability metrics for which new should be lower (better) than true
-                for key in ["rewrite_prompts_probs", "paraphrase_prompts_probs"]:
-                    if prefix not in data or key not in data[prefix]:
-                        continue
-
-                    sum_key_discrete = f"{prefix}_{key.split('_')[0]}_success"
-                    sum_key_cont = f"{prefix}_{key.split('_')[0]}_diff"
-
-                    cur_sum[sum_key_discrete].append(
-                        np.mean(
-                            [
-                                x["target_true"] > x["target_new"]
-                                for x in data[prefix][key]
-                            ]
-                        )
-                    )
-                    cur_sum[sum_key_cont].append(
-                        np.mean(
-                            [
-                                np.exp(-x["target_new"]) - np.exp(-x["target_true"])
-                                for x in data[prefix][key]
-                            ]
-                        )
-                    )
-
-                # Probability metrics for which true should be lower (better) than new
-                sum_key_discrete = f"{prefix}_neighborhood_success"
-                sum_key_cont = f"{prefix}_neighborhood_diff"
-                key = "neighborhood_prompts_probs"
-                if prefix in data and key in data[prefix]:
-                    cur_sum[sum_key_discrete].append(
-                        np.mean(
-                            [
-                                x["target_true"] < x["target_new"]
-                                for x in data[prefix][key]
-                            ]
-                        )
-                    )
-                    cur_sum[sum_key_cont].append(
-                        np.mean(
-                            [
-                                np.exp(-x["target_true"]) - np.exp(-x["target_new"])
-                                for x in data[prefix][key]
-                            ]
-                        )
-                    )
-
-                # zsRE evaluation metrics
-                for key in ["rewrite", "paraphrase", "neighborhood"]:
-                    sum_key = f"{prefix}_{key}_acc"
-                    key = f"{key}_prompts_correct"
-
-                    if prefix not in data or key not in data[prefix]:
-                        continue
-
-                    cur_sum[sum_key].append(np.mean(data[prefix][key]))
-
-                # Generation metrics that can be directly averaged
-                for key in ["ngram_entropy", "reference_score", "essence_score"]:
-                    if prefix in data and key in data[prefix]:
-                        cur_sum[f"{prefix}_{key}"].append(data[prefix][key])
+            for k, v in case_sum.items():
+                cur_sum[k].append(v)
 
         if len(cur_sum) == 0:
             continue
@@ -154,6 +81,125 @@ def main(
     return uncompressed if get_uncompressed else summaries
 
 
+def case_summary(data):
+    """
+    Returns the metrics of one case record that are averaged over the cases
+    of a run.
+    """
+    cur_sum = {}
+    cur_sum["time"] = data["time"]
+
+    for prefix in ["pre", "post"]:
+        # Probability metrics for which new should be lower (better) than true
+        for key in ["rewrite_prompts_probs", "paraphrase_prompts_probs"]:
+            if prefix not in data or key not in data[prefix]:
+                continue
+
+            sum_key_discrete = f"{prefix}_{key.split('_')[0]}_success"
+            sum_key_cont = f"{prefix}_{key.split('_')[0]}_diff"
+
+            cur_sum[sum_key_discrete] = np.mean(
+                [
+                    x["target_true"] > x["target_new"]
+                    for x in data[prefix][key]
+                ]
+            )
+            cur_sum[sum_key_cont] = np.mean(
+                [
+                    np.exp(-x["target_new"]) - np.exp(-x["target_true"])
+                    for x in data[prefix][key]
+                ]
+            )
+
+        # Probability metrics for which true should be lower (better) than new
+        sum_key_discrete = f"{prefix}_neighborhood_success"
+        sum_key_cont = f"{prefix}_neighborhood_diff"
+        key = "neighborhood_prompts_probs"
+        if prefix in data and key in data[prefix]:
+            cur_sum[sum_key_discrete] = np.mean(
+                [
+                    x["target_true"] < x["target_new"]
+                    for x in data[prefix][key]
+                ]
+            )
+            cur_sum[sum_key_cont] = np.mean(
+                [
+                    np.exp(-x["target_true"]) - np.exp(-x["target_new"])
+                    for x in data[prefix][key]
+                ]
+            )
+
+        # zsRE evaluation metrics
+        for key in ["rewrite", "paraphrase", "neighborhood"]:
+            sum_key = f"{prefix}_{key}_acc"
+            key = f"{key}_prompts_correct"
+
+            if prefix not in data or key not in data[prefix]:
+                continue
+
+            cur_sum[sum_key] = np.mean(data[prefix][key])
+
+        # Generation metrics that can be directly averaged
+        for key in ["ngram_entropy", "reference_score", "essence_score"]:
+            if prefix in data and key in data[prefix]:
+                cur_sum[f"{prefix}_{key}"] = data[prefix][key]
+
+    return cur_sum
+
+
+def case_summary_rows(df):
+    return pd.DataFrame(
+        [
+            dict(case_id=case_id, **case_summary(json.loads(metrics)))
+            for case_id, metrics in zip(df["case_id"], df["metrics"])
+        ]
+    )
+
+
+def iter_run_case_summaries(dir_name, runs, abs_path=False, results_store=None):
+    """
+    Yields (run, (case_id, case_summary) pairs in case_id order) for each run,
+    read from the case_*.json files of the run directories in dir_name, or, if
+    results_store is given, from its experiments. The case summaries of a
+    store are kept in a derived table, so only the cases appended since the
+    last summary are read.
+    """
+
+    if results_store is not None:
+        for experiment in results_store.experiments():
+            if runs is not None and all(run not in experiment for run in runs):
+                continue
+            df = results_store.derived(experiment, "case_summaries", case_summary_rows, unique_on="case_id")
+            if df.empty:
+                continue
+            df = df.sort_values("case_id")
+            yield experiment, (
+                (case_id, {k: v for k, v in row.items() if not pd.isna(v)})
+                for case_id, row in zip(df["case_id"], df.drop(columns="case_id").to_dict("records"))
+            )
+        return
+
+    for run_dir in (RESULTS_DIR / dir_name if not abs_path else dir_name).iterdir():
+        # Skip if we're not interested
+        if runs is not None and all(run not in str(run_dir) for run in runs):
+            continue
+
+        files = list(run_dir.glob("case_*.json"))
+        files.sort(key=lambda x: int(str(x).split("_")[-1].split(".")[0]))
+        yield run_dir, ((data["case_id"], case_summary(data)) for data in iter_case_files(files))
+
+
+def iter_case_files(files):
+    for case_file in files:
+        try:
+            with open(case_file, "r") as f:
+                data = json.load(f)
+        except json.JSONDecodeError:
+            print(f"Could not decode {case_file} due to format error; skipping.")
+            continue
+        yield data
+
+
 if __name__ == "__main__":
     import argparse
 
@@ -175,10 +221,18 @@ if __name__ == "__main__":
         help="Restricts evaluation to first n cases in dataset. "
         "Useful for comparing different in-progress runs on the same slice of data.",
     )
+    parser.add_argument(
+        "--store_dir",
+        type=str,
+        default=None,
+        help="Summarizes the experiments of the results store in this directory, "
+        "instead of the case files in <dir_name>.",
+    )
     args = parser.parse_args()
 
     main(
         args.dir_name,
         None if args.runs is None else args.runs.split(","),
         args.first_n_cases,
+        results_store=None if args.store_dir is None else ResultsStore(args.store_dir),
     )
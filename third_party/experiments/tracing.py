@@ -2,7 +2,9 @@ import argparse
 import json
 import os
 import shutil
+import sys
 import collections
+import itertools
 import time
 from google.cloud import storage
 from pathlib import Path
@@ -35,6 +37,8 @@ from rome import ROMEHyperParams, apply_rome_to_model
 from util import nethook
 from util.generate import generate_fast
 from util.globals import *
+from util.results_store import ResultsStore
+from util.work_queue import LEASE_SECONDS, WorkQueue, set_record_seed
 from util.fewshot_utils import first_appearance_fewshot_accuracy_sum, fewshot_accuracy_sum
 
 
@@ -192,9 +196,23 @@ def format_prompt_from_df(df, test_input, answers=None, instructions=None, cot_r
   prompt = format_prompt(examples, formatted_test_input, instructions=instructions, separator=separator)
   return prompt
 
-def make_results_df(model_name, exp_name, count=1208):
-  all_data_points = []
+TRACE_ROW_KEY = ['input_id', 'module', 'token_idx', 'layer_idx']
+
+def dedup_trace_rows(df):
+  # keeps the last trace written for each point, module and cell in a batch of new rows
+  return df.drop_duplicates(subset=TRACE_ROW_KEY, keep='last')
+
+def make_results_df(model_name, exp_name, count=1208, results_store=None):
   print(f"Making results_df for exp: {exp_name}...")
+  if results_store is not None:
+    # the derived table is only extended with the traces appended since the last call, and is
+    # compacted with the raw traces at the end of a run, so this reads one file per experiment
+    results_df = results_store.derived(exp_name, 'results_df', dedup_trace_rows, unique_on=TRACE_ROW_KEY)
+    if results_df.empty:
+      print(f"no results stored for exp: {exp_name}")
+      return results_df
+    return results_df[results_df['input_id'] < count]
+  all_data_points = []
   for kind in [None, 'mlp', 'attn']:
     skipped = 0
     read_count = 0
@@ -264,13 +282,23 @@ def causal_tracing_loop(args, experiment_name, task_name, split_name, model_name
                         correctness_filter=False,
                         check_corruption_effects=False,
                         min_corruption_effect = 0,
-                        min_pred_prob=0):
+                        min_pred_prob=0,
+                        max_batch_rows=None,
+                        results_store=None,
+                        work_queue=None,
+                        worker_id=None):
   """Runs causal tracing algorithm over a dataset provided in eval_data.
   args:
     explain_quantity: in ['label', 'score_pred', None], we explain p(explain_quantity)
       None means that you generate a prediction, 'score_pred' means you score to get pred
     check_corruption_effects: instead of doing causal tracing, loop over the data and check
       the effect of the subject noising step on the output. used for calibrating the noise size
+    max_batch_rows: if set, trace many (token, layer) cells per forward pass, using at most
+      this many rows per pass. None traces one cell per pass
+    results_store: if set, trace results are appended to this ResultsStore under experiment_name,
+      instead of being written to per-point npz and csv files
+    work_queue: if set, the data points are shared with other workers through this WorkQueue,
+      and only the points leased to worker_id are traced
   """
   # eval model and return a single row df with the results
   start = time.time()
@@ -294,8 +322,15 @@ def causal_tracing_loop(args, experiment_name, task_name, split_name, model_name
   n_chunks = np.ceil(len(eval_data_loop) / effective_batch_size)
   causal_tracing_results = []
   skipped = 0
-  for batch_num, batch in enumerate(np.array_split(eval_data_loop, n_chunks)):
+  batches = np.array_split(eval_data_loop, n_chunks)
+  # kept up to date by the store as traces are appended
+  done_ids = results_store.done_ids(experiment_name, key=['input_id', 'module']) if results_store is not None else None
+  def trace_point(batch_num, batch):
+    nonlocal skipped, done_ids
     data_point_id = batch.index[0]
+    # seed per point, so that results do not depend on which points were traced before it,
+    # or on which worker traced it
+    set_record_seed(random_seed, data_point_id)
     # format data
     input = batch.input.item()
     if task_name in ['commonsense', 'utilitarianism', 'deontology', 'justice', 'virtue']:
@@ -332,7 +367,7 @@ def causal_tracing_loop(args, experiment_name, task_name, split_name, model_name
       if correctness_filter is True:
         if not is_correct:
           print(f"skipping batch {batch_num}, point {data_point_id}, as it is wrongly predicted")
-          continue
+          return
     # get tracing output to explain
     if explain_quantity == 'label':
       tracing_target = label
@@ -366,18 +401,25 @@ def causal_tracing_loop(args, experiment_name, task_name, split_name, model_name
       if min_pred_prob > 0:
         if high_score < min_pred_prob:
           print(f"skipping batch {batch_num}, point {data_point_id}, with too small a pred prob of {high_score:.3f}")
-          continue
+          return
       if min_corruption_effect > 0:
         if diff < min_corruption_effect:
           print(f"skipping batch {batch_num}, point {data_point_id}, with too small a corruption effect of {diff:.3f}")
-          continue
+          return
 
     kinds = [restore_module] if restore_module!=None else [None, "mlp", "attn"]
     for kind in kinds:
       # potentially skip if exists
       if not overwrite:
         save_path = f"{BASE_DIR}/results/{_model_name}/traces/{experiment_name}_{data_point_id}_{kind}.csv"
-        if os.path.exists(save_path):
+        if results_store is not None:
+          if work_queue is not None:
+            # pick up points written by other workers
+            done_ids = results_store.done_ids(experiment_name, key=['input_id', 'module'])
+          already_written = (data_point_id, str(kind)) in done_ids
+        else:
+          already_written = os.path.exists(save_path)
+        if already_written:
           if printing:
             print(f"skipping batch {batch_num}, point {data_point_id}, as it is already written")
           skipped += 1
@@ -388,6 +430,7 @@ def causal_tracing_loop(args, experiment_name, task_name, split_name, model_name
       # CALCULUATE HIDDEN FLOW
       results_dict = calculate_hidden_flow(
         mt, query_input, subject, target=tracing_target, samples=num_samples, noise=noise_sd, window=window_size, kind=kind,
+        max_batch_rows=max_batch_rows,
       )
       # add variables to results_dict
       results_dict['input_id'] = data_point_id
@@ -405,12 +448,31 @@ def causal_tracing_loop(args, experiment_name, task_name, split_name, model_name
         save_path = os.path.join(f'{BASE_DIR}/results/{_model_name}/traces', plot_name) if plot_name else None 
         print(f"saving plot at {save_path}")
         plot_trace_heatmap(results_dict, show_plot=show_plots, savepdf=save_path, modelname=_model_name)
-        save_path = f"{BASE_DIR}/results/{_model_name}/traces/{experiment_name}_{data_point_id}_{kind}.npz"
-        if printing:
-          print(f"saving results at {save_path}")
-        np.savez(save_path, results_dict)
-        results_df.to_csv(save_path.replace('npz', 'csv'), index=False)
+        if results_store is not None:
+          results_store.append(experiment_name, results_df)
+        else:
+          save_path = f"{BASE_DIR}/results/{_model_name}/traces/{experiment_name}_{data_point_id}_{kind}.npz"
+          if printing:
+            print(f"saving results at {save_path}")
+          np.savez(save_path, results_dict)
+          results_df.to_csv(save_path.replace('npz', 'csv'), index=False)
     del batch, input, label, subject, query_input
+  if work_queue is not None:
+    batches_by_id = {str(batch.index[0]): batch for batch in batches}
+    def log_lease(data_point_id, counts):
+      print(f"Worker {worker_id} leased point {data_point_id}. Queue: {counts}")
+    point_nums = itertools.count()
+    def trace_leased_point(data_point_id):
+      trace_point(next(point_nums), batches_by_id[data_point_id])
+      # the point's traces are written before its queue item is completed
+      if results_store is not None:
+        results_store.flush(experiment_name)
+    work_queue.process_leased(worker_id, list(batches_by_id), trace_leased_point, on_lease=log_lease)
+  else:
+    for batch_num, batch in enumerate(batches):
+      trace_point(batch_num, batch)
+  if results_store is not None:
+    results_store.flush(experiment_name)
   # make results dfs
   if len(causal_tracing_results) > 0:
     results_df = pd.concat([result_df for result_df in causal_tracing_results])
@@ -467,6 +529,44 @@ if __name__ == "__main__":
         action="store_true",
         help="More printing",
     )
+    parser.add_argument(
+        "--max_batch_rows",
+        type=int,
+        default=None,
+        help="Trace many (token, layer) cells per forward pass, with at most this many rows per pass",
+    )
+    parser.add_argument(
+        "--results_store",
+        type=int,
+        default=0,
+        choices=[0,1],
+        help="Append traces to the Parquet results store under results/<model>/store instead of writing npz and csv files per point",
+    )
+    parser.add_argument(
+        "--results_store_buffer",
+        type=int,
+        default=20000,
+        help="Number of trace rows to buffer in memory before appending them to the results store",
+    )
+    parser.add_argument(
+        "--worker_id",
+        type=int,
+        default=None,
+        help="Run as one of several workers sharing each experiment's points through a work queue. "
+        "Usually set by experiments.run_workers",
+    )
+    parser.add_argument(
+        "--queue_dir",
+        type=str,
+        default=None,
+        help="Local directory for the work queue databases. Defaults to results/<model>/traces",
+    )
+    parser.add_argument(
+        "--lease_seconds",
+        type=float,
+        default=LEASE_SECONDS,
+        help="Seconds after which a queue item leased by a worker that stopped sending heartbeats is reclaimed",
+    )
     parser.add_argument(
         "--run",
         type=int,
@@ -477,13 +577,15 @@ if __name__ == "__main__":
         "--gpu",
         type=str,
         default="0",
+        help="GPU id, or cpu",
     )
     parser.set_defaults(verbose=False, overwrite=False)
     args = parser.parse_args()
 
     # set device and seed
-    device = torch.device(f"cuda:{args.gpu}")
-    torch.cuda.set_device(device)
+    device = torch.device("cpu") if args.gpu == "cpu" else torch.device(f"cuda:{args.gpu}")
+    if device.type == "cuda":
+        torch.cuda.set_device(device)
     RANDOM_SEED=1
     np.random.seed(RANDOM_SEED)
     torch.random.manual_seed(RANDOM_SEED)
@@ -500,9 +602,9 @@ if __name__ == "__main__":
         mem_usage = True
 
         if '20b' not in model_name:
-            mt = ModelAndTokenizer(model_name, low_cpu_mem_usage=mem_usage, torch_dtype=torch_dtype, cache_dir=MODEL_DIR)
+            mt = ModelAndTokenizer(model_name, low_cpu_mem_usage=mem_usage, torch_dtype=torch_dtype, cache_dir=MODEL_DIR, device=device)
             torch.cuda.empty_cache()
-            mt.model.eval().cuda()
+            mt.model.eval().to(device)
             mt.tokenizer.add_special_tokens({'pad_token' : mt.tokenizer.eos_token})
         else:
             raise RuntimeError("20b model does not load properly across devices")
@@ -554,9 +656,18 @@ if __name__ == "__main__":
         noise_sd = .01
         max_decode_steps=36
 
+    results_store = None
+    if args.results_store:
+        # workers also flush each point's traces when it is done
+        results_store = ResultsStore(f'{BASE_DIR}/results/{_model_name}/store', buffer_rows=args.results_store_buffer)
+
     results_dfs = []
     for window_size in window_sizes:
         exp_name = f"{_model_name}_{args.ds_name}_k{k}_wd{window_size}_sd{RANDOM_SEED}"
+        work_queue = None
+        if args.worker_id is not None:
+            queue_dir = args.queue_dir or f'{BASE_DIR}/results/{_model_name}/traces'
+            work_queue = WorkQueue(os.path.join(queue_dir, f"work_queue_{exp_name}.sqlite"), lease_seconds=args.lease_seconds)
         if args.run:
             results_df, metadata_df = causal_tracing_loop(args, exp_name, args.ds_name, "", args.model_name, 
                                         mt, eval_data,
@@ -573,11 +684,22 @@ if __name__ == "__main__":
                                         template_id=template_id, 
                                         print_examples=10,
                                         overwrite=args.overwrite,
-                                        correctness_filter=True)
-        results_df = make_results_df(_model_name, exp_name, count=args.dataset_size_limit)
+                                        correctness_filter=True,
+                                        max_batch_rows=args.max_batch_rows,
+                                        results_store=results_store,
+                                        work_queue=work_queue,
+                                        worker_id=args.worker_id)
+        if args.worker_id is not None:
+            # results are collected by experiments.run_workers once every worker is done
+            continue
+        results_df = make_results_df(_model_name, exp_name, count=args.dataset_size_limit, results_store=results_store)
+        if results_store is not None:
+            results_store.compact(exp_name)
         results_df['trace_window_size'] = window_size
         results_dfs.append(results_df)
 
+    if args.worker_id is not None:
+        sys.exit(0)
     all_results_df = pd.concat(results_dfs)
     save_path = f'{BASE_DIR}/results/{ovr_exp_name}.csv'
     print(f"Saving results at {save_path}")
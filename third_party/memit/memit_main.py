@@ -7,7 +7,7 @@ import numpy as np
 import torch
 from transformers import AutoModelForCausalLM, AutoTokenizer
 
-from rome.layer_stats import layer_stats
+from rome.layer_stats import layer_stats, multi_layer_stats
 from util import nethook
 from util.generate import generate_fast
 from util.globals import *
@@ -47,7 +47,8 @@ def apply_memit_to_model(
 
     with torch.no_grad():
         for w_name, (key_mat, val_mat) in deltas.items():
-            key_mat, val_mat = key_mat.to("cuda"), val_mat.to("cuda")
+            device = next(model.parameters()).device
+            key_mat, val_mat = key_mat.to(device), val_mat.to(device)
             upd_matrix = key_mat @ val_mat.T
             w = nethook.get_parameter(model, w_name)
             upd_matrix = upd_matrix_match_shape(upd_matrix, w.shape)
@@ -122,7 +123,7 @@ def execute_memit(
         ):
             try:
                 data = np.load(cache_fname)
-                z_list.append(torch.from_numpy(data["v_star"]).to("cuda"))
+                z_list.append(torch.from_numpy(data["v_star"]).to(next(model.parameters()).device))
                 data_loaded = True
             except Exception as e:
                 print(f"Error reading cache file due to {e}. Recomputing...")
@@ -152,6 +153,16 @@ def execute_memit(
                 print(f"Cached k/v pair at {cache_fname}")
     zs = torch.stack(z_list, dim=1)
 
+    # Collect any uncached covariance statistics for all layers in one pass
+    prefetch_covs(
+        model,
+        tok,
+        [hparams.rewrite_module_tmp.format(layer) for layer in hparams.layers],
+        hparams.mom2_dataset,
+        hparams.mom2_n_samples,
+        hparams.mom2_dtype,
+    )
+
     # Insert
     for i, layer in enumerate(hparams.layers):
         print(f"\n\nLAYER {layer}\n")
@@ -269,9 +280,43 @@ def get_cov(
         )
         COV_CACHE[key] = stat.mom2.moment().float().to("cpu")
 
+    device = next(model.parameters()).device
     return (
-        torch.inverse(COV_CACHE[key].to("cuda")) if inv else COV_CACHE[key].to("cuda")
+        torch.inverse(COV_CACHE[key].to(device)) if inv else COV_CACHE[key].to(device)
+    )
+
+
+def prefetch_covs(
+    model: AutoModelForCausalLM,
+    tok: AutoTokenizer,
+    layer_names: List[str],
+    mom2_dataset: str,
+    mom2_n_samples: str,
+    mom2_dtype: str,
+) -> None:
+    """
+    Fills COV_CACHE for all of the given layers, so that get_cov does not
+    make a separate pass over the dataset for each one.
+    """
+
+    model_name = model.config._name_or_path.replace("/", "_")
+    layer_names = [l for l in layer_names if (model_name, l) not in COV_CACHE]
+    if not layer_names:
+        return
+
+    print(f"Retrieving covariance statistics for {model_name} @ {layer_names}.")
+    stats = multi_layer_stats(
+        model,
+        tok,
+        layer_names,
+        STATS_DIR,
+        mom2_dataset,
+        to_collect=["mom2"],
+        sample_size=mom2_n_samples,
+        precision=mom2_dtype,
     )
+    for layer_name, stat in stats.items():
+        COV_CACHE[(model_name, layer_name)] = stat.mom2.moment().float().to("cpu")
 
 
 def upd_matrix_match_shape(matrix: torch.Tensor, shape: torch.Size) -> torch.Tensor:
@@ -1 +1,2 @@
 from .rome_main import ROMEHyperParams, apply_rome_to_model, execute_rome
+from .virtual_edits import VirtualEdits
@@ -48,7 +48,7 @@ def get_inv_cov(
             precision=mom2_dtype,
         )
         inv_mom2_cache[key] = torch.inverse(
-            stat.mom2.moment().to("cuda")
+            stat.mom2.moment().to(next(model.parameters()).device)
         ).float()  # Cast back to float32
 
     return inv_mom2_cache[key]
@@ -28,9 +28,10 @@ def compute_v(
 
     print("Computing right vector (v)")
     patience_counter = 0
+    device = next(model.parameters()).device
 
     # Tokenize target into list of int token IDs
-    target_ids = tok(request["target_new"]["str"], return_tensors="pt").to("cuda")[
+    target_ids = tok(request["target_new"]["str"], return_tensors="pt").to(device)[
         "input_ids"
     ][0]
 
@@ -45,10 +46,10 @@ def compute_v(
         [prompt.format(request["subject"]) for prompt in all_prompts],
         return_tensors="pt",
         padding=True,
-    ).to("cuda")
+    ).to(device)
 
     # Compute rewriting targets
-    rewriting_targets = torch.tensor(-100, device="cuda").repeat(
+    rewriting_targets = torch.tensor(-100, device=device).repeat(
         len(rewriting_prompts), *input_tok["input_ids"].shape[1:]
     )
     for i in range(len(rewriting_prompts)):
@@ -71,7 +72,7 @@ def compute_v(
     # Set up an optimization over a latent vector that, when output at the
     # rewrite layer, i.e. hypothesized fact lookup location, will induce the
     # target token to be predicted at the final layer.
-    delta = torch.zeros((model.config.n_embd,), requires_grad=True, device="cuda")
+    delta = torch.zeros((model.config.n_embd,), requires_grad=True, device=device)
     target_init, kl_distr_init = None, None
 
     # Inserts new "delta" variable at the appropriate part of the computation
@@ -94,85 +95,91 @@ def compute_v(
     opt = torch.optim.Adam([delta], lr=hparams.v_lr)
     nethook.set_requires_grad(False, model)
 
-    # Execute optimization
-    for it in range(hparams.v_num_grad_steps):
-        opt.zero_grad()
-
-        # Forward propagation
-        with nethook.TraceDict(
-            module=model,
-            layers=[
-                hparams.layer_module_tmp.format(loss_layer),
-                hparams.mlp_module_tmp.format(layer),
-            ],
-            retain_input=False,
-            retain_output=True,
-            edit_output=edit_output_fn,
-        ) as tr:
-            logits = model(**input_tok).logits
-
-            # Compute distribution for KL divergence
-            kl_logits = torch.stack(
-                [
-                    logits[i - len(kl_prompts), idx, :]
-                    for i, idx in enumerate(lookup_idxs[-len(kl_prompts) :])
+    # Execute optimization. The layers below the edit are unaffected by delta,
+    # so their outputs are recorded once and replayed on every step. Under fact
+    # forcing the subject embeddings are re-noised each step, so they must rerun.
+    frozen_layers = [] if args.fact_forcing else range(layer)
+    with nethook.FrozenPrefix(
+        model, [hparams.layer_module_tmp.format(l) for l in frozen_layers]
+    ):
+        for it in range(hparams.v_num_grad_steps):
+            opt.zero_grad()
+
+            # Forward propagation
+            with nethook.TraceDict(
+                module=model,
+                layers=[
+                    hparams.layer_module_tmp.format(loss_layer),
+                    hparams.mlp_module_tmp.format(layer),
                 ],
-                dim=0,
+                retain_input=False,
+                retain_output=True,
+                edit_output=edit_output_fn,
+            ) as tr:
+                logits = model(**input_tok).logits
+
+                # Compute distribution for KL divergence
+                kl_logits = torch.stack(
+                    [
+                        logits[i - len(kl_prompts), idx, :]
+                        for i, idx in enumerate(lookup_idxs[-len(kl_prompts) :])
+                    ],
+                    dim=0,
+                )
+                kl_log_probs = torch.nn.functional.log_softmax(kl_logits, dim=1)
+                if kl_distr_init is None:
+                    kl_distr_init = kl_log_probs.detach().clone()
+
+            # Compute loss on rewriting targets
+            log_probs = torch.log_softmax(logits, dim=2)
+
+            loss = torch.gather(
+                log_probs,
+                2,
+                torch.where(rewriting_targets != -100, rewriting_targets, 0).unsqueeze(2),
+            ).squeeze(2)
+            mask = (rewriting_targets != -100).float()
+
+            # Aggregate total losses
+            nll_loss_each = -(loss * mask).sum(1) / target_ids.size(0)
+            nll_loss = nll_loss_each.mean()
+            kl_loss = hparams.kl_factor * torch.nn.functional.kl_div(
+                kl_distr_init, kl_log_probs, log_target=True, reduction="batchmean"
             )
-            kl_log_probs = torch.nn.functional.log_softmax(kl_logits, dim=1)
-            if kl_distr_init is None:
-                kl_distr_init = kl_log_probs.detach().clone()
-
-        # Compute loss on rewriting targets
-        log_probs = torch.log_softmax(logits, dim=2)
-
-        loss = torch.gather(
-            log_probs,
-            2,
-            torch.where(rewriting_targets != -100, rewriting_targets, 0).unsqueeze(2),
-        ).squeeze(2)
-        mask = (rewriting_targets != -100).float()
-
-        # Aggregate total losses
-        nll_loss_each = -(loss * mask).sum(1) / target_ids.size(0)
-        nll_loss = nll_loss_each.mean()
-        kl_loss = hparams.kl_factor * torch.nn.functional.kl_div(
-            kl_distr_init, kl_log_probs, log_target=True, reduction="batchmean"
-        )
-        weight_decay = hparams.v_weight_decay * (
-            torch.norm(delta) / torch.norm(target_init) ** 2
-        )
-        # weight_decay = hparams.v_weight_decay * torch.norm(delta) ** 2
-        if args.fact_erasure:
-            pred_prob = torch.exp(-nll_loss)
-            loss = pred_prob + kl_loss + weight_decay
-        else:
-            loss = nll_loss + kl_loss + weight_decay
-        print(
-            f"loss {np.round(loss.item(), 3)} = {np.round(nll_loss.item(), 3)} + {np.round(kl_loss.item(), 3)} + {np.round(weight_decay.item(), 3)} "
-            f"avg prob of [{request['target_new']['str']}] "
-            f"{torch.exp(-nll_loss_each).mean().item()}"
-        )
-        if not args.fact_erasure:
-            if loss < 5e-2:
-                patience_counter += 1
-                if patience_counter >= 5:
+            weight_decay = hparams.v_weight_decay * (
+                torch.norm(delta) / torch.norm(target_init) ** 2
+            )
+            # weight_decay = hparams.v_weight_decay * torch.norm(delta) ** 2
+            if args.fact_erasure:
+                pred_prob = torch.exp(-nll_loss)
+                loss = pred_prob + kl_loss + weight_decay
+            else:
+                loss = nll_loss + kl_loss + weight_decay
+            print(
+                f"loss {np.round(loss.item(), 3)} = {np.round(nll_loss.item(), 3)} + {np.round(kl_loss.item(), 3)} + {np.round(weight_decay.item(), 3)} "
+                f"avg prob of [{request['target_new']['str']}] "
+                f"{torch.exp(-nll_loss_each).mean().item()}"
+            )
+            if not args.fact_erasure:
+                if loss < 5e-2:
+                    patience_counter += 1
+                    if patience_counter >= 5:
+                        break
+                    else:
+                        patience_counter = 0
+
+                if it == hparams.v_num_grad_steps - 1:
                     break
-                else:
-                    patience_counter = 0
-
-            if it == hparams.v_num_grad_steps - 1:
-                break
 
-        # Backpropagate
-        loss.backward()
-        opt.step()
+            # Backpropagate
+            loss.backward()
+            opt.step()
 
-        # Project within L2 ball
-        max_norm = hparams.clamp_norm_factor * target_init.norm()
-        if delta.norm() > max_norm:
-            with torch.no_grad():
-                delta[...] = delta * max_norm / delta.norm()
+            # Project within L2 ball
+            max_norm = hparams.clamp_norm_factor * target_init.norm()
+            if delta.norm() > max_norm:
+                with torch.no_grad():
+                    delta[...] = delta * max_norm / delta.norm()
 
     target = target_init + delta
 
@@ -1,3 +1,4 @@
+import hashlib
 import os
 from pathlib import Path
 
@@ -7,8 +8,19 @@ from tqdm.auto import tqdm
 from transformers import AutoModelForCausalLM, AutoTokenizer
 
 from util.globals import *
-from util.nethook import Trace, set_requires_grad
-from util.runningstats import CombinedStat, Mean, NormMean, SecondMoment, tally
+from util.nethook import TraceDict, set_requires_grad
+from util.runningstats import (
+    CombinedStat,
+    FixedRandomSubsetSampler,
+    FixedSubsetSampler,
+    Mean,
+    NormMean,
+    SecondMoment,
+    Stat,
+    load_cached_state,
+    make_loader,
+    save_cached_state,
+)
 
 from .tok_dataset import (
     TokenizedDataset,
@@ -27,6 +39,12 @@ STAT_TYPES = {
 def main():
     """
     Command-line utility to precompute cached stats.
+
+    All requested layers are collected in a single pass over the dataset.
+    Progress is checkpointed every --checkpoint_every batches, and rerunning
+    the same command resumes from the last checkpoint.  The work can also be
+    split over --num_shards independent jobs, each run with its own --shard,
+    after which a final run with --merge combines the shards.
     """
     import argparse
 
@@ -44,33 +62,55 @@ def main():
     aa("--precision", default="float32", choices=["float64", "float32", "float16"])
     aa("--stats_dir", default=STATS_DIR)
     aa("--download", default=1, type=int, choices=[0, 1])
+    aa("--checkpoint_every", default=100, type=int)
+    aa("--num_shards", default=1, type=int)
+    aa("--shard", default=None, type=int)
+    aa("--merge", action="store_true")
     args = parser.parse_args()
 
     tokenizer = AutoTokenizer.from_pretrained(args.model_name)
     model = AutoModelForCausalLM.from_pretrained(args.model_name).eval().cuda()
     set_requires_grad(False, model)
 
-    for layer_num in args.layers:
-        print(
-            f"Computing stats for layer {layer_num} of {args.model_name} "
-            f'over {args.sample_size or "all"} samples of {args.dataset}. '
-            "Note, the statistics are collected over the inputs to the second MLP layer, "
-            "or equivalently the outputs of the first MLP layer."
-        )
-        proj_layer_name = "c_proj" if "gpt2" in args.model_name else "fc_out"
-        layer_name = f"transformer.h.{layer_num}.mlp.{proj_layer_name}"
+    print(
+        f"Computing stats for layers {args.layers} of {args.model_name} "
+        f'over {args.sample_size or "all"} samples of {args.dataset}. '
+        "Note, the statistics are collected over the inputs to the second MLP layer, "
+        "or equivalently the outputs of the first MLP layer."
+    )
+    proj_layer_name = "c_proj" if "gpt2" in args.model_name else "fc_out"
+    layer_names = [
+        f"transformer.h.{layer_num}.mlp.{proj_layer_name}" for layer_num in args.layers
+    ]
+    stats_args = dict(
+        sample_size=args.sample_size,
+        precision=args.precision,
+        batch_tokens=args.batch_tokens,
+    )
 
-        layer_stats(
+    if args.merge:
+        merge_layer_stats_shards(
+            model,
+            layer_names,
+            args.stats_dir,
+            args.dataset,
+            args.to_collect,
+            args.num_shards,
+            **stats_args,
+        )
+    else:
+        multi_layer_stats(
             model,
             tokenizer,
-            layer_name,
+            layer_names,
             args.stats_dir,
             args.dataset,
             args.to_collect,
-            sample_size=args.sample_size,
-            precision=args.precision,
-            batch_tokens=args.batch_tokens,
             download=args.download,
+            checkpoint_every=args.checkpoint_every,
+            shard=args.shard,
+            num_shards=args.num_shards if args.shard is not None else None,
+            **stats_args,
         )
 
 
@@ -88,82 +128,298 @@ def layer_stats(
     download=True,
     progress=tqdm,
     force_recompute=False,
+    text_dataset=None,
 ):
     """
     Function to load or compute cached stats.
     """
 
-    def get_ds():
-        raw_ds = load_dataset(
-            ds_name,
-            dict(wikitext="wikitext-103-raw-v1", wikipedia="20200501.en")[ds_name],
-        )
-        maxlen = model.config.n_positions
-        if batch_tokens is not None and batch_tokens < maxlen:
-            maxlen = batch_tokens
-        return TokenizedDataset(raw_ds["train"], tokenizer, maxlen=maxlen)
+    return multi_layer_stats(
+        model,
+        tokenizer,
+        [layer_name],
+        stats_dir,
+        ds_name,
+        to_collect,
+        model_name=model_name,
+        sample_size=sample_size,
+        precision=precision,
+        batch_tokens=batch_tokens,
+        download=download,
+        progress=progress,
+        force_recompute=force_recompute,
+        text_dataset=text_dataset,
+    )[layer_name]
 
-    # Continue with computation of statistics
-    batch_size = 100  # Examine this many dataset texts at once
+
+def check_mergeable(to_collect):
+    """
+    Raises ValueError unless every stat in to_collect can be merged across
+    shards, so that a sharded computation fails before it starts.
+    """
+    unmergeable = [k for k in to_collect if STAT_TYPES[k].merge is Stat.merge]
+    if unmergeable:
+        raise ValueError(f"Stats {unmergeable} cannot be computed in shards")
+
+
+def stats_filename(
+    model,
+    layer_name,
+    ds_name,
+    to_collect,
+    model_name=None,
+    sample_size=None,
+    precision=None,
+    batch_tokens=None,
+    shard=None,
+    num_shards=None,
+):
+    """
+    Returns the path of the stats file for one layer, relative to stats_dir.
+    Shards of a sharded computation are stored beside the final file.
+    """
     npos = model.config.n_positions
     if batch_tokens is None:
-        batch_tokens = npos * 3  # Sort and divide into batches with this many tokens
+        batch_tokens = npos * 3
     if precision is None:
         precision = "float64"
-    dtype = getattr(torch, precision)
     size_suffix = "" if sample_size is None else f"_{sample_size}"
     if batch_tokens < npos:
-        size_suffix = "_t{batch_tokens}" + size_suffix
+        size_suffix = f"_t{batch_tokens}" + size_suffix
+    if shard is not None:
+        size_suffix += f"_shard{shard}of{num_shards}"
     if model_name is None:
         model_name = model.config._name_or_path.replace("/", "_")
+    return f"{model_name}/{ds_name}_stats/{layer_name}_{precision}_{'-'.join(sorted(to_collect))}{size_suffix}.npz"
 
-    stats_dir = Path(stats_dir)
-    file_extension = f"{model_name}/{ds_name}_stats/{layer_name}_{precision}_{'-'.join(sorted(to_collect))}{size_suffix}.npz"
-    filename = stats_dir / file_extension
-
-    if not filename.exists() and download:
-        remote_url = f"{REMOTE_ROOT_URL}/data/stats/{file_extension}"
-        try:
-            print(f"Attempting to download {file_extension} from {remote_url}.")
-            (stats_dir / "/".join(file_extension.split("/")[:-1])).mkdir(
-                exist_ok=True, parents=True
+
+def multi_layer_stats(
+    model,
+    tokenizer,
+    layer_names,
+    stats_dir,
+    ds_name,
+    to_collect,
+    model_name=None,
+    sample_size=None,
+    precision=None,
+    batch_tokens=None,
+    download=True,
+    progress=tqdm,
+    force_recompute=False,
+    checkpoint_every=None,
+    shard=None,
+    num_shards=None,
+    text_dataset=None,
+):
+    """
+    Loads or computes cached stats for several layers, returning a dict
+    from layer name to stat.  Every layer that is not already cached is
+    computed in the same pass over the dataset, so the stats of all of
+    them are held on the device at once.
+
+    If checkpoint_every is set, the partial stats are saved every that many
+    batches, and a later call for the same layers resumes from there.
+    If shard is set, only that shard out of num_shards disjoint ranges of
+    the sample is computed and saved to a shard file, to be combined with
+    merge_layer_stats_shards.
+
+    If text_dataset is given, the stats are computed over its "text" items
+    instead of the ds_name dataset, which is then only used to name files.
+    """
+
+    if shard is not None:
+        check_mergeable(to_collect)
+
+    def get_ds():
+        if text_dataset is not None:
+            raw_ds = dict(train=text_dataset)
+        else:
+            raw_ds = load_dataset(
+                ds_name,
+                dict(wikitext="wikitext-103-raw-v1", wikipedia="20200501.en")[ds_name],
             )
-            torch.hub.download_url_to_file(remote_url, filename)
-            print("Successfully downloaded.")
-        except Exception as e:
-            print(f"Unable to download due to {e}. Computing locally....")
+        maxlen = model.config.n_positions
+        if batch_tokens is not None and batch_tokens < maxlen:
+            maxlen = batch_tokens
+        return TokenizedDataset(raw_ds["train"], tokenizer, maxlen=maxlen)
 
-    ds = get_ds() if not filename.exists() else None
+    # Continue with computation of statistics
+    batch_size = 100  # Examine this many dataset texts at once
+    npos = model.config.n_positions
+    collate_tokens = batch_tokens
+    if collate_tokens is None:
+        collate_tokens = npos * 3  # Sort and divide into batches with this many tokens
+    dtype = getattr(torch, precision or "float64")
+    device = next(model.parameters()).device
+
+    stats_dir = Path(stats_dir)
+    file_args = dict(
+        model_name=model_name,
+        sample_size=sample_size,
+        precision=precision,
+        batch_tokens=batch_tokens,
+        shard=shard,
+        num_shards=num_shards,
+    )
+    file_extensions = {
+        layer_name: stats_filename(model, layer_name, ds_name, to_collect, **file_args)
+        for layer_name in layer_names
+    }
+    cache_args = dict(sample_size=sample_size)
+
+    stats = {}
+    missing = []
+    for layer_name, file_extension in file_extensions.items():
+        filename = stats_dir / file_extension
+        if not filename.exists() and download and shard is None:
+            remote_url = f"{REMOTE_ROOT_URL}/data/stats/{file_extension}"
+            try:
+                print(f"Attempting to download {file_extension} from {remote_url}.")
+                filename.parent.mkdir(exist_ok=True, parents=True)
+                torch.hub.download_url_to_file(remote_url, filename)
+                print("Successfully downloaded.")
+            except Exception as e:
+                print(f"Unable to download due to {e}. Computing locally....")
+        stats[layer_name] = CombinedStat(**{k: STAT_TYPES[k]() for k in to_collect})
+        cached_state = (
+            load_cached_state(filename, cache_args) if not force_recompute else None
+        )
+        if cached_state is not None:
+            stats[layer_name].load_state_dict(cached_state)
+        else:
+            missing.append(layer_name)
+    if not missing:
+        return stats
+    # TraceDict stops after the last listed layer, so list them in execution order.
+    module_order = {n: i for i, (n, _) in enumerate(model.named_modules())}
+    missing.sort(key=lambda layer_name: module_order[layer_name])
 
+    ds = get_ds()
     if progress is None:
-        progress = lambda x: x
+        progress = lambda x, **k: x
+
+    # Determine which slice of the (shuffled) sample this pass covers.
+    total = len(ds) if sample_size is None else min(sample_size, len(ds))
+    start, end = 0, total
+    if shard is not None:
+        start, end = total * shard // num_shards, total * (shard + 1) // num_shards
+
+    # Resume from a checkpoint of this same pass, if one exists.
+    combined = CombinedStat(**{layer_name: stats[layer_name] for layer_name in missing})
+    ckpt_args = dict(cache_args, start=start, end=end)
+    ckpt_key = hashlib.md5(",".join(missing).encode()).hexdigest()[:8]
+    ckpt_filename = (stats_dir / file_extensions[missing[0]]).with_name(
+        f"checkpoint_{ckpt_key}_{Path(file_extensions[missing[0]]).name}"
+    )
+    done = 0
+    if checkpoint_every is not None and not force_recompute:
+        ckpt_state = load_cached_state(ckpt_filename, ckpt_args)
+        if ckpt_state is not None:
+            combined.load_state_dict(ckpt_state)
+            combined.to_(device)
+            done = int(ckpt_state["done"])
+            print(f"Resuming from item {start + done} of {start}-{end}")
 
-    stat = CombinedStat(**{k: STAT_TYPES[k]() for k in to_collect})
-    loader = tally(
-        stat,
+    if sample_size is None:
+        sampler = FixedSubsetSampler(list(range(start + done, end)))
+    else:
+        sampler = FixedRandomSubsetSampler(ds, start=start + done, end=end, seed=1)
+    loader = make_loader(
         ds,
-        cache=filename if not force_recompute else None,
-        sample_size=sample_size,
+        sampler=sampler,
         batch_size=batch_size,
-        collate_fn=length_collation(batch_tokens),
+        collate_fn=length_collation(collate_tokens),
         pin_memory=True,
-        random_sample=1,
         num_workers=2,
     )
-    batch_count = -(-(sample_size or len(ds)) // batch_size)
+    batch_count = -(-len(sampler) // batch_size)
     with torch.no_grad():
-        for batch_group in progress(loader, total=batch_count):
+        for batch_num, batch_group in enumerate(progress(loader, total=batch_count)):
             for batch in batch_group:
-                batch = dict_to_(batch, "cuda")
-                with Trace(
-                    model, layer_name, retain_input=True, retain_output=False, stop=True
+                batch = dict_to_(batch, device)
+                with TraceDict(
+                    model, missing, retain_input=True, retain_output=False, stop=True
                 ) as tr:
                     model(**batch)
-                feats = flatten_masked_batch(tr.input, batch["attention_mask"])
-                # feats = flatten_masked_batch(tr.output, batch["attention_mask"])
-                feats = feats.to(dtype=dtype)
-                stat.add(feats)
-    return stat
+                for layer_name in missing:
+                    feats = flatten_masked_batch(
+                        tr[layer_name].input, batch["attention_mask"]
+                    )
+                    feats = feats.to(dtype=dtype)
+                    stats[layer_name].add(feats)
+            done = min(done + batch_size, end - start)
+            if checkpoint_every is not None and (batch_num + 1) % checkpoint_every == 0:
+                save_checkpoint(ckpt_filename, combined, dict(ckpt_args, done=done))
+
+    for layer_name in missing:
+        stats[layer_name].to_(device="cpu")
+        args = cache_args if shard is None else ckpt_args
+        save_cached_state(stats_dir / file_extensions[layer_name], stats[layer_name], args)
+    if ckpt_filename.exists():
+        os.remove(ckpt_filename)
+    return stats
+
+
+def save_checkpoint(filename, stat, args):
+    """
+    Saves a stat with its progress so that a killed job can resume.  The
+    file is written under a temporary name first, so that a checkpoint is
+    never left half-written.
+    """
+    tmp_filename = filename.with_name("tmp_" + filename.name)
+    save_cached_state(str(tmp_filename), stat, args)
+    os.replace(tmp_filename, filename)
+
+
+def merge_layer_stats_shards(
+    model,
+    layer_names,
+    stats_dir,
+    ds_name,
+    to_collect,
+    num_shards,
+    model_name=None,
+    sample_size=None,
+    precision=None,
+    batch_tokens=None,
+):
+    """
+    Combines the shard files written by multi_layer_stats(shard=i, ...) for
+    i in range(num_shards) into the final stats file for each layer, and
+    returns a dict from layer name to the merged stat.
+    """
+    check_mergeable(to_collect)
+    stats_dir = Path(stats_dir)
+    file_args = dict(
+        model_name=model_name,
+        sample_size=sample_size,
+        precision=precision,
+        batch_tokens=batch_tokens,
+    )
+    stats = {}
+    for layer_name in layer_names:
+        stat = CombinedStat(**{k: STAT_TYPES[k]() for k in to_collect})
+        for shard in range(num_shards):
+            shard_filename = stats_dir / stats_filename(
+                model,
+                layer_name,
+                ds_name,
+                to_collect,
+                shard=shard,
+                num_shards=num_shards,
+                **file_args,
+            )
+            shard_stat = CombinedStat(**{k: STAT_TYPES[k]() for k in to_collect})
+            shard_stat.load_state_dict(
+                load_cached_state(shard_filename, {}, quiet=True, throw=True)
+            )
+            stat.merge(shard_stat)
+        filename = stats_dir / stats_filename(model, layer_name, ds_name, to_collect, **file_args)
+        save_cached_state(filename, stat, dict(sample_size=sample_size))
+        print(f"Merged {num_shards} shards into {filename}")
+        stats[layer_name] = stat
+    return stats
 
 
 if __name__ == "__main__":
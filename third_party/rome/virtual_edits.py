@@ -0,0 +1,126 @@
+import contextlib
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import torch
+from transformers import AutoModelForCausalLM
+
+from util import nethook
+
+
+class VirtualEdits(contextlib.AbstractContextManager):
+    """
+    Applies rank-one ROME deltas through forward hooks on the rewritten
+    modules instead of writing them into the weights, so that the weights
+    never change and several independently edited models can be scored in
+    one batched forward pass:
+
+        deltas_list = [execute_rome(args, model, tok, r, hparams) for r in requests]
+        with VirtualEdits(model, deltas_list) as ve:
+            ve.select([0, 0, 1, 1, None, None])  # one edit (or None) per batch row
+            logits = model(**batch).logits
+
+    Each deltas dict maps weight names to the (u, v) factors returned by
+    execute_rome.  For a row under edit k, the hook adds exactly the change
+    in output that apply_rome_to_model would make by adding u v^T to the
+    weights.  select(k) applies edit k to every row, whatever the batch
+    size, and select(None) leaves the model unedited.
+    """
+
+    def __init__(
+        self,
+        model: AutoModelForCausalLM,
+        deltas_list: List[Dict[str, Tuple[torch.Tensor, torch.Tensor]]],
+    ):
+        self.edit_ids = None
+        self.num_edits = len(deltas_list)
+
+        by_module = {}
+        for k, deltas in enumerate(deltas_list):
+            for w_name, (delta_u, delta_v) in deltas.items():
+                assert w_name.endswith(".weight"), f"{w_name} is not a weight"
+                module_name = w_name[: -len(".weight")]
+                by_module.setdefault(module_name, []).append((k, delta_u, delta_v))
+
+        # Stack the factors of all edits, with a final all-zero row for "no edit".
+        self.factors = {}
+        for module_name, edits in by_module.items():
+            module = nethook.get_module(model, module_name)
+            keys, values = None, None
+            for k, delta_u, delta_v in edits:
+                key, value = rank_one_key_value(module, delta_u, delta_v)
+                if keys is None:
+                    keys = key.new_zeros(self.num_edits + 1, key.shape[0])
+                    values = value.new_zeros(self.num_edits + 1, value.shape[0])
+                keys[k] = key
+                values[k] = value
+            self.factors[module_name] = (keys, values)
+
+        self.registered_hooks = [
+            nethook.get_module(model, module_name).register_forward_hook(
+                self.make_hook(module_name)
+            )
+            for module_name in self.factors
+        ]
+
+    def select(self, edit_ids: Union[None, int, Sequence[Optional[int]]]):
+        """
+        Chooses the edit to apply: None for the unedited model, an int for
+        the same edit on every row, or a list with one entry per batch row.
+        """
+        if edit_ids is None or isinstance(edit_ids, int):
+            self.edit_ids = edit_ids
+        else:
+            self.edit_ids = torch.tensor(
+                [self.num_edits if k is None else k for k in edit_ids]
+            )
+        return self
+
+    def make_hook(self, module_name):
+        def hook(m, inputs, output):
+            if self.edit_ids is None:
+                return output
+            keys, values = self.factors[module_name]
+            x = inputs[0]
+            if isinstance(self.edit_ids, int):
+                key, value = keys[self.edit_ids], values[self.edit_ids]
+                coeff = x @ key.to(x.dtype)
+                return output + coeff[..., None] * value.to(output.dtype)
+            assert len(self.edit_ids) == x.shape[0], (
+                f"{len(self.edit_ids)} edit ids selected for a batch of {x.shape[0]}"
+            )
+            edit_ids = self.edit_ids.to(keys.device)
+            row_keys, row_values = keys[edit_ids], values[edit_ids]
+            coeff = torch.einsum("b...d,bd->b...", x, row_keys.to(x.dtype))
+            row_values = row_values.view(
+                row_values.shape[:1] + (1,) * (output.dim() - 2) + row_values.shape[1:]
+            )
+            return output + coeff[..., None] * row_values.to(output.dtype)
+
+        return hook
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        for h in self.registered_hooks:
+            h.remove()
+        self.registered_hooks = []
+
+
+def rank_one_key_value(
+    module: torch.nn.Module, delta_u: torch.Tensor, delta_v: torch.Tensor
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Returns (key, value) such that adding upd_matrix_match_shape(u v^T) to
+    the module's weight adds (x . key) * value to its output for input x.
+    GPT-2 Conv1D weights are (in, out) while nn.Linear weights are (out, in).
+    """
+    weight_shape = tuple(module.weight.shape)
+    kept_as_is = (delta_u.shape[0], delta_v.shape[0]) == weight_shape
+    out_by_in = isinstance(module, torch.nn.Linear)
+    if kept_as_is != out_by_in:
+        return delta_u, delta_v
+    return delta_v, delta_u
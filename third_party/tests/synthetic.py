@@ -0,0 +1,143 @@
+"""
+Synthetic CounterFact-style facts, a tokenizer trained on them and small,
+randomly initialized GPT-2 and GPT-J models, so that the tests run offline
+and on the cpu.
+"""
+
+import numpy as np
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from transformers import (
+    AutoModelForCausalLM,
+    GPT2Config,
+    GPTJConfig,
+    PreTrainedTokenizerFast,
+)
+
+from rome.rome_hparams import ROMEHyperParams
+from util import nethook
+
+SYLLABLES = ["ka", "lo", "mi", "ren", "tos", "vel", "dar", "shi", "po", "ne", "gu", "bra"]
+RELATIONS = [
+    "{} is located in",
+    "{} was born in",
+    "The native language of {} is",
+    "{} works in the field of",
+    "{} is a citizen of",
+]
+ARCH_MODULES = dict(
+    gpt2=dict(rewrite_module_tmp="transformer.h.{}.mlp.c_proj", lm_head_module="transformer.wte"),
+    gptj=dict(rewrite_module_tmp="transformer.h.{}.mlp.fc_out", lm_head_module="lm_head"),
+)
+def make_word(prng, capitalize=True):
+    word = "".join(prng.choice(SYLLABLES, size=prng.randint(2, 4)))
+    return word.capitalize() if capitalize else word
+
+
+def make_facts(num_facts, seed=0):
+    """
+    Returns num_facts synthetic records in the format of CounterFact, about
+    made-up subjects of one or two words, and a corpus of texts mentioning them.
+    """
+    prng = np.random.RandomState(seed)
+    subjects = [
+        " ".join(make_word(prng) for _ in range(prng.randint(1, 3))) for _ in range(num_facts)
+    ]
+    facts, corpus = [], []
+    for i, subject in enumerate(subjects):
+        relation = RELATIONS[i % len(RELATIONS)]
+        target_true, target_new = make_word(prng), make_word(prng)
+        neighbors = [s for s in subjects if s != subject][:3]
+        facts.append(
+            dict(
+                case_id=i,
+                requested_rewrite=dict(
+                    prompt=relation,
+                    subject=subject,
+                    target_true=dict(str=target_true),
+                    target_new=dict(str=target_new),
+                ),
+                paraphrase_prompts=[
+                    f"{make_word(prng)} {make_word(prng, False)}. " + relation.format(subject),
+                    "As everyone knows, " + relation.format(subject),
+                ],
+                neighborhood_prompts=[relation.format(s) for s in neighbors],
+            )
+        )
+        corpus.append(f"{relation.format(subject)} {target_true}.")
+        corpus.append(
+            " ".join(make_word(prng, j == 0) for j in range(prng.randint(8, 40))) + "."
+        )
+    return facts, corpus
+
+
+def make_tokenizer(corpus, vocab_size):
+    """
+    Trains a byte-level BPE tokenizer like GPT-2's on corpus.
+    """
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=vocab_size,
+        special_tokens=["<|endoftext|>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    )
+    tokenizer.train_from_iterator(corpus, trainer)
+    tok = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        bos_token="<|endoftext|>",
+        eos_token="<|endoftext|>",
+        unk_token="<|endoftext|>",
+    )
+    tok.pad_token = tok.eos_token
+    return tok
+
+
+def make_model(arch, tok, n_layer, n_embd, n_head, n_positions, device, seed=0):
+    """
+    Returns a randomly initialized model of the given architecture.
+    """
+    config_args = dict(
+        vocab_size=len(tok),
+        n_positions=n_positions,
+        n_embd=n_embd,
+        n_layer=n_layer,
+        n_head=n_head,
+        bos_token_id=tok.bos_token_id,
+        eos_token_id=tok.eos_token_id,
+    )
+    if arch == "gpt2":
+        config = GPT2Config(**config_args)
+    elif arch == "gptj":
+        config = GPTJConfig(rotary_dim=n_embd // n_head // 2, **config_args)
+    else:
+        raise ValueError(f"Unknown architecture {arch}")
+    torch.manual_seed(seed)
+    model = AutoModelForCausalLM.from_config(config)
+    nethook.set_requires_grad(False, model)
+    return model.eval().to(device)
+
+
+def make_hparams(arch, n_layer, v_num_grad_steps):
+    return ROMEHyperParams(
+        layers=[n_layer // 2],
+        fact_token="subject_last",
+        v_num_grad_steps=v_num_grad_steps,
+        v_lr=5e-1,
+        v_loss_layer=n_layer - 1,
+        v_weight_decay=0.5,
+        clamp_norm_factor=4,
+        kl_factor=0.0625,
+        mom2_adjustment=False,
+        context_template_length_params=[[5, 10], [10, 10]],
+        layer_module_tmp="transformer.h.{}",
+        mlp_module_tmp="transformer.h.{}.mlp",
+        attn_module_tmp="transformer.h.{}.attn",
+        ln_f_module="transformer.ln_f",
+        mom2_dataset="wikitext",
+        mom2_n_samples=100000,
+        mom2_dtype="float32",
+        editing_noise=0.1,
+        **ARCH_MODULES[arch],
+    )
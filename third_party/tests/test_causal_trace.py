@@ -0,0 +1,26 @@
+import pytest
+import torch
+
+from experiments.causal_trace import calculate_hidden_flow
+
+
+@pytest.mark.parametrize("kind", [None, "mlp", "attn"])
+def test_batched_hidden_flow_matches_unbatched(tiny_mt, synthetic_facts, kind):
+    facts, _ = synthetic_facts
+    for fact in facts[:2]:
+        r = fact["requested_rewrite"]
+        args = dict(
+            prompt=r["prompt"].format(r["subject"]),
+            subject=r["subject"],
+            target=r["target_true"]["str"],
+            samples=3,
+            window=2,
+            kind=kind,
+        )
+        unbatched = calculate_hidden_flow(tiny_mt, **args)
+        # 7 rows fit two cells of 3 samples per pass, so the grid is traced in several chunks
+        batched = calculate_hidden_flow(tiny_mt, max_batch_rows=7, **args)
+        assert batched["scores"].shape == unbatched["scores"].shape
+        assert torch.allclose(batched["scores"], unbatched["scores"], rtol=1e-4, atol=1e-6)
+        assert batched["low_score"] == unbatched["low_score"]
+        assert batched["base_score"] == unbatched["base_score"]
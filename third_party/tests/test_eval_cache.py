@@ -0,0 +1,47 @@
+import json
+import os
+
+import numpy
+import torch
+
+from util.eval_cache import EvalCache
+
+
+def test_get_or_compute(tmp_path):
+    cache = EvalCache(tmp_path)
+    key = dict(kind="pre", model="tiny", case_id=3)
+    assert cache.get_or_compute(key, lambda: dict(score=0.5)) == dict(score=0.5)
+    assert cache.get_or_compute(key, lambda: dict(score=1.0)) == dict(score=0.5)
+    assert cache.get(dict(key, case_id=4)) is None
+
+
+def test_entry_for_another_key_is_a_miss(tmp_path):
+    cache = EvalCache(tmp_path)
+    key, other = dict(kind="pre", case_id=1), dict(kind="pre", case_id=2)
+    cache.put(other, "other value")
+    # Put other's entry where key's entry would be, as a hash collision would.
+    with open(cache.path(other), "r") as f:
+        entry = json.load(f)
+    path = cache.path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(entry, f)
+    assert cache.get(key) is None
+    assert cache.get(other) == "other value"
+
+
+def test_miss_and_hit_return_the_same_types(tmp_path):
+    cache = EvalCache(tmp_path)
+    key = dict(kind="pre", case_id=0)
+    value = dict(prob=numpy.float32(0.25), pair=(1, 2), scores=torch.tensor([0.5, 1.5]))
+    computed = cache.get_or_compute(key, lambda: value)
+    read = cache.get_or_compute(key, lambda: value)
+    assert computed == read == dict(prob=0.25, pair=[1, 2], scores=[0.5, 1.5])
+
+
+def test_overwriting_an_entry_does_not_count_it_twice(tmp_path):
+    cache = EvalCache(tmp_path)
+    key = dict(kind="pre", case_id=0)
+    cache.put(key, "a" * 100)
+    cache.put(key, "b" * 100)
+    assert cache._size == cache.size()
@@ -0,0 +1,79 @@
+from argparse import Namespace
+
+import pytest
+
+from experiments.py.eval_utils_counterfact import test_batch_prediction_groups as batch_prediction_groups
+from tests.synthetic import make_hparams
+
+
+def make_groups(facts):
+    groups = []
+    for fact in facts:
+        r = fact["requested_rewrite"]
+        groups.append(
+            dict(
+                prefixes=[r["prompt"].format(r["subject"])] + fact["paraphrase_prompts"],
+                target_new=r["target_new"]["str"],
+                request_baseline=r["target_true"]["str"],
+                subject=r["subject"],
+            )
+        )
+    return groups
+
+
+def make_args(mt, fact_forcing, noise_all_prefix_rows=False):
+    hparams = make_hparams(mt.model.config.model_type, mt.num_layers, v_num_grad_steps=1)
+    hparams.editing_noise = 1.0
+    return Namespace(
+        fact_forcing=fact_forcing,
+        weight_based_tracing=False,
+        noise_all_prefix_rows=noise_all_prefix_rows,
+        hparams=hparams,
+    )
+
+
+def row_nlls(group_results):
+    # in batch order: target_new then request_baseline for each prefix
+    return [row[k] for row in group_results for k in ["target_new", "request_baseline"]]
+
+
+def test_every_row_of_a_prefix_is_noised(tiny_mt, synthetic_facts):
+    facts, _ = synthetic_facts
+    groups = make_groups(facts[:2])
+    clean = batch_prediction_groups(make_args(tiny_mt, False), tiny_mt.model, tiny_mt.tokenizer, groups)
+    noised = batch_prediction_groups(
+        make_args(tiny_mt, True, noise_all_prefix_rows=True), tiny_mt.model, tiny_mt.tokenizer, groups
+    )
+    for clean_group, noised_group in zip(clean, noised):
+        for clean_row, noised_row in zip(clean_group, noised_group):
+            # Both the target_new and the request_baseline row of each prefix are noised.
+            assert clean_row["target_new"] != noised_row["target_new"]
+            assert clean_row["request_baseline"] != noised_row["request_baseline"]
+
+
+def test_default_noises_the_first_rows_only(tiny_mt, synthetic_facts):
+    facts, _ = synthetic_facts
+    groups = make_groups(facts[:2])
+    clean = batch_prediction_groups(make_args(tiny_mt, False), tiny_mt.model, tiny_mt.tokenizer, groups)
+    noised = batch_prediction_groups(make_args(tiny_mt, True), tiny_mt.model, tiny_mt.tokenizer, groups)
+    for group, clean_group, noised_group in zip(groups, clean, noised):
+        num_prefixes = len(group["prefixes"])
+        for i, (clean_nll, noised_nll) in enumerate(zip(row_nlls(clean_group), row_nlls(noised_group))):
+            # The original row mapping: only rows 0..len(prefixes)-1 of a group are noised.
+            if i < num_prefixes:
+                assert clean_nll != noised_nll
+            else:
+                assert clean_nll == noised_nll
+
+
+@pytest.mark.parametrize("fact_forcing,noise_all_prefix_rows", [(False, False), (True, False), (True, True)])
+def test_packed_groups_match_separate_groups(tiny_mt, synthetic_facts, fact_forcing, noise_all_prefix_rows):
+    facts, _ = synthetic_facts
+    groups = make_groups(facts[:3])
+    args = make_args(tiny_mt, fact_forcing, noise_all_prefix_rows)
+    packed = batch_prediction_groups(args, tiny_mt.model, tiny_mt.tokenizer, groups, max_batch_rows=64)
+    for group, packed_group in zip(groups, packed):
+        [separate_group] = batch_prediction_groups(args, tiny_mt.model, tiny_mt.tokenizer, [group])
+        for packed_row, separate_row in zip(packed_group, separate_group):
+            for k in ["target_new", "request_baseline"]:
+                assert packed_row[k] == pytest.approx(separate_row[k], rel=1e-4)
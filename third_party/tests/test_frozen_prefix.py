@@ -0,0 +1,90 @@
+import contextlib
+from argparse import Namespace
+
+import pytest
+import torch
+
+from memit.compute_z import compute_z
+from memit.memit_hparams import MEMITHyperParams
+from rome.compute_u import compute_u
+from rome.compute_v import compute_v
+from tests.synthetic import make_hparams
+from util import nethook
+
+ARGS = Namespace(fact_forcing=False, fact_erasure=False, weight_based_tracing=False)
+CONTEXT_TEMPLATES = ["{}", "Kalo mitos renvel. {}"]
+
+
+def without_frozen_prefix(monkeypatch):
+    monkeypatch.setattr(nethook, "FrozenPrefix", lambda module, layers=None: contextlib.nullcontext())
+
+
+def rome_hparams(mt):
+    return make_hparams(mt.model.config.model_type, mt.num_layers, v_num_grad_steps=4)
+
+
+def memit_hparams(mt):
+    hparams = rome_hparams(mt)
+    return MEMITHyperParams(
+        layers=hparams.layers,
+        layer_selection="all",
+        fact_token=hparams.fact_token,
+        v_num_grad_steps=hparams.v_num_grad_steps,
+        v_lr=hparams.v_lr,
+        v_loss_layer=hparams.v_loss_layer,
+        v_weight_decay=hparams.v_weight_decay,
+        clamp_norm_factor=hparams.clamp_norm_factor,
+        kl_factor=hparams.kl_factor,
+        mom2_adjustment=False,
+        mom2_update_weight=20000,
+        editing_noise=hparams.editing_noise,
+        rewrite_module_tmp=hparams.rewrite_module_tmp,
+        layer_module_tmp=hparams.layer_module_tmp,
+        mlp_module_tmp=hparams.mlp_module_tmp,
+        attn_module_tmp=hparams.attn_module_tmp,
+        ln_f_module=hparams.ln_f_module,
+        lm_head_module=hparams.lm_head_module,
+        mom2_dataset=hparams.mom2_dataset,
+        mom2_n_samples=hparams.mom2_n_samples,
+        mom2_dtype=hparams.mom2_dtype,
+    )
+
+
+def test_frozen_prefix_none_layers(tiny_mt):
+    with nethook.FrozenPrefix(tiny_mt.model, None) as frozen:
+        assert frozen.patched == []
+
+
+def test_frozen_copy_clones_nested_outputs():
+    x = torch.ones(2, requires_grad=True)
+    output = (x * 2, None, {"past": [x * 3]})
+    copied = nethook.frozen_copy(output, detach=True)
+    assert copied[1] is None
+    assert torch.equal(copied[0], output[0]) and not copied[0].requires_grad
+    assert copied[2]["past"][0] is not output[2]["past"][0]
+    # recursive_copy, used by Trace and TraceDict, still leaves nested values alone.
+    assert nethook.recursive_copy(output[2], clone=True)["past"][0] is output[2]["past"][0]
+
+
+def test_compute_v_frozen_matches_unfrozen(tiny_mt, synthetic_facts, monkeypatch):
+    facts, _ = synthetic_facts
+    hparams = rome_hparams(tiny_mt)
+    layer = hparams.layers[0]
+    request = facts[0]["requested_rewrite"]
+    u = compute_u(ARGS, tiny_mt.model, tiny_mt.tokenizer, request, hparams, layer, CONTEXT_TEMPLATES)
+    frozen = compute_v(ARGS, tiny_mt.model, tiny_mt.tokenizer, request, hparams, layer, u, CONTEXT_TEMPLATES)
+    without_frozen_prefix(monkeypatch)
+    unfrozen = compute_v(ARGS, tiny_mt.model, tiny_mt.tokenizer, request, hparams, layer, u, CONTEXT_TEMPLATES)
+    assert torch.allclose(frozen, unfrozen, rtol=1e-5, atol=1e-6)
+
+
+def test_compute_z_frozen_matches_unfrozen(tiny_mt, synthetic_facts, monkeypatch):
+    facts, _ = synthetic_facts
+    hparams = memit_hparams(tiny_mt)
+    layer = hparams.layers[0]
+    request = facts[1]["requested_rewrite"]
+    context_templates = [CONTEXT_TEMPLATES]
+    frozen = compute_z(ARGS, tiny_mt.model, tiny_mt.tokenizer, request, hparams, layer, context_templates)
+    without_frozen_prefix(monkeypatch)
+    unfrozen = compute_z(ARGS, tiny_mt.model, tiny_mt.tokenizer, request, hparams, layer, context_templates)
+    assert torch.allclose(frozen, unfrozen, rtol=1e-5, atol=1e-6)
@@ -0,0 +1,80 @@
+import unicodedata
+
+import pytest
+import torch
+
+from util.generate import generate_fast
+
+
+def baseline_generate_fast(model, tok, prompts, n_gen_per_prompt=1, top_k=5, max_out_len=200):
+    """
+    generate_fast as it was before it was rewritten, for regression tests.
+    """
+    inp = [prompt for prompt in prompts for _ in range(n_gen_per_prompt)]
+    inp_tok = tok(inp, padding=True, return_tensors="pt").to(next(model.parameters()).device)
+    input_ids, attention_mask = inp_tok["input_ids"], inp_tok["attention_mask"]
+    batch_size = input_ids.size(0)
+    past_key_values, cur_context = None, slice(0, attention_mask.sum(1).min().item())
+    with torch.no_grad():
+        while input_ids.size(1) < max_out_len:
+            model_out = model(
+                input_ids=input_ids[:, cur_context],
+                attention_mask=attention_mask[:, cur_context],
+                past_key_values=past_key_values,
+                use_cache=True,
+            )
+            logits, past_key_values = model_out.logits, model_out.past_key_values
+            softmax_out = torch.nn.functional.softmax(logits[:, -1, :], dim=1)
+            tk = torch.topk(softmax_out, top_k, dim=1).indices
+            softmax_out_top_k = torch.gather(softmax_out, 1, tk)
+            softmax_out_top_k = softmax_out_top_k / softmax_out_top_k.sum(1)[:, None]
+            new_tok_indices = torch.multinomial(softmax_out_top_k, 1)
+            new_toks = torch.gather(tk, 1, new_tok_indices)
+            if cur_context.stop == input_ids.size(1):
+                attention_mask = torch.cat(
+                    [attention_mask, attention_mask.new_zeros(batch_size, 1)], dim=1
+                )
+                input_ids = torch.cat(
+                    [input_ids, input_ids.new_ones(batch_size, 1) * tok.pad_token_id], dim=1
+                )
+            last_non_masked = attention_mask.sum(1) - 1
+            for i in range(batch_size):
+                new_idx = last_non_masked[i] + 1
+                if last_non_masked[i].item() + 1 != cur_context.stop:
+                    continue
+                if new_idx < max_out_len:
+                    input_ids[i][new_idx] = new_toks[i]
+                    attention_mask[i][new_idx] = 1
+            cur_context = slice(cur_context.stop, cur_context.stop + 1)
+    txt = [tok.decode(x) for x in input_ids.detach().cpu().numpy().tolist()]
+    return [
+        unicodedata.normalize("NFKD", x).replace("\n\n", " ").replace("<|endoftext|>", "")
+        for x in txt
+    ]
+
+
+@pytest.mark.parametrize(
+    "n_gen_per_prompt,max_out_len", [(1, 20), (5, 20), (3, 4), (2, 1)]
+)
+def test_generate_fast_matches_baseline(tiny_mt, synthetic_facts, n_gen_per_prompt, max_out_len):
+    facts, _ = synthetic_facts
+    # Prompts of different lengths, so that some rows are still in their prompt
+    # while others are already generating.
+    prompts = [f["requested_rewrite"]["prompt"].format(f["requested_rewrite"]["subject"]) for f in facts[:4]]
+    prompts.append(tiny_mt.tokenizer.eos_token)
+    args = dict(n_gen_per_prompt=n_gen_per_prompt, max_out_len=max_out_len)
+    torch.manual_seed(1)
+    expected = baseline_generate_fast(tiny_mt.model, tiny_mt.tokenizer, prompts, **args)
+    torch.manual_seed(1)
+    assert generate_fast(tiny_mt.model, tiny_mt.tokenizer, prompts, **args) == expected
+
+
+def test_generate_fast_stops_at_eos(tiny_mt, synthetic_facts):
+    facts, _ = synthetic_facts
+    tok = tiny_mt.tokenizer
+    prompts = [facts[0]["requested_rewrite"]["prompt"].format(facts[0]["requested_rewrite"]["subject"])]
+    torch.manual_seed(1)
+    texts = generate_fast(tiny_mt.model, tok, prompts, n_gen_per_prompt=8, max_out_len=30, stop_at_eos=True)
+    assert len(texts) == 8
+    for text in texts:
+        assert len(tok.encode(text)) <= 30
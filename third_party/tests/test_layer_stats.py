@@ -0,0 +1,105 @@
+import pytest
+import torch
+
+from rome.layer_stats import merge_layer_stats_shards, multi_layer_stats, stats_filename
+from tests.synthetic import make_facts
+
+TO_COLLECT = ["mom2", "mean"]
+
+
+class Interrupted(Exception):
+    pass
+
+
+@pytest.fixture(scope="module")
+def texts():
+    # Enough texts for several loader batches of 100.
+    _, corpus = make_facts(150, seed=1)
+    return [dict(text=text) for text in corpus]
+
+
+def collect(mt, stats_dir, texts, to_collect=TO_COLLECT, **kwargs):
+    layer_names = [f"transformer.h.{l}.mlp" for l in range(mt.num_layers)][1:3]
+    stats = multi_layer_stats(
+        mt.model,
+        mt.tokenizer,
+        layer_names,
+        stats_dir,
+        "wikitext",
+        to_collect,
+        model_name="tiny",
+        precision="float64",
+        download=False,
+        progress=kwargs.pop("progress", None),
+        text_dataset=texts,
+        **kwargs,
+    )
+    return layer_names, stats
+
+
+def assert_stats_match(a, b):
+    assert a.mom2.count == b.mom2.count
+    assert torch.allclose(a.mom2.moment(), b.mom2.moment(), rtol=1e-10)
+    assert a.mean.count == b.mean.count
+    # Mean.merge is a Chan-style update, so it only matches up to rounding.
+    assert torch.allclose(a.mean.mean(), b.mean.mean(), rtol=1e-8, atol=1e-10)
+
+
+def test_stats_filename_batch_tokens(tiny_mt):
+    names = {
+        stats_filename(tiny_mt.model, "layer", "wikitext", TO_COLLECT, model_name="tiny", batch_tokens=t)
+        for t in [16, 32]
+    }
+    assert len(names) == 2
+    assert all("{" not in name for name in names)
+
+
+def test_sharded_stats_match_single_pass(tiny_mt, texts, tmp_path):
+    layer_names, single = collect(tiny_mt, tmp_path / "single", texts)
+    for shard in range(3):
+        collect(tiny_mt, tmp_path / "sharded", texts, shard=shard, num_shards=3)
+    merged = merge_layer_stats_shards(
+        tiny_mt.model,
+        layer_names,
+        tmp_path / "sharded",
+        "wikitext",
+        TO_COLLECT,
+        3,
+        model_name="tiny",
+        precision="float64",
+    )
+    for layer_name in layer_names:
+        assert_stats_match(merged[layer_name], single[layer_name])
+
+
+def test_resumed_stats_match_single_pass(tiny_mt, texts, tmp_path):
+    layer_names, single = collect(tiny_mt, tmp_path / "single", texts)
+
+    def interrupt_after_first_batch(loader, **kwargs):
+        for i, batch_group in enumerate(loader):
+            if i == 1:
+                raise Interrupted()
+            yield batch_group
+
+    with pytest.raises(Interrupted):
+        collect(
+            tiny_mt,
+            tmp_path / "resumed",
+            texts,
+            checkpoint_every=1,
+            progress=interrupt_after_first_batch,
+        )
+    _, resumed = collect(tiny_mt, tmp_path / "resumed", texts, checkpoint_every=1)
+    for layer_name in layer_names:
+        assert_stats_match(resumed[layer_name], single[layer_name])
+
+
+def test_unmergeable_stats_are_rejected(tiny_mt, texts, tmp_path, monkeypatch):
+    from rome import layer_stats
+    from util.runningstats import Variance
+
+    monkeypatch.setitem(layer_stats.STAT_TYPES, "var", Variance)
+    with pytest.raises(ValueError):
+        collect(tiny_mt, tmp_path, texts[:10], to_collect=["var"], shard=0, num_shards=2)
+    with pytest.raises(ValueError):
+        merge_layer_stats_shards(tiny_mt.model, ["transformer.h.0.mlp"], tmp_path, "wikitext", ["var"], 2)
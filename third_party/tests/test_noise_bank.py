@@ -0,0 +1,99 @@
+from argparse import Namespace
+
+import numpy as np
+import pytest
+import torch
+
+import experiments.causal_trace as causal_trace
+import experiments.py.eval_utils_counterfact as eval_utils_counterfact
+from experiments.causal_trace import find_token_range, layername, make_inputs
+from util.noise_bank import NoiseBank
+
+
+class OldNoiseStream:
+    """
+    The noise the code drew before NoiseBank: a fresh np.random.RandomState(1)
+    per call of a noising function (the draw=0 call), from which every forward
+    pass draws the next array of whatever shape it needs.
+    """
+
+    def __init__(self):
+        self.rs = None
+
+    def __call__(self, shape, device, scale=1.0, seed=1, draw=0, uniform=False):
+        if draw == 0:
+            self.rs = np.random.RandomState(seed)
+        sample = self.rs.uniform(-1, 1, shape) if uniform else self.rs.randn(*shape)
+        return scale * torch.from_numpy(sample).to(device)
+
+
+@pytest.mark.parametrize("uniform", [False, True])
+def test_draws_match_a_random_state(uniform):
+    bank = NoiseBank(max_entries=2)
+    rs = np.random.RandomState(1)
+    expected = [
+        0.7 * torch.from_numpy(rs.uniform(-1, 1, (3, 2, 5)) if uniform else rs.randn(3, 2, 5))
+        for _ in range(4)
+    ]
+    for draw in range(4):
+        assert torch.equal(bank.get((3, 2, 5), "cpu", scale=0.7, draw=draw, uniform=uniform), expected[draw])
+    # Evicted draws are replayed from the start of the stream.
+    assert torch.equal(bank.get((3, 2, 5), "cpu", scale=0.7, draw=0, uniform=uniform), expected[0])
+
+
+def trace_inputs(mt, fact, samples=3):
+    r = fact["requested_rewrite"]
+    prompt = r["prompt"].format(r["subject"])
+    batch = make_inputs(mt.tokenizer, [prompt] * (samples + 1), device="cpu")
+    e_range = find_token_range(mt.tokenizer, substring=r["subject"], prompt_str=prompt)
+    answer_t = mt.tokenizer.encode(r["target_true"]["str"])[0]
+    return batch, e_range, answer_t
+
+
+def test_trace_with_patch_matches_old_noise(tiny_mt, synthetic_facts, monkeypatch):
+    facts, _ = synthetic_facts
+    batch, e_range, answer_t = trace_inputs(tiny_mt, facts[0])
+    states = [(e_range[1] - 1, layername(tiny_mt.model, 1))]
+    args = (tiny_mt.model, batch, states, answer_t, e_range)
+    new = causal_trace.trace_with_patch(*args, noise=0.3)
+    monkeypatch.setattr(causal_trace, "seeded_noise", OldNoiseStream())
+    old = causal_trace.trace_with_patch(*args, noise=0.3)
+    assert torch.equal(new, old)
+
+
+@pytest.mark.parametrize("uniform_noise", [False, True])
+def test_trace_with_repatch_matches_old_noise(tiny_mt, synthetic_facts, monkeypatch, uniform_noise):
+    facts, _ = synthetic_facts
+    batch, e_range, answer_t = trace_inputs(tiny_mt, facts[1])
+    token = e_range[1] - 1
+    # Unpatching runs two passes, which draw consecutive arrays from one stream.
+    args = (
+        tiny_mt.model,
+        batch,
+        [(token, layername(tiny_mt.model, 1))],
+        [(token, layername(tiny_mt.model, 2, "mlp"))],
+        answer_t,
+        e_range,
+    )
+    new = causal_trace.trace_with_repatch(*args, noise=0.3, uniform_noise=uniform_noise)
+    monkeypatch.setattr(causal_trace, "seeded_noise", OldNoiseStream())
+    old = causal_trace.trace_with_repatch(*args, noise=0.3, uniform_noise=uniform_noise)
+    assert torch.equal(new, old)
+
+
+def test_generation_matches_old_noise(tiny_mt, synthetic_facts, monkeypatch):
+    facts, _ = synthetic_facts
+    r = facts[2]["requested_rewrite"]
+    hparams = Namespace(editing_noise=0.5)
+    args = Namespace(fact_forcing=True, weight_based_tracing=False, hparams=hparams)
+    essence_texts = [f"{r['subject']} is a thing.", f"People say {r['subject']} is known."]
+
+    def essence_score():
+        return eval_utils_counterfact.test_generation(
+            args, tiny_mt.model, tiny_mt.tokenizer, [], [], essence_texts, None, r["subject"]
+        )["essence_score"]
+
+    new = essence_score()
+    monkeypatch.setattr(eval_utils_counterfact, "seeded_noise", OldNoiseStream())
+    old = essence_score()
+    assert new == old
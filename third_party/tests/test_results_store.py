@@ -0,0 +1,51 @@
+import pandas as pd
+
+from util.results_store import ResultsStore
+
+
+def double_rows(df):
+    return pd.DataFrame(dict(case_id=df["case_id"], double=df["value"] * 2))
+
+
+def test_done_ids_includes_buffered_rows_without_writing(tmp_path):
+    store = ResultsStore(tmp_path, buffer_rows=3)
+    done = store.done_ids("exp")
+    store.append("exp", [dict(case_id=0, value=1.0), dict(case_id=1, value=2.0)])
+    assert done == {0, 1}
+    assert store.done_ids("exp") == {0, 1}
+    assert store.parts("exp") == []
+    # Rows buffered before the done set was first asked for are included too.
+    assert store.done_ids("exp", key=["case_id", "value"]) == {(0, 1.0), (1, 2.0)}
+    store.append("exp", [dict(case_id=2, value=3.0)])
+    assert len(store.parts("exp")) == 1
+    assert done == {0, 1, 2}
+
+
+def test_done_ids_reads_parts_of_other_writers(tmp_path):
+    store = ResultsStore(tmp_path)
+    done = store.done_ids("exp")
+    other = ResultsStore(tmp_path)
+    other.append("exp", [dict(case_id=5, value=1.0)])
+    assert 5 not in done
+    assert store.done_ids("exp") == {5}
+
+
+def test_compact_keeps_up_to_date_derived_tables(tmp_path):
+    store = ResultsStore(tmp_path)
+    for case_id in range(4):
+        store.append("exp", [dict(case_id=case_id, value=float(case_id))])
+        store.derived("exp", "double", double_rows, unique_on="case_id")
+    store.append("exp", [dict(case_id=1, value=10.0)])
+    expected = store.read("exp", unique_on="case_id")
+    expected_double = store.derived("exp", "double", double_rows, unique_on="case_id")
+    store.compact("exp")
+    assert len(store.parts("exp")) == 1
+    pd.testing.assert_frame_equal(store.read("exp", unique_on="case_id"), expected)
+    calls = []
+    def tracked_double_rows(df):
+        calls.append(len(df))
+        return double_rows(df)
+    derived = store.derived("exp", "double", tracked_double_rows, unique_on="case_id")
+    pd.testing.assert_frame_equal(derived, expected_double)
+    assert calls == []
+    assert store.done_ids("exp") == {0, 1, 2, 3}
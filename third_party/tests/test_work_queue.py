@@ -0,0 +1,39 @@
+import pytest
+
+from util.work_queue import DONE, FAILED, WorkQueue
+
+
+def test_process_leased_completes_items(tmp_path):
+    queue = WorkQueue(tmp_path / "queue.sqlite")
+    processed = []
+    queue.process_leased("w0", ["a", "b", "c"], processed.append)
+    assert processed == ["a", "b", "c"]
+    assert queue.counts() == {DONE: 3}
+
+
+def test_failing_item_is_retried_then_given_up_on(tmp_path):
+    queue = WorkQueue(tmp_path / "queue.sqlite", max_attempts=2)
+    attempts = []
+
+    def crash_on_b(item):
+        attempts.append(item)
+        if item == "b":
+            raise RuntimeError("bad record")
+
+    # The worker keeps going after a failing item.
+    queue.process_leased("w0", ["a", "b", "c"], crash_on_b)
+    assert attempts == ["a", "b", "b", "c"]
+    assert queue.counts() == {DONE: 2, FAILED: 1}
+
+
+def test_interrupt_returns_the_item_and_stops_the_worker(tmp_path):
+    queue = WorkQueue(tmp_path / "queue.sqlite")
+
+    def interrupt(item):
+        raise KeyboardInterrupt()
+
+    with pytest.raises(KeyboardInterrupt):
+        queue.process_leased("w0", ["a", "b"], interrupt)
+    processed = []
+    queue.process_leased("w1", ["a", "b"], processed.append)
+    assert processed == ["a", "b"]
@@ -0,0 +1,192 @@
+"""
+A persistent, content-addressed cache for evaluation results that depend
+only on the unedited model, such as the "pre" metrics of a CounterFact
+record, its essence texts, and the correctness checks run before editing.
+
+    cache = EvalCache('results/eval_cache', max_bytes=2**30)
+    key = dict(kind='pre', model='gpt2-xl', record=record, ...)
+    metrics = cache.get_or_compute(key, lambda: eval_fn(model, record))
+
+Keys are JSON-serializable dicts.  Each entry is stored as its own json
+file, named by a hash of the key, so that separate processes can share one
+cache directory.  Entries hold their full key, which is compared on every
+read, so a hash collision or a stale file is treated as a miss.  Bumping
+CACHE_VERSION invalidates every existing entry.
+When max_bytes is set, the least recently used entries are evicted once
+the cache grows past it.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy
+import torch
+
+CACHE_VERSION = 1
+
+_MISSING = object()
+
+
+def _to_json(x):
+    """
+    Converts numpy and torch values that json cannot serialize natively.
+    """
+    if isinstance(x, (numpy.generic, numpy.ndarray)):
+        return x.tolist()
+    if torch.is_tensor(x):
+        return x.tolist()
+    if isinstance(x, (set, frozenset)):
+        return sorted(x)
+    raise TypeError(f"{type(x)} is not JSON serializable")
+
+
+class EvalCache:
+    """
+    On-disk cache from JSON-serializable keys to JSON-serializable values.
+    """
+
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = str(cache_dir)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._size = self.size()
+
+    def canonical_key(self, key):
+        """
+        Returns the key, with the cache version, as a canonical json string.
+        """
+        return json.dumps(
+            dict(key, cache_version=CACHE_VERSION), sort_keys=True, default=_to_json
+        )
+
+    def key_hash(self, key):
+        """
+        Returns the content address of a key.
+        """
+        return hashlib.sha256(self.canonical_key(key).encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        h = self.key_hash(key)
+        return os.path.join(self.cache_dir, h[:2], f"{h}.json")
+
+    def get(self, key, default=None):
+        """
+        Returns the cached value for key, or default if there is none.
+        """
+        path = self.path(key)
+        try:
+            with open(path, "r") as f:
+                entry = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.misses += 1
+            return default
+        if entry.get("key") != json.loads(self.canonical_key(key)):
+            self.misses += 1
+            return default
+        # Mark as recently used, for eviction.
+        os.utime(path)
+        self.hits += 1
+        return entry["value"]
+
+    def put(self, key, value):
+        """
+        Stores value under key, replacing any previous value. Returns the
+        value as get() will return it, with numpy and torch values and
+        tuples converted to their json types.
+        """
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = json.dumps(
+            dict(key=json.loads(self.canonical_key(key)), value=value), default=_to_json
+        )
+        # Write to a temporary file first so that readers never see a partial entry.
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+        try:
+            old_size = os.path.getsize(path)
+        except FileNotFoundError:
+            old_size = 0
+        os.replace(tmp_path, path)
+        self._size += len(data) - old_size
+        if self.max_bytes is not None and self._size > self.max_bytes:
+            self.evict()
+        return json.loads(data)["value"]
+
+    def get_or_compute(self, key, fn):
+        """
+        Returns the cached value for key, calling fn() to compute and
+        store it if it is not cached. The value is returned as read from the
+        cache either way.
+        """
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = self.put(key, fn())
+        return value
+
+    def invalidate(self, key):
+        """
+        Removes the entry for key, if there is one.
+        """
+        try:
+            path = self.path(key)
+            self._size -= os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        """
+        Removes every entry in the cache.
+        """
+        for path, _, _ in list(self._entries()):
+            os.remove(path)
+        self._size = 0
+
+    def size(self):
+        """
+        Returns the total size of the cached entries in bytes.
+        """
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self):
+        """
+        Removes least recently used entries until the cache is within 90%
+        of max_bytes, so that eviction does not run on every put.
+        """
+        entries = sorted(self._entries(), key=lambda e: e[2])
+        self._size = sum(size for _, size, _ in entries)
+        target = 0.9 * self.max_bytes
+        for path, size, _ in entries:
+            if self._size <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._size -= size
+
+    def _entries(self):
+        """
+        Yields (path, size in bytes, last access time) for each entry.
+        """
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, st.st_size, st.st_mtime
+
+    def __repr__(self):
+        return (
+            f"EvalCache({self.cache_dir}, {self._size} bytes, "
+            f"{self.hits} hits, {self.misses} misses)"
+        )
@@ -86,7 +86,7 @@ def score_from_batch(model, batch, return_log_probs=False):
     return torch.exp(seq_log_probs)
 
 def score_model(mt, query_inputs, targets):
-  batch = make_inputs(mt.tokenizer, query_inputs, targets)
+  batch = make_inputs(mt.tokenizer, query_inputs, targets, device=mt.model.device)
   return score_from_batch(mt.model, batch)
 
 def predict_model(mt, 
@@ -98,7 +98,7 @@ def predict_model(mt,
   assert not isinstance(query_inputs, str), "provide queries as list"
   with torch.no_grad():
     generate_and_score = (answers is None)
-    batch = make_inputs(mt.tokenizer, query_inputs, targets=answers)
+    batch = make_inputs(mt.tokenizer, query_inputs, targets=answers, device=mt.model.device)
     if generate_and_score:
       pad_token_id = mt.tokenizer.pad_token_id
       pad_token_id = pad_token_id if pad_token_id else 0
@@ -109,7 +109,7 @@ def predict_model(mt,
       preds = [pred.replace(query_input, "").strip() for pred, query_input in zip(preds, query_inputs)]     
       # for some reason huggingface generate not giving generation probs, so we recalculate
       if score_if_generating: 
-        batch = make_inputs(mt.tokenizer, query_inputs, targets=preds)
+        batch = make_inputs(mt.tokenizer, query_inputs, targets=preds, device=mt.model.device)
         scores = score_from_batch(mt.model, batch)
       else:
         scores = -100 * np.ones(len(preds))
@@ -121,7 +121,7 @@ def predict_model(mt,
         for answer in answers:
           repeated_inputs.append(input)
           repeated_answers.append(answer)
-      batch = make_inputs(mt.tokenizer, repeated_inputs, repeated_answers)
+      batch = make_inputs(mt.tokenizer, repeated_inputs, repeated_answers, device=mt.model.device)
       scores = score_from_batch(mt.model, batch)
       scores = scores.reshape(-1, num_answers)
       pred_ids = [torch.argmax(ex_answer_probs).item() for ex_answer_probs in scores]
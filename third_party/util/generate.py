@@ -81,72 +81,108 @@ def generate_fast(
     n_gen_per_prompt: int = 1,
     top_k: int = 5,
     max_out_len: int = 200,
+    stop_at_eos: bool = False,
 ):
     """
     Fast, parallelized auto-regressive text generation with top-k sampling.
     Our custom implementation.
+
+    Each distinct prompt is run through the model once and its attention
+    cache is shared by its n_gen_per_prompt samples. Generation then runs one
+    column at a time over the whole batch, drawing a sample for every row at
+    every step, so outputs under a fixed seed are the same as those of the
+    original implementation. Rows are extended until the batch is max_out_len
+    tokens wide. If stop_at_eos, a row also stops once it samples the EOS
+    token, and is dropped from the batch; this changes the random draws.
     """
 
-    # Unroll prompts and tokenize
-    inp = [prompt for prompt in prompts for _ in range(n_gen_per_prompt)]
-    inp_tok = tok(inp, padding=True, return_tensors="pt").to(
-        next(model.parameters()).device
-    )
-    input_ids, attention_mask = inp_tok["input_ids"], inp_tok["attention_mask"]
-    batch_size = input_ids.size(0)
+    device = next(model.parameters()).device
+    eos_id = tok.eos_token_id if stop_at_eos else None
 
-    # Setup storage of fast generation with attention caches.
-    # `cur_context` is used to define the range of inputs that are not yet
-    # stored in `past_key_values`. At each step, we are generating the
-    # next token for the index at `cur_context.stop + 1`.
-    past_key_values, cur_context = None, slice(0, attention_mask.sum(1).min().item())
+    # Right-pad the distinct prompts, as the unrolled prompts were padded before
+    inp_tok = tok(prompts, padding=True, return_tensors="pt").to(device)
+    prompt_ids, prompt_mask = inp_tok["input_ids"], inp_tok["attention_mask"]
+    prompt_len = prompt_ids.size(1)
+    batch_size = len(prompts) * n_gen_per_prompt
+
+    # Preallocate storage for the longest output, instead of growing it every step.
+    # Sample j of prompt i is row i * n_gen_per_prompt + j
+    prompt_idx = torch.arange(batch_size, device=device) // n_gen_per_prompt
+    input_ids = prompt_ids.new_full(
+        (batch_size, max(prompt_len, max_out_len)), tok.pad_token_id
+    )
+    attention_mask = prompt_mask.new_zeros(input_ids.shape)
+    input_ids[:, :prompt_len] = prompt_ids[prompt_idx]
+    attention_mask[:, :prompt_len] = prompt_mask[prompt_idx]
+    lengths = attention_mask.sum(1)
+
+    # `width` is the number of columns of the output so far. `cur_context`
+    # is the range of columns not yet stored in `past_key_values`; at each
+    # step we sample the token that follows column `cur_context.stop - 1`.
+    width = prompt_len
+    cur_context = slice(0, lengths.min().item())
+    active = torch.arange(batch_size, device=device)
+    past_key_values = None
 
     with torch.no_grad():
-        while input_ids.size(1) < max_out_len:  # while not exceeding max output length
-            model_out = model(
-                input_ids=input_ids[:, cur_context],
-                attention_mask=attention_mask[:, cur_context],
-                past_key_values=past_key_values,
-                use_cache=True,
-            )
-            logits, past_key_values = model_out.logits, model_out.past_key_values
-            softmax_out = torch.nn.functional.softmax(logits[:, -1, :], dim=1)
+        while width < max_out_len:  # while not exceeding max output length
+            if past_key_values is None:
+                # Run the prompts once, then share their cache across samples
+                model_out = model(
+                    input_ids=prompt_ids[:, cur_context],
+                    attention_mask=prompt_mask[:, cur_context],
+                    use_cache=True,
+                )
+                logits = model_out.logits[:, -1, :]
+                past_key_values = model_out.past_key_values
+                if n_gen_per_prompt > 1:
+                    logits = logits[prompt_idx]
+                    past_key_values = select_cache(past_key_values, prompt_idx)
+            else:
+                model_out = model(
+                    input_ids=input_ids[active, cur_context],
+                    attention_mask=attention_mask[active, cur_context],
+                    past_key_values=past_key_values,
+                    use_cache=True,
+                )
+                logits, past_key_values = model_out.logits[:, -1, :], model_out.past_key_values
+            softmax_out = torch.nn.functional.softmax(logits, dim=1)
 
             # Top-k sampling
             tk = torch.topk(softmax_out, top_k, dim=1).indices
             softmax_out_top_k = torch.gather(softmax_out, 1, tk)
             softmax_out_top_k = softmax_out_top_k / softmax_out_top_k.sum(1)[:, None]
             new_tok_indices = torch.multinomial(softmax_out_top_k, 1)
-            new_toks = torch.gather(tk, 1, new_tok_indices)
-
-            # If we're currently generating the continuation for the last token in `input_ids`,
-            # create a new index so we can insert the new token
-            if cur_context.stop == input_ids.size(1):
-                attention_mask = torch.cat(
-                    [attention_mask, attention_mask.new_zeros(batch_size, 1)], dim=1
-                )
-                input_ids = torch.cat(
-                    [
-                        input_ids,
-                        input_ids.new_ones(batch_size, 1) * tok.pad_token_id,
-                    ],
-                    dim=1,
-                )
-
-            last_non_masked = attention_mask.sum(1) - 1
-            for i in range(batch_size):
-                new_idx = last_non_masked[i] + 1
-                if last_non_masked[i].item() + 1 != cur_context.stop:
-                    continue
-
-                # Stop generating if we've already maxed out for this prompt
-                if new_idx < max_out_len:
-                    input_ids[i][new_idx] = new_toks[i]
-                    attention_mask[i][new_idx] = 1
+            new_toks = torch.gather(tk, 1, new_tok_indices)[:, 0]
+
+            # If we're currently generating the continuation for the last column,
+            # the output gets a new column
+            if cur_context.stop == width:
+                width += 1
+
+            # Only rows whose prompt is used up take the new token; the others
+            # continue with their own next prompt token
+            new_idx = cur_context.stop
+            extend = lengths[active] == new_idx
+            if new_idx < max_out_len and extend.any():
+                rows = active[extend]
+                input_ids[rows, new_idx] = new_toks[extend]
+                attention_mask[rows, new_idx] = 1
+                lengths[rows] += 1
 
             cur_context = slice(cur_context.stop, cur_context.stop + 1)
 
-    txt = [tok.decode(x) for x in input_ids.detach().cpu().numpy().tolist()]
+            # Stop rows that sampled EOS, and compact the rest
+            if eos_id is not None:
+                done = extend & (new_toks == eos_id)
+                if done.all():
+                    break
+                if done.any():
+                    keep = (~done).nonzero()[:, 0]
+                    active = active[keep]
+                    past_key_values = select_cache(past_key_values, keep)
+
+    txt = [tok.decode(x) for x in input_ids[:, :width].detach().cpu().numpy().tolist()]
     txt = [
         unicodedata.normalize("NFKD", x)
         .replace("\n\n", " ")
@@ -155,3 +191,18 @@ def generate_fast(
     ]
 
     return txt
+
+
+def select_cache(past_key_values, index: torch.Tensor):
+    """
+    Selects (and possibly repeats) rows of an attention cache along the batch
+    dimension. Handles both the legacy tuple-of-tuples format and Cache objects.
+    """
+
+    if hasattr(past_key_values, "reorder_cache"):
+        past_key_values.reorder_cache(index)
+        return past_key_values
+    return tuple(
+        tuple(t.index_select(0, index.to(t.device)) for t in layer)
+        for layer in past_key_values
+    )
@@ -3,6 +3,8 @@ Utilities for instrumenting a torch model.
 
 Trace will hook one layer at a time.
 TraceDict will hook multiple layers at once.
+FrozenPrefix replays cached outputs of leading layers instead of rerunning them.
+HookProfile times the layers and hooks of Trace and TraceDict.
 subsequence slices intervals from Sequential modules.
 get_module, replace_module, get_parameter resolve dotted names.
 set_requires_grad recursively sets requires_grad in module parameters.
@@ -11,6 +13,7 @@ set_requires_grad recursively sets requires_grad in module parameters.
 import contextlib
 import copy
 import inspect
+import time
 from collections import OrderedDict
 
 import torch
@@ -45,6 +48,10 @@ class Trace(contextlib.AbstractContextManager):
             for the original output and the layer name.
         stop=True - throws a StopForward exception after the layer
             is run, which allows running just a portion of a model.
+        profile=HookProfile() - records the forward time of the layer,
+            the time spent in the hook and the volume of cloned
+            tensors.  By default, the innermost open HookProfile
+            context is used, if any.
     """
 
     def __init__(
@@ -58,6 +65,7 @@ class Trace(contextlib.AbstractContextManager):
         retain_grad=False,
         edit_output=None,
         stop=False,
+        profile=None,
     ):
         """
         Method to replace a forward method with a closure that
@@ -67,6 +75,9 @@ class Trace(contextlib.AbstractContextManager):
         self.layer = layer
         if layer is not None:
             module = get_module(module, layer)
+        if profile is None and len(HookProfile.active) > 0:
+            profile = HookProfile.active[-1]
+        profile_name = layer if layer is not None else type(module).__name__
 
         def retain_hook(m, inputs, output):
             if retain_input:
@@ -76,6 +87,8 @@ class Trace(contextlib.AbstractContextManager):
                     detach=detach,
                     retain_grad=False,
                 )  # retain_grad applies to output only.
+                if profile is not None and clone:
+                    profile.add_clone(profile_name, retainer.input)
             if edit_output:
                 output = invoke_with_optional_args(
                     edit_output, output=output, layer=self.layer
@@ -84,15 +97,25 @@ class Trace(contextlib.AbstractContextManager):
                 retainer.output = recursive_copy(
                     output, clone=clone, detach=detach, retain_grad=retain_grad
                 )
+                if profile is not None and clone:
+                    profile.add_clone(profile_name, retainer.output)
                 # When retain_grad is set, also insert a trivial
                 # copy operation.  That allows in-place operations
                 # to follow without error.
                 if retain_grad:
                     output = recursive_copy(retainer.output, clone=True, detach=False)
+                    if profile is not None:
+                        profile.add_clone(profile_name, output)
             if stop:
                 raise StopForward()
             return output
 
+        self.registered_pre_hook = None
+        if profile is not None:
+            self.registered_pre_hook = module.register_forward_pre_hook(
+                profile.forward_pre_hook(profile_name)
+            )
+            retain_hook = profile.wrap_hook(profile_name, retain_hook)
         self.registered_hook = module.register_forward_hook(retain_hook)
         self.stop = stop
 
@@ -106,6 +129,8 @@ class Trace(contextlib.AbstractContextManager):
 
     def close(self):
         self.registered_hook.remove()
+        if self.registered_pre_hook is not None:
+            self.registered_pre_hook.remove()
 
 
 class TraceDict(OrderedDict, contextlib.AbstractContextManager):
@@ -137,6 +162,7 @@ class TraceDict(OrderedDict, contextlib.AbstractContextManager):
         retain_grad=False,
         edit_output=None,
         stop=False,
+        profile=None,
     ):
         self.stop = stop
 
@@ -165,6 +191,7 @@ class TraceDict(OrderedDict, contextlib.AbstractContextManager):
                 retain_grad=retain_grad,
                 edit_output=edit_output,
                 stop=stop and is_last,
+                profile=profile,
             )
 
     def __enter__(self):
@@ -180,6 +207,179 @@ class TraceDict(OrderedDict, contextlib.AbstractContextManager):
             trace.close()
 
 
+class FrozenPrefix(contextlib.AbstractContextManager):
+    """
+    To avoid recomputing the layers below an intervention when the same
+    inputs are run through a network many times, as in an optimization
+    loop that only edits an upper layer:
+
+        lower = [f'transformer.h.{i}' for i in range(layer)]
+        with FrozenPrefix(net, lower):
+            for step in range(steps):
+                logits = net(**inp).logits   # lower layers run only once
+
+    The first call to each listed layer runs it as usual and records a
+    detached copy of its output.  Every later call skips the computation
+    and returns a fresh clone of the recorded output, so downstream
+    in-place edits cannot alter the cache.  Gradients do not flow into
+    the frozen layers, and the inputs to the network must not change
+    while the context is open.  Hooks registered on the frozen layers,
+    e.g. by Trace, still see (and may edit) the replayed output.
+    """
+
+    def __init__(self, module, layers=None):
+        self.outputs = OrderedDict()
+        self.patched = []
+        for layer in layers or []:
+            self.freeze(get_module(module, layer), layer)
+
+    def freeze(self, module, layer):
+        """
+        Replace the forward method of the module with a closure that
+        records its output once and replays it thereafter.
+        """
+        freezer = self
+        instance_forward = module.__dict__.get("forward")
+        forward = module.forward
+
+        def frozen_forward(*args, **kwargs):
+            if layer not in freezer.outputs:
+                freezer.outputs[layer] = frozen_copy(
+                    forward(*args, **kwargs), detach=True
+                )
+            return frozen_copy(freezer.outputs[layer])
+
+        module.forward = frozen_forward
+        self.patched.append((module, instance_forward))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        for module, instance_forward in reversed(self.patched):
+            if instance_forward is None:
+                del module.forward
+            else:
+                module.forward = instance_forward
+        self.patched = []
+        self.outputs.clear()
+
+
+class HookProfile(contextlib.AbstractContextManager):
+    """
+    To find out whether the hooks of a tracing run or the model itself
+    take up the time, profile the Trace and TraceDict hooks created
+    while the context is open, including those created deep inside
+    other functions:
+
+        with HookProfile() as profile:
+            result = calculate_hidden_flow(mt, prompt, subject, target)
+        print(profile.summary())
+
+    or pass it to a single Trace or TraceDict with profile=profile.
+    For every traced layer it records the number of calls, the time
+    of the layer's own forward computation, the time spent in the
+    Trace hook after it (edit_output and copying the retained values)
+    and the number and size of the tensors cloned by the hook.
+
+    Nested traced layers (e.g. a block and its mlp) each count their
+    own forward time, so those times overlap.  When synchronize is
+    set and CUDA is available, the clock waits for pending kernels,
+    which makes the times accurate but slows the run down.
+    """
+
+    active = []
+
+    def __init__(self, synchronize=True):
+        self.synchronize = synchronize and torch.cuda.is_available()
+        self.layers = OrderedDict()
+        self.starts = {}
+
+    def clock(self):
+        if self.synchronize:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def layer_stats(self, name):
+        if name not in self.layers:
+            self.layers[name] = dict(
+                calls=0, forward_seconds=0.0, hook_seconds=0.0, clones=0, clone_bytes=0
+            )
+        return self.layers[name]
+
+    def forward_pre_hook(self, name):
+        def pre_hook(m, inputs):
+            self.starts.setdefault(name, []).append(self.clock())
+
+        return pre_hook
+
+    def wrap_hook(self, name, hook):
+        """
+        Returns a forward hook that runs hook, recording the time since
+        the layer started as its forward time and the hook's own time.
+        """
+
+        def profiled_hook(m, inputs, output):
+            hook_start = self.clock()
+            stats = self.layer_stats(name)
+            stats["calls"] += 1
+            starts = self.starts.get(name)
+            if starts:
+                stats["forward_seconds"] += hook_start - starts.pop()
+            try:
+                return hook(m, inputs, output)
+            finally:
+                stats["hook_seconds"] += self.clock() - hook_start
+
+        return profiled_hook
+
+    def add_clone(self, name, x):
+        stats = self.layer_stats(name)
+        for t in iter_tensors(x):
+            stats["clones"] += 1
+            stats["clone_bytes"] += t.numel() * t.element_size()
+
+    def totals(self):
+        totals = dict(calls=0, forward_seconds=0.0, hook_seconds=0.0, clones=0, clone_bytes=0)
+        for stats in self.layers.values():
+            for k, v in stats.items():
+                totals[k] += v
+        return totals
+
+    def summary(self):
+        """
+        Returns a table of the stats of each layer and their totals.
+        """
+        rows = list(self.layers.items()) + [("total", self.totals())]
+        width = max([len(name) for name, _ in rows])
+        lines = [
+            f"{'layer':<{width}} {'calls':>7} {'forward ms':>11} "
+            f"{'hook ms':>9} {'clones':>7} {'clone MB':>9}"
+        ]
+        for name, stats in rows:
+            lines.append(
+                f"{name:<{width}} {stats['calls']:>7} "
+                f"{1000 * stats['forward_seconds']:>11.2f} "
+                f"{1000 * stats['hook_seconds']:>9.2f} {stats['clones']:>7} "
+                f"{stats['clone_bytes'] / 2 ** 20:>9.2f}"
+            )
+        return "\n".join(lines)
+
+    def reset(self):
+        self.layers.clear()
+        self.starts.clear()
+
+    def __enter__(self):
+        HookProfile.active.append(self)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        HookProfile.active.remove(self)
+
+
 class StopForward(Exception):
     """
     If the only output needed from running a network is the retained
@@ -223,6 +423,40 @@ def recursive_copy(x, clone=None, detach=None, retain_grad=None):
         assert False, f"Unknown type {type(x)} cannot be broken into tensors."
 
 
+def frozen_copy(x, detach=False):
+    """
+    Copies the output of a layer frozen by FrozenPrefix, cloning every
+    tensor in nested dicts, lists, and tuples and keeping Nones (such
+    as a missing key-value cache) in place.
+    """
+    if x is None:
+        return x
+    if isinstance(x, torch.Tensor):
+        if detach:
+            x = x.detach()
+        return x.clone()
+    if isinstance(x, dict):
+        return type(x)({k: frozen_copy(v, detach) for k, v in x.items()})
+    elif isinstance(x, (list, tuple)):
+        return type(x)([frozen_copy(v, detach) for v in x])
+    else:
+        assert False, f"Unknown type {type(x)} cannot be broken into tensors."
+
+
+def iter_tensors(x):
+    """
+    Yields the tensors in an object that recursive_copy can copy.
+    """
+    if isinstance(x, torch.Tensor):
+        yield x
+    elif isinstance(x, dict):
+        for v in x.values():
+            yield from iter_tensors(v)
+    elif isinstance(x, (list, tuple)):
+        for v in x:
+            yield from iter_tensors(v)
+
+
 def subsequence(
     sequential,
     first_layer=None,
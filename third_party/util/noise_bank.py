@@ -0,0 +1,75 @@
+"""
+Caches the seeded noise used to corrupt subject embeddings.
+
+Causal tracing and the evaluation noising functions draw their noise from a
+fresh np.random.RandomState(1) on every forward pass, so every pass with the
+same noise shape draws the same values, on the cpu, in float64.  NoiseBank
+draws each such tensor once, scales it and keeps it on the device, and hands
+back the cached tensor on later passes:
+
+    x[1:, b:e] += seeded_noise((x.shape[0] - 1, e - b, x.shape[2]), x.device, scale=noise)
+
+is bit-identical to
+
+    prng = np.random.RandomState(1)
+    x[1:, b:e] += noise * torch.from_numpy(prng.randn(x.shape[0] - 1, e - b, x.shape[2])).to(x.device)
+
+The cached tensors are kept in float64, like the freshly drawn noise, so
+that adding them to the embeddings rounds exactly as before.  Consecutive
+draws from one RandomState, as made by the two passes of trace_with_repatch,
+are selected with draw=1, 2, ...
+"""
+
+import collections
+
+import numpy as np
+import torch
+
+
+class NoiseBank:
+    """
+    Least recently used cache of seeded, scaled noise tensors, keyed by
+    shape, device, scale, seed, draw index and distribution.
+    """
+
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+
+    def get(self, shape, device, scale=1.0, seed=1, draw=0, uniform=False):
+        """
+        Returns scale times the draw'th array of the given shape drawn from
+        np.random.RandomState(seed), standard normal or uniform on (-1, 1),
+        as a float64 tensor on device. The result must not be modified.
+        """
+        shape = tuple(int(s) for s in shape)
+        key = (shape, str(device), scale, seed, draw, uniform)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        # Replay the stream up to the requested draw, caching every draw on the way.
+        rs = np.random.RandomState(seed)
+        for d in range(draw + 1):
+            sample = rs.uniform(-1, 1, shape) if uniform else rs.randn(*shape)
+            self.put((shape, str(device), scale, seed, d, uniform),
+                     scale * torch.from_numpy(sample).to(device))
+        return self.entries[key]
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+
+NOISE_BANK = NoiseBank()
+
+
+def seeded_noise(shape, device, scale=1.0, seed=1, draw=0, uniform=False):
+    """
+    Returns seeded noise from the shared NOISE_BANK. See NoiseBank.get.
+    """
+    return NOISE_BANK.get(shape, device, scale=scale, seed=seed, draw=draw, uniform=uniform)
@@ -1,3 +1,5 @@
+from typing import List
+
 import torch
 from transformers import AutoModelForCausalLM, AutoTokenizer
 
@@ -15,10 +17,47 @@ def perplexity(
 
     inputs = tok(
         [text], return_tensors="pt", max_length=max_input_length, truncation=True
-    ).to("cuda")
+    ).to(next(model.parameters()).device)
 
     logits = torch.nn.functional.log_softmax(model(**inputs).logits, dim=2)
     log_probs = torch.gather(logits[:, :-1, :], 2, inputs["input_ids"][:, 1:, None])[0]
 
     # Perplexity = exp(-1/N * log P(x_1, ..., x_n))
     return torch.exp(-1 / inputs["input_ids"].size(1) * log_probs.sum()).item()
+
+
+def batch_perplexity(
+    model: AutoModelForCausalLM,
+    tok: AutoTokenizer,
+    texts: List[str],
+    max_input_length: int = None,
+):
+    """
+    Computes the perplexity of each of several texts in one forward pass,
+    matching perplexity() on each text. Texts are right-padded so that the
+    positions of the real tokens do not depend on the rest of the batch.
+    """
+
+    token_lists = [
+        tok.encode(text, max_length=max_input_length, truncation=True)
+        for text in texts
+    ]
+    maxlen = max(len(t) for t in token_lists)
+    pad_id = tok.pad_token_id if tok.pad_token_id is not None else 0
+    device = next(model.parameters()).device
+    input_ids = torch.tensor(
+        [t + [pad_id] * (maxlen - len(t)) for t in token_lists], device=device
+    )
+    attention_mask = torch.tensor(
+        [[1] * len(t) + [0] * (maxlen - len(t)) for t in token_lists], device=device
+    )
+    lengths = attention_mask.sum(1)
+
+    logits = torch.nn.functional.log_softmax(
+        model(input_ids=input_ids, attention_mask=attention_mask).logits, dim=2
+    )
+    log_probs = torch.gather(logits[:, :-1, :], 2, input_ids[:, 1:, None])[..., 0]
+    log_probs = (log_probs * attention_mask[:, 1:]).sum(1)
+
+    # Perplexity = exp(-1/N * log P(x_1, ..., x_n)), with N counted per text
+    return torch.exp(-log_probs / lengths).tolist()
@@ -0,0 +1,342 @@
+"""
+An append-only, columnar store for experiment results, to replace writing
+one small json, csv or npz file per case. Rows are appended to Parquet files
+partitioned by experiment name:
+
+    {root}/experiment={name}/part-{time}-{pid}-{n}.parquet
+
+    store = ResultsStore(f'{BASE_DIR}/results/store', buffer_rows=20)
+    done = store.done_ids(exp_name)
+    for case_id in case_ids:
+        if case_id not in done:
+            store.append(exp_name, [dict(case_id=case_id, metrics=json.dumps(metrics))])
+    store.flush()
+    store.compact(exp_name)
+    df = store.read(exp_name, unique_on='case_id')
+
+Every flush writes a new part file, and existing parts are only replaced
+by compact(), so concurrent writers never touch the same file and readers
+never see a partial one.  This lets readers read only the parts that are
+new to them: done_ids() reads just the key columns of new parts, and
+derived() keeps a table computed from the raw rows up to date by
+transforming only the rows appended since its last update.
+
+Existing result directories can be converted with
+
+    python -m util.results_store --store_dir STORE --cases_dir RESULTS_DIR
+    python -m util.results_store --store_dir STORE --traces_dir TRACES_DIR
+"""
+
+import collections
+import itertools
+import json
+import os
+import re
+import shutil
+import time
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+class ResultsStore:
+    """
+    Appends rows to per-experiment Parquet datasets under root. Rows are
+    buffered in memory until buffer_rows of them are pending for an
+    experiment, then written as one part file.
+    """
+
+    def __init__(self, root, buffer_rows=1):
+        self.root = str(root)
+        self.buffer_rows = buffer_rows
+        self._buffers = collections.defaultdict(list)
+        self._done = {}
+        self._count = itertools.count()
+        os.makedirs(self.root, exist_ok=True)
+
+    def experiment_dir(self, experiment):
+        return os.path.join(self.root, f"experiment={experiment}")
+
+    def experiments(self):
+        """
+        Returns the names of all experiments in the store.
+        """
+        return sorted(
+            name[len("experiment=") :]
+            for name in os.listdir(self.root)
+            if name.startswith("experiment=")
+        )
+
+    def parts(self, experiment):
+        """
+        Returns the part files of an experiment, in the order they were written.
+        """
+        return list_parts(self.experiment_dir(experiment))
+
+    def append(self, experiment, rows):
+        """
+        Appends rows, given as a DataFrame or a list of dicts, to an experiment.
+        """
+        if not isinstance(rows, pd.DataFrame):
+            rows = pd.DataFrame(list(rows))
+        # Keep the done sets handed out by done_ids up to date, buffered rows included.
+        for (done_experiment, columns), (_, done) in self._done.items():
+            if done_experiment == experiment and all(c in rows for c in columns):
+                done.update(key_values(rows, columns))
+        buffer = self._buffers[experiment]
+        buffer.append(rows)
+        if sum(len(df) for df in buffer) >= self.buffer_rows:
+            self.flush(experiment)
+
+    def flush(self, experiment=None):
+        """
+        Writes the buffered rows of one experiment, or of all experiments.
+        """
+        experiments = [experiment] if experiment is not None else list(self._buffers)
+        for experiment in experiments:
+            buffer = self._buffers.pop(experiment, [])
+            if sum(len(df) for df in buffer) > 0:
+                name = self._write_part(self.experiment_dir(experiment), pd.concat(buffer))
+                # append() already added these rows to the done sets.
+                for (done_experiment, _), (seen, _) in self._done.items():
+                    if done_experiment == experiment:
+                        seen.add(name)
+
+    def read(self, experiment, columns=None, unique_on=None):
+        """
+        Returns the rows of an experiment as a DataFrame. If unique_on names
+        key columns, only the last row written for each key is kept, so that
+        rewriting a case replaces it.
+        """
+        self.flush(experiment)
+        df = read_parts(self.experiment_dir(experiment), self.parts(experiment), columns)
+        if unique_on is not None and len(df) > 0:
+            df = df.drop_duplicates(subset=unique_on, keep="last")
+        return df.reset_index(drop=True)
+
+    def done_ids(self, experiment, key="case_id"):
+        """
+        Returns the set of values of the key column (or of tuples, if key is a
+        list of columns) appended to an experiment, whether written or still
+        buffered. Only the key columns of parts written by other processes
+        since the last call are read. The returned set is kept up to date as
+        this store appends rows, so it can be fetched once before a loop.
+        """
+        columns = (key,) if isinstance(key, str) else tuple(key)
+        if (experiment, columns) not in self._done:
+            done = set()
+            for df in self._buffers.get(experiment, []):
+                done.update(key_values(df, columns))
+            self._done[(experiment, columns)] = (set(), done)
+        seen, done = self._done[(experiment, columns)]
+        new_parts = [p for p in self.parts(experiment) if p not in seen]
+        df = read_parts(self.experiment_dir(experiment), new_parts, list(columns))
+        if len(df) > 0:
+            done.update(key_values(df, columns))
+        seen.update(new_parts)
+        return done
+
+    def derived(self, experiment, name, fn, unique_on=None):
+        """
+        Returns the table fn(rows) of an experiment, kept on disk under the
+        experiment's _derived/{name} directory. fn is only called on the rows
+        of parts written since the last update, so it must compute its output
+        rows from each batch of input rows independently. Use a new name
+        whenever fn changes.
+        """
+        self.flush(experiment)
+        derived_dir = os.path.join(self.experiment_dir(experiment), "_derived", name)
+        manifest_path = os.path.join(derived_dir, "manifest.json")
+        try:
+            with open(manifest_path, "r") as f:
+                consumed = json.load(f)["parts"]
+        except FileNotFoundError:
+            consumed = []
+        new_parts = [p for p in self.parts(experiment) if p not in set(consumed)]
+        if len(new_parts) > 0:
+            new_rows = fn(read_parts(self.experiment_dir(experiment), new_parts))
+            if new_rows is not None and len(new_rows) > 0:
+                self._write_part(derived_dir, new_rows)
+            os.makedirs(derived_dir, exist_ok=True)
+            tmp_path = f"{manifest_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(dict(parts=consumed + new_parts), f)
+            os.replace(tmp_path, manifest_path)
+        df = read_parts(derived_dir, list_parts(derived_dir))
+        if unique_on is not None and len(df) > 0:
+            df = df.drop_duplicates(subset=unique_on, keep="last")
+        return df.reset_index(drop=True)
+
+    def compact(self, experiment, min_parts=2):
+        """
+        Rewrites the parts of an experiment as a single part, if it has at
+        least min_parts of them. Derived tables that are up to date are
+        compacted too; the others are dropped and will be rebuilt on their
+        next use. Should not be called while other processes write to the
+        experiment.
+        """
+        self.flush(experiment)
+        parts = self.parts(experiment)
+        if len(parts) < max(min_parts, 2):
+            return
+        experiment_dir = self.experiment_dir(experiment)
+        name = self._write_part(experiment_dir, read_parts(experiment_dir, parts))
+        derived_root = os.path.join(experiment_dir, "_derived")
+        for derived_name in os.listdir(derived_root) if os.path.isdir(derived_root) else []:
+            derived_dir = os.path.join(derived_root, derived_name)
+            manifest_path = os.path.join(derived_dir, "manifest.json")
+            try:
+                with open(manifest_path, "r") as f:
+                    consumed = set(json.load(f)["parts"])
+            except FileNotFoundError:
+                consumed = set()
+            if not set(parts) <= consumed:
+                shutil.rmtree(derived_dir, ignore_errors=True)
+                continue
+            derived_parts = list_parts(derived_dir)
+            if len(derived_parts) > 1:
+                self._write_part(derived_dir, read_parts(derived_dir, derived_parts))
+                for part in derived_parts:
+                    os.remove(os.path.join(derived_dir, part))
+            tmp_path = f"{manifest_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(dict(parts=[name]), f)
+            os.replace(tmp_path, manifest_path)
+        for part in parts:
+            os.remove(os.path.join(experiment_dir, part))
+        for seen, _ in (v for (e, _), v in self._done.items() if e == experiment):
+            seen.add(name)
+
+    def _write_part(self, dir_name, df):
+        os.makedirs(dir_name, exist_ok=True)
+        name = f"part-{time.time_ns():020d}-{os.getpid()}-{next(self._count):06d}.parquet"
+        # Write to a hidden temporary file first so that readers never see a partial part.
+        tmp_path = os.path.join(dir_name, f".{name}.tmp")
+        pq.write_table(pa.Table.from_pandas(df, preserve_index=False), tmp_path)
+        os.replace(tmp_path, os.path.join(dir_name, name))
+        return name
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.flush()
+
+
+def key_values(df, columns):
+    """
+    Returns the values of one key column, or the tuples of several, of df.
+    """
+    if len(columns) == 1:
+        return df[columns[0]].tolist()
+    return list(df[list(columns)].itertuples(index=False, name=None))
+
+
+def list_parts(dir_name):
+    if not os.path.isdir(dir_name):
+        return []
+    return sorted(
+        name
+        for name in os.listdir(dir_name)
+        if name.startswith("part-") and name.endswith(".parquet")
+    )
+
+
+def read_parts(dir_name, parts, columns=None):
+    """
+    Reads and concatenates part files, skipping requested columns that a
+    part does not have.
+    """
+    dfs = []
+    for part in parts:
+        path = os.path.join(dir_name, part)
+        part_columns = None
+        if columns is not None:
+            names = pq.read_schema(path).names
+            part_columns = [c for c in columns if c in names]
+        dfs.append(pq.read_table(path, columns=part_columns).to_pandas())
+    if len(dfs) == 0:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(dfs, ignore_index=True)
+
+
+def convert_cases_dir(store, cases_dir, experiment=None):
+    """
+    Appends the case_{id}.json files written by experiments/evaluate.py in
+    cases_dir to the experiment named after the directory, as rows of
+    case_id and the json-encoded metrics.
+    """
+    experiment = experiment or os.path.basename(os.path.normpath(cases_dir))
+    rows = []
+    for name in sorted(os.listdir(cases_dir)):
+        if not re.fullmatch(r"case_\d+\.json", name):
+            continue
+        try:
+            with open(os.path.join(cases_dir, name), "r") as f:
+                metrics = json.load(f)
+        except json.JSONDecodeError:
+            print(f"Could not decode {name} due to format error; skipping.")
+            continue
+        rows.append(dict(case_id=metrics["case_id"], metrics=json.dumps(metrics)))
+    if len(rows) > 0:
+        store.append(experiment, rows)
+        store.flush(experiment)
+    return len(rows)
+
+
+def convert_traces_dir(store, traces_dir):
+    """
+    Appends the {experiment}_{id}_{kind}.csv files written by
+    experiments/tracing.py in traces_dir to their experiments.
+    """
+    counts = collections.Counter()
+    for name in sorted(os.listdir(traces_dir)):
+        match = re.fullmatch(r"(.+)_(\d+)_(None|mlp|attn)\.csv", name)
+        if match is None:
+            continue
+        experiment = match.group(1)
+        store.append(experiment, pd.read_csv(os.path.join(traces_dir, name)))
+        counts[experiment] += 1
+    store.flush()
+    return dict(counts)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--store_dir", type=str, required=True, help="Root directory of the results store."
+    )
+    parser.add_argument(
+        "--cases_dir",
+        type=str,
+        default=None,
+        help="Directory of experiment directories holding case_{id}.json files.",
+    )
+    parser.add_argument(
+        "--traces_dir",
+        type=str,
+        default=None,
+        help="Directory holding the {experiment}_{id}_{kind}.csv files of causal tracing.",
+    )
+    parser.add_argument(
+        "--buffer_rows",
+        type=int,
+        default=100000,
+        help="Rows to write per part file when converting traces.",
+    )
+    args = parser.parse_args()
+
+    store = ResultsStore(args.store_dir, buffer_rows=args.buffer_rows)
+    if args.cases_dir is not None:
+        for name in sorted(os.listdir(args.cases_dir)):
+            cases_dir = os.path.join(args.cases_dir, name)
+            if os.path.isdir(cases_dir):
+                count = convert_cases_dir(store, cases_dir)
+                if count > 0:
+                    print(f"Converted {count} cases of {name}")
+    if args.traces_dir is not None:
+        for experiment, count in convert_traces_dir(store, args.traces_dir).items():
+            print(f"Converted {count} traces of {experiment}")
@@ -32,6 +32,10 @@ The data type and device used matches the data passed to add();
 for example, for higher-precision covariances, convert to double
 before calling add().
 
+Stats computed over disjoint parts of a dataset can be combined with
+merge(), e.g., `m.merge(other_m)`, for Mean, NormMean, SecondMoment and
+CombinedStat; the result is the same as adding all the batches to one stat.
+
 It is common to want to compute and remember a statistic sampled
 over a Dataset, computed in batches, possibly caching the computed
 statistic in a file. The tally(stat, dataset, cache) handles
@@ -161,6 +165,13 @@ class Stat:
         """
         pass
 
+    def merge(self, other):
+        """
+        Incorporates the observations of another Stat of the same type,
+        computed over disjoint data, as if its batches had been added here.
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not support merge")
+
     def load_state_dict(self, d):
         """
         Loads this Stat from a dictionary of numpy arrays as saved
@@ -263,6 +274,21 @@ class Mean(Stat):
         delta = batch_mean.sub_(self._mean).mul_(new_frac)
         self._mean.add_(delta)
 
+    def merge(self, other):
+        if other._mean is None:
+            return
+        self.batchcount += other.batchcount
+        if self._mean is None:
+            self.count = other.count
+            self._mean = other._mean.clone()
+            self.data_shape = other.data_shape
+            return
+        # Same Chan-style update as add, with other as one large batch.
+        self.count += other.count
+        new_frac = float(other.count) / self.count
+        delta = other._mean.to(self._mean.device).sub(self._mean).mul_(new_frac)
+        self._mean.add_(delta)
+
     def size(self):
         return self.count
 
@@ -492,6 +518,15 @@ class SecondMoment(Stat):
         self.count += batch_count
         self.mom2 += a.t().mm(a)
 
+    def merge(self, other):
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.mom2 = other.mom2.clone()
+        else:
+            self.mom2 += other.mom2.to(self.mom2.device)
+        self.count += other.count
+
     def to_(self, device):
         if self.mom2 is not None:
             self.mom2 = self.mom2.to(device)
@@ -1372,6 +1407,10 @@ class CombinedStat(Stat):
         for obj in self._objs.values():
             obj.add(d, *args, **kwargs)
 
+    def merge(self, other):
+        for k, obj in self._objs.items():
+            obj.merge(other._objs[k])
+
     def load_state_dict(self, state):
         for prefix, obj in self._objs.items():
             obj.load_state_dict(pull_key_prefix(prefix, state))
@@ -0,0 +1,239 @@
+"""
+A crash-safe work queue for splitting the records of an experiment across
+worker processes on one machine, kept in a local SQLite database:
+
+    def run_case(case_id):
+        set_record_seed(args.seed, case_id)
+        ...
+
+    queue = WorkQueue(f'{run_dir}/work_queue.sqlite')
+    queue.process_leased(worker_id, [str(r['case_id']) for r in ds], run_case)
+
+Every worker adds the full list of items (adding is idempotent) and then
+leases items one at a time.  While an item is processed, a background thread
+renews its lease every lease_seconds / 3 seconds; an item whose lease runs
+out, because its worker crashed or hung, is handed to the next worker that
+asks for one.  Items that fail max_attempts times are given up on.
+
+SQLite locking is not reliable on network filesystems, so the database
+should be on a local disk.
+"""
+
+import contextlib
+import hashlib
+import os
+import random
+import sqlite3
+import threading
+import time
+import traceback
+
+import numpy as np
+import torch
+
+PENDING, LEASED, DONE, FAILED = "pending", "leased", "done", "failed"
+
+# Seconds after which the lease of a worker that stopped sending heartbeats expires
+LEASE_SECONDS = 900
+
+
+class WorkQueue:
+    """
+    Lease-based queue of string items shared through a SQLite database.
+    """
+
+    def __init__(self, path, lease_seconds=LEASE_SECONDS, max_attempts=3):
+        self.path = str(path)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with self._transaction() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS items ("
+                " item TEXT PRIMARY KEY,"
+                " position INTEGER,"
+                " status TEXT,"
+                " worker TEXT,"
+                " attempts INTEGER,"
+                " lease_expires REAL,"
+                " updated REAL)"
+            )
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # A connection per transaction, so that the heartbeat thread never shares one.
+        db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+        finally:
+            db.close()
+
+    def add(self, items):
+        """
+        Adds items to the queue in order, ignoring items it already has.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            db.executemany(
+                "INSERT OR IGNORE INTO items VALUES (?, ?, ?, NULL, 0, NULL, ?)",
+                [(str(item), i, PENDING, now) for i, item in enumerate(items)],
+            )
+
+    def lease(self, worker):
+        """
+        Leases the first pending or expired item to worker, returning the
+        item, or None if no item is available.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            # Give up on items whose lease expired too many times
+            db.execute(
+                "UPDATE items SET status = ?, updated = ? "
+                "WHERE status = ? AND lease_expires < ? AND attempts >= ?",
+                (FAILED, now, LEASED, now, self.max_attempts),
+            )
+            row = db.execute(
+                "SELECT item FROM items "
+                "WHERE status = ? OR (status = ? AND lease_expires < ?) "
+                "ORDER BY position LIMIT 1",
+                (PENDING, LEASED, now),
+            ).fetchone()
+            if row is None:
+                return None
+            db.execute(
+                "UPDATE items SET status = ?, worker = ?, attempts = attempts + 1, "
+                "lease_expires = ?, updated = ? WHERE item = ?",
+                (LEASED, str(worker), now + self.lease_seconds, now, row[0]),
+            )
+        return row[0]
+
+    def heartbeat(self, worker, item):
+        """
+        Renews worker's lease on item. Returns False if the lease was lost.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            cursor = db.execute(
+                "UPDATE items SET lease_expires = ?, updated = ? "
+                "WHERE item = ? AND worker = ? AND status = ?",
+                (now + self.lease_seconds, now, str(item), str(worker), LEASED),
+            )
+        return cursor.rowcount > 0
+
+    def complete(self, worker, item):
+        """
+        Marks an item leased by worker as done.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE items SET status = ?, lease_expires = NULL, updated = ? "
+                "WHERE item = ? AND worker = ?",
+                (DONE, now, str(item), str(worker)),
+            )
+
+    def fail(self, worker, item):
+        """
+        Returns an item leased by worker to the queue, or gives up on it once
+        it has been attempted max_attempts times.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE items SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, "
+                "worker = NULL, lease_expires = NULL, updated = ? "
+                "WHERE item = ? AND worker = ? AND status = ?",
+                (self.max_attempts, FAILED, PENDING, now, str(item), str(worker), LEASED),
+            )
+
+    def counts(self):
+        """
+        Returns the number of items with each status.
+        """
+        with self._transaction() as db:
+            rows = db.execute("SELECT status, COUNT(*) FROM items GROUP BY status").fetchall()
+        return dict(rows)
+
+    def process_leased(self, worker, items, process, on_lease=None):
+        """
+        Adds items to the queue, then calls process(item) on the items leased
+        to worker, one at a time, until none are left. An item is completed
+        once process returns. If process raises, the error is printed and the
+        item is returned to the queue, or given up on after max_attempts
+        attempts, and the worker moves on to its next lease; only
+        KeyboardInterrupt and SystemExit stop it. If given,
+        on_lease(item, counts) is called for progress logs.
+        """
+        self.add(items)
+        while True:
+            item = self.lease(worker)
+            if item is None:
+                return
+            if on_lease is not None:
+                on_lease(item, self.counts())
+            try:
+                with Heartbeat(self, worker, item):
+                    process(item)
+            except (KeyboardInterrupt, SystemExit):
+                self.fail(worker, item)
+                raise
+            except Exception:
+                print(f"Worker {worker} failed on {item}:")
+                traceback.print_exc()
+                self.fail(worker, item)
+                continue
+            self.complete(worker, item)
+
+
+class Heartbeat:
+    """
+    Renews a lease from a background thread for as long as it is entered.
+    """
+
+    def __init__(self, queue, worker, item):
+        self.queue, self.worker, self.item = queue, worker, item
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.queue.lease_seconds / 3):
+            if not self.queue.heartbeat(self.worker, self.item):
+                print(f"Worker {self.worker} lost its lease on {self.item}")
+                return
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stopped.set()
+        self.thread.join()
+
+
+def record_seed(seed, key):
+    """
+    Returns a 32 bit seed determined by a run seed and a record key, so that
+    the randomness used for a record does not depend on which worker
+    processes it or on what it processed before.
+    """
+    digest = hashlib.sha256(f"{seed}:{key}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:4], "little")
+
+
+def set_record_seed(seed, key):
+    """
+    Seeds the python, numpy and torch random number generators for a record.
+    """
+    s = record_seed(seed, key)
+    random.seed(s)
+    np.random.seed(s)
+    torch.manual_seed(s)
+    if torch.cuda.is_available():
+        torch.cuda.manual_seed_all(s)
+    return s